@@ -12,7 +12,26 @@
 # We should have one that understands pagination, but whatever
 
 import sys
+import time
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# The list of mime types was hard to get. I found it in a
+# stackexchange posting where the author had found it by
+# proxying the docker requests and looking at the headers.
+_manifest_accept = "application/vnd.docker.distribution.manifest.v2+json," \
+                   "application/vnd.docker.distribution.manifest.list.v2+json," \
+                   "application/vnd.oci.image.index.v1+json," \
+                   "application/vnd.docker.distribution.manifest.v1+prettyjws," \
+                   "application/json," \
+                   "application/vnd.oci.image.manifest.v1+json"
+
+# The status of a probe that timed out, there was no answer to get a
+# status from.  408 is "Request Timeout"
+TIMEOUT = 408
+
 
 def _get_link(headers):
     """Get URL from the Link header if rel is "next" and return it.
@@ -29,7 +48,30 @@ def _get_link(headers):
     return None
 
 
-def _json_get(url, tl_key):
+def manifest_blobs(manifest):
+    """The blobs a manifest refers to, and the manifests a manifest
+    list (or OCI index) refers to.  Knows docker schema 1 and 2 and
+    OCI manifests.
+
+    Returns a tuple: [ blob digests ], [ manifest digests ]
+    """
+
+    blobs = []
+
+    if 'config' in manifest and 'digest' in manifest['config']:
+        blobs.append(manifest['config']['digest'])
+
+    blobs.extend(layer['digest'] for layer in manifest.get('layers', []) if 'digest' in layer)
+
+    # Schema 1 lists the same layer many times
+    blobs.extend(dict.fromkeys(layer['blobSum'] for layer in manifest.get('fsLayers', [])))
+
+    manifests = [ m['digest'] for m in manifest.get('manifests', []) if 'digest' in m ]
+
+    return blobs, manifests
+
+
+def _json_get(url, tl_key, session=requests, timeout=None):
         """Get URL and return the result as a array, supporting
         pagination.
 
@@ -47,12 +89,15 @@ def _json_get(url, tl_key):
 
         For non-paginating requests tl_key may be None, and in this
         case the whole document is returned.
+
+        session is the requests.Session to use, by default plain
+        requests.  timeout is the requests timeout, in seconds.
         """
 
         (scheme, _, host, _) = url.split('/', 3)
         rooturl = "%s//%s" % (scheme, host)
 
-        r = requests.get(url)
+        r = session.get(url, timeout=timeout)
 
         if r.status_code == 404:
             return []
@@ -63,8 +108,7 @@ def _json_get(url, tl_key):
             return []
 
         if r.status_code != 200:
-            sys.exit("Error: %s getting %s" % (r.status_code, url),
-                     file=sys.stderr)
+            sys.exit("Error: %s getting %s" % (r.status_code, url))
 
         if tl_key is None:
             return r.json()
@@ -74,7 +118,7 @@ def _json_get(url, tl_key):
         while l := _get_link(r.headers):
             all_data.extend(r.json()[tl_key])
             url = f"{rooturl}/{l}"
-            r = requests.get(url)
+            r = session.get(url, timeout=timeout)
 
             if r.status_code != 200:
                 print("Unexpected error in the middle of paginated request: %s getting %s" %
@@ -90,6 +134,31 @@ def _json_get(url, tl_key):
         return { tl_key: all_data }
     
 
+class _Latencies:
+    """The latencies of the last size requests, to set timeouts from"""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+
+    def percentile(self, p):
+        """The p percentile of the latencies, or None if too few
+        requests have been seen to tell"""
+
+        with self.lock:
+            if len(self.samples) < 20:
+                return None
+            ordered = sorted(self.samples)
+
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
 class Registry:
     """Class to handle the docker registry API.
 
@@ -116,32 +185,199 @@ class Registry:
                print("    Image type: %s" % mimetype)
     """
 
-    def __init__(self, registry, do_delete = False):
+    def __init__(self, registry, do_delete = False, connections = 10, scheme = "https",
+                 timeout = 60, hedge = False):
         """Initialize the registry object with the registry server
         name.  If you want to actually delete manifests using the
         delete_manifest function you have to specify do_delete=True.
 
+        The requests go through one requests.Session so connections
+        are reused.  If the registry object is used from several
+        threads set connections to the number of threads, that is how
+        many connections are kept open.  scheme is "http" for test
+        registries without TLS.
+
+        No request waits more than timeout seconds for the registry.
+        The probes of manifests and blobs, which are many and small,
+        get a shorter timeout from the latencies seen so far: 4 times
+        the 99th percentile, but at least 1 second.  A request that
+        times out counts as taking the whole timeout, so the timeout
+        grows when the registry gets slow.  A probe that times out is
+        sent once more with the full timeout, and if that times out
+        too it gets the status TIMEOUT.  A probe that loses its
+        connection is handled the same way.  With hedge=True a probe
+        that has not been answered by the 95th percentile of the
+        latencies is sent again, and the first answer is used.  stats()
+        tells how that went.
+
         The registry object has debug and verbose flags which you can
         set directly to possibly get useful information.
         """
 
         self.registry = registry
+        self.url = "%s://%s" % (scheme, registry)
         self.do_delete = do_delete
         self.debug = False
         self.verbose = False
 
+        self.timeout = timeout
+        self.min_timeout = 1.0
+        self.hedge = hedge
+        self.latencies = _Latencies()
+        self.counts = { 'probes': 0, 'timeouts': 0, 'broken': 0, 'retried': 0, 'failed': 0,
+                        'hedged': 0, 'hedge won': 0 }
+        self.lock = threading.Lock()
+
+        # Hedged probes are sent from their own threads, and need a
+        # connection each
+        self.hedger = None
+        if hedge:
+            self.hedger = ThreadPoolExecutor(max_workers=connections * 2)
+            connections *= 2
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount(self.url, adapter)
+
         # Check that the registry is there and version 2
-        r = requests.get("https://%s/v2" % self.registry)
+        r = self.session.get("%s/v2" % self.url, timeout=self.timeout)
         if r.status_code == 200: return None
 
         r.raise_for_status()
 
 
+    def _count(self, what):
+        with self.lock:
+            self.counts[what] += 1
+
+
+    def probe_timeout(self):
+        """The timeout of a probe, from the latencies seen so far"""
+
+        p99 = self.latencies.percentile(99)
+        if p99 is None:
+            return self.timeout
+
+        return min(self.timeout, max(self.min_timeout, 4 * p99))
+
+
+    def _send(self, method, url, headers, timeout):
+        """Send one request, returns the response or None if it timed
+        out or lost the connection"""
+
+        start = time.monotonic()
+        try:
+            # A HEAD of a blob is answered with a redirect to the
+            # storage backend, that is enough to know it's there
+            r = self.session.request(method, url, headers=headers, timeout=timeout,
+                                     allow_redirects=(method != "HEAD"))
+        except requests.exceptions.Timeout:
+            # It took at least this long, leaving it out would make
+            # the registry look faster than it is
+            self.latencies.add(timeout)
+            self._count('timeouts')
+            return None
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            # A read timeout in the middle of the body, or a busy
+            # registry dropping the connection.  No answer either.
+            self.latencies.add(time.monotonic() - start)
+            self._count('broken')
+            if self.debug:
+                print("%s of %s failed: %s" % (method, url, e), file=sys.stderr)
+            return None
+
+        self.latencies.add(time.monotonic() - start)
+        return r
+
+
+    def _probe(self, method, url, headers=None):
+        """Send a GET or HEAD probe with the timeout from the latencies
+        seen, hedged if asked to.  If it times out it is tried again
+        with the full timeout, if that times out too the response has
+        the status TIMEOUT and no content."""
+
+        self._count('probes')
+
+        r = self._try(method, url, headers, self.probe_timeout())
+        if r is None:
+            # Most likely it was just unlucky, a registry with a slow
+            # tail answers the next one as quickly as usual.  Give it
+            # all the time we have before calling it a timeout.
+            self._count('retried')
+            r = self._try(method, url, headers, self.timeout)
+
+        if r is None:
+            self._count('failed')
+            if self.debug:
+                print("%s of %s timed out twice" % (method, url), file=sys.stderr)
+            r = requests.models.Response()
+            r.status_code = TIMEOUT
+            r.url = url
+
+        return r
+
+
+    def _try(self, method, url, headers, timeout):
+        """One try of a probe, hedged if asked to.  Returns the
+        response or None on timeout."""
+
+        delay = self.latencies.percentile(95) if self.hedge else None
+
+        if delay is None:
+            r = self._send(method, url, headers, timeout)
+        else:
+            first = self.hedger.submit(self._send, method, url, headers, timeout)
+            done, _ = wait([first], timeout=delay)
+
+            if len(done) > 0:
+                r = first.result()
+            else:
+                # Slow, ask again and take the first answer.  The GET
+                # and HEAD probes can be repeated safely.
+                self._count('hedged')
+                second = self.hedger.submit(self._send, method, url, headers, timeout)
+                pending = { first, second }
+                r = None
+                while r is None and len(pending) > 0:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        if r is None and f.result() is not None:
+                            r = f.result()
+                            if f is second:
+                                self._count('hedge won')
+
+        return r
+
+
+    def stats(self):
+        """How the probes went, for the log"""
+
+        with self.lock:
+            counts = dict(self.counts)
+
+        p95 = self.latencies.percentile(95)
+
+        return "%d probes, %d requests timed out, %d lost their connection, %d probes retried, %d failed, %d hedged (%d answered first by the hedge), timeout %.1fs, p95 %s" % \
+            (counts['probes'], counts['timeouts'], counts['broken'], counts['retried'], counts['failed'],
+             counts['hedged'], counts['hedge won'],
+             self.probe_timeout(), "%.0fms" % (p95 * 1000) if p95 is not None else "unknown")
+
+
+    def close(self):
+        """Done with the registry.  The hedges still waiting for an
+        answer are given up, so they don't hold up the exit."""
+
+        if self.hedger is not None:
+            self.hedger.shutdown(wait=False, cancel_futures=True)
+
+        self.session.close()
+
+
     def get_repositories(self):
         """Returns a list of repositories in the registry."""
 
 
-        j = _json_get("https://%s/v2/_catalog" % self.registry, "repositories")
+        j = _json_get("%s/v2/_catalog" % self.url, "repositories", self.session, self.timeout)
         if "repositories" not in j:
             return []
 
@@ -151,7 +387,7 @@ class Registry:
     def get_tags(self, repo):
         """Get all tags for a repo"""
 
-        j = _json_get("https://%s/v2/%s/tags/list" % (self.registry, repo), "tags")
+        j = _json_get("%s/v2/%s/tags/list" % (self.url, repo), "tags", self.session, self.timeout)
         if "tags" not in j:
             return []
 
@@ -180,21 +416,25 @@ class Registry:
 
         """
 
-        # The list of mime types was hard to get. I found it in a
-        # stackexchange posting where the author had found it by
-        # proxying the docker requests and looking at the headers.
-        r = requests.get("https://%s/v2/%s/manifests/%s" % (self.registry, repo, tag), \
-                         headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json," \
-                                  "application/vnd.docker.distribution.manifest.list.v2+json," \
-                                  "application/vnd.oci.image.index.v1+json," \
-                                  "application/vnd.docker.distribution.manifest.v1+prettyjws," \
-                                  "application/json," \
-                                  "application/vnd.oci.image.manifest.v1+json"})
+        r = self._probe("GET", "%s/v2/%s/manifests/%s" % (self.url, repo, tag),
+                        headers={"Accept": _manifest_accept})
 
         if r.status_code == 200:
             dcd = r.headers['Docker-Content-Digest']
             dtype = r.headers['Content-Type']
-            mani = _json_get("https://%s/v2/%s/manifests/%s" % (self.registry, repo, tag), None)
+            timeout = self.probe_timeout()
+            start = time.monotonic()
+            try:
+                mani = _json_get("%s/v2/%s/manifests/%s" % (self.url, repo, tag), None, self.session,
+                                 timeout)
+            except requests.exceptions.Timeout:
+                self.latencies.add(timeout)
+                self._count('timeouts')
+                return "", {}, ""
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                self.latencies.add(time.monotonic() - start)
+                self._count('broken')
+                return "", {}, ""
             if r.status_code == 200:
                 return dcd, mani, dtype
             # The error will already have been printed in json_get so don't bother
@@ -203,6 +443,107 @@ class Registry:
         return "", {}, ""
 
 
+    def get_image_manifest(self, repo, ref):
+        """Get the manifest of a tag or digest as it is stored, in one
+        request.  get_manifest gets the manifest a second time without
+        the Accept header, and the registry then converts it to schema
+        1 if it can, this does not.  Use manifest_blobs to see what it
+        refers to.
+
+        Return a tuple: digest, { manifest }, mimetype, status
+
+        On error returns: "", {}, "", status.  The status is the HTTP
+        status code, or TIMEOUT.
+        """
+
+        r = self._probe("GET", "%s/v2/%s/manifests/%s" % (self.url, repo, ref),
+                        headers={"Accept": _manifest_accept})
+
+        if r.status_code != 200:
+            if self.debug:
+                print("GET of %s:%s failed: %s" % (repo, ref, r.status_code), file=sys.stderr)
+            return "", {}, "", r.status_code
+
+        try:
+            manifest = r.json()
+        except ValueError:
+            manifest = {}
+
+        return r.headers.get('Docker-Content-Digest', ""), manifest, r.headers.get('Content-Type', ""), \
+            r.status_code
+
+
+    def get_blob_status(self, repo, digest):
+        """Check if a blob (layer or config) is there with a HEAD
+        request.  Returns the HTTP status code, 200 (or a redirect to
+        the storage backend) if it's there and 404 if it has gone
+        missing."""
+
+        r = self._probe("HEAD", "%s/v2/%s/blobs/%s" % (self.url, repo, digest))
+
+        if self.debug and r.status_code != 200:
+            print("HEAD of %s@%s failed: %s" % (repo, digest, r.status_code), file=sys.stderr)
+
+        return r.status_code
+
+
+    def get_manifest_health(self, repo, tag, get=True):
+        """Check the health of a tag: HEAD the manifest to get the
+        digest and, unless get is False, GET the manifest too to see
+        that it can be retrieved.  The GET is only done if the HEAD
+        went well, if not the manifest is not there either.
+
+        Return a tuple: digest, digest status, manifest status
+
+        The digest is "" if it could not be had.  The statuses are the
+        HTTP status codes, or TIMEOUT, the manifest status is None if it
+        was not retrieved.
+        """
+
+        url = "%s/v2/%s/manifests/%s" % (self.url, repo, tag)
+
+        r = self._probe("HEAD", url, headers={"Accept": _manifest_accept})
+
+        digest = ""
+        if r.status_code == 200:
+            digest = r.headers.get('Docker-Content-Digest', "")
+        elif self.debug:
+            print("HEAD of %s:%s failed: %s" % (repo, tag, r.status_code), file=sys.stderr)
+
+        if not get:
+            return digest, r.status_code, None
+
+        if r.status_code != 200:
+            return digest, r.status_code, r.status_code
+
+        m = self._probe("GET", url, headers={"Accept": _manifest_accept})
+
+        if self.debug and m.status_code != 200:
+            print("GET of %s:%s failed: %s" % (repo, tag, m.status_code), file=sys.stderr)
+
+        return digest, r.status_code, m.status_code
+
+
+    def get_digest(self, repo, tag):
+        """Get only the digest of a tag.  This is a single HEAD request
+        so it's a lot cheaper than get_manifest, use it when you don't
+        need the manifest itself.
+
+        Returns the digest, or "" on error.
+        """
+
+        r = self._probe("HEAD", "%s/v2/%s/manifests/%s" % (self.url, repo, tag),
+                        headers={"Accept": _manifest_accept})
+
+        if r.status_code == 200 and 'Docker-Content-Digest' in r.headers:
+            return r.headers['Docker-Content-Digest']
+
+        if self.debug:
+            print("HEAD of %s:%s failed: %s" % (repo, tag, r.status_code), file=sys.stderr)
+
+        return ""
+
+
     ## Delete functions
 
     def delete_manifest(self, repo, digest):
@@ -226,20 +567,25 @@ class Registry:
 
                     reg.delete_manifest(repo_name, digest)
 
+        Returns True if the manifest was deleted, False if it was not,
+        because of a error or because do_delete is not set.
         """
 
         if not self.do_delete:
             if self.verbose:
                 print("-- (not really) Deleting manifest for %s@%s" % (repo, digest))
-            return
+            return False
 
         if self.verbose:
             print("-- Deleting manifest for %s@%s" % (repo, digest))
 
-        r = requests.delete("https://%s/v2/%s/manifests/%s" % (self.registry, repo, digest))
+        r = self.session.delete("%s/v2/%s/manifests/%s" % (self.url, repo, digest),
+                                timeout=self.timeout)
         if r.status_code != 200 and r.status_code != 202:
             print("--- Error? Result: %s: %s" % (r.status_code, r.text.rstrip()))
-            return
+            return False
 
         if self.debug:
             print("--- Result: %s: %s" % (r.status_code, r.text.rstrip()))
+
+        return True
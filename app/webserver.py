@@ -5,13 +5,23 @@ running kubernets - in a pod."""
 
 import os
 import json
+import time
+import shutil
 import requests
 import argparse
+import threading
+import inventory
+import checkreport
 from pathlib import Path
-from datetime import datetime
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 images = None
+images_lock = threading.Lock()
+
+# When the pod started, as a timestamp.  Fetched from kubernetes once,
+# by fetch_pod_start, so the health check never waits for the API
+pod_start = None
 
 
 class Router:
@@ -48,7 +58,11 @@ class Router:
 
 class RegistryHealthHTTPD(BaseHTTPRequestHandler):
     """Simple HTTP server to serve a simple task, avoiding larger
-    frameworks."""
+    frameworks.  Each request is handled in a thread of its own, so a
+    slow client does not hold up the health checks, and a client that
+    does not send or read anything for timeout seconds is hung up on."""
+
+    timeout = 30
 
     def send_response(self, code, message=None):
         """Superclass override: Send a response without a Server: header."""
@@ -58,10 +72,17 @@ class RegistryHealthHTTPD(BaseHTTPRequestHandler):
 
 
     def _HEAD(self, body, response=200):
-        """Make apropriate headers for GET or HEAD requests"""
+        """Make apropriate headers for GET or HEAD requests, body is
+        bytes or a open file"""
+
+        if isinstance(body, bytes):
+            length = len(body)
+        else:
+            length = os.fstat(body.fileno()).st_size
+
         self.send_response(response)
         self.send_header("Content-type", "text/plain;chatset=utf-8")
-        self.send_header("Content-length", len(body))
+        self.send_header("Content-length", length)
         self.end_headers()
 
 
@@ -74,6 +95,9 @@ class RegistryHealthHTTPD(BaseHTTPRequestHandler):
         don't find the path or no content (None) is returned by the
         handler we return 404. Otherwise we return 200.
 
+        A handler may return a open file instead of a string, it is
+        sent as it is without reading it all into memory first.
+
         Some responses are for a nagios plugin.  The words "OK",
         "WARNING", "CRITICAL", "UNKNOWN" are used by the nagios
         plugwin to detect what to set the exit code to.  Do not use
@@ -89,6 +113,9 @@ class RegistryHealthHTTPD(BaseHTTPRequestHandler):
             body = "Not found"
             response_code = 404
 
+        if not isinstance(body, str):
+            return (body, response_code)
+
         if "ERROR" in body:
             response_code = 503 # Service unavailable
 
@@ -103,28 +130,41 @@ class RegistryHealthHTTPD(BaseHTTPRequestHandler):
     def do_GET(self):
         (body, response_code) = self._GET()
         self._HEAD(body, response=response_code)
-        if body is not None: self.wfile.write(body)
+
+        if isinstance(body, bytes):
+            self.wfile.write(body)
+            return
+
+        with body:
+            shutil.copyfileobj(body, self.wfile)
 
 
     def do_HEAD(self):
         (body, response_code) = self._GET()
         self._HEAD(body, response=response_code)
 
+        if not isinstance(body, bytes):
+            body.close()
+
 
 ### Helper procedures ###
 
 def load_images(text=None):
-    """Load images from string"""
+    """Load images.json from string, as inventory.ImageRecords"""
 
     global images
 
-    if images is not None:
-        return  # Already loaded
+    # Several requests may want them at once, load them only once
+    with images_lock:
+        if images is not None:
+            return  # Already loaded
 
-    if text is None: # Caller did not provide text
-        text = Path(f"{report_dir}/images.json").read_text()
+        if text is None: # Caller did not provide text
+            text = Path(f"{report_dir}/images.json").read_text()
 
-    images = json.loads(text)
+        images = { image: inventory.ImageRecord.from_entry(image, entry)
+                   for image, entry in json.loads(text).items()
+                   if not image.startswith("_") }
 
 
 def health_check(request, path, query):
@@ -135,12 +175,12 @@ def health_check(request, path, query):
         return "ERROR: Can't get pod uptime"
 
     try:
-        image_report = Path(f"{report_dir}/images.json").stat()
+        image_report = Path(inventory.newest_path(report_dir)).stat()
     except FileNotFoundError:
         image_report = None
 
     try:
-        check_time = Path(f"{report_dir}/registry-check.json").stat()
+        check_time = Path(f"{report_dir}/{checkreport.SUMMARY}").stat()
     except FileNotFoundError:
         check_time = None
 
@@ -153,38 +193,35 @@ def health_check(request, path, query):
     return "OK"
 
 
-def image_info(tag):
-    """Get image info from the tag and images report"""
+def image_record(tag):
+    """The images report inventory.ImageRecord of the tag, or None.
+    From images.db only the tag is looked up, images.json has to be
+    loaded whole."""
 
-    global images
+    path = inventory.newest_path(report_dir)
+
+    if path.endswith(".db"):
+        return inventory.load_record(tag, path)
 
     if images is None:
         load_images()
 
-    info = "%s is running on: " % tag
-    run_nodes = []
-    ran_nodes = []
-    some_pod = ""
-
-    if tag not in images:
-        return "no information available"
+    return images.get(tag)
 
-    tag_info = images[tag]
 
-    for pod in tag_info.keys():
-        if pod.startswith("_"):
-            continue
+def image_info(tag):
+    """Get image info from the tag and images report"""
 
-        if tag_info[pod]["Running"]:
-            some_pod = pod
-            run_nodes.append(tag_info[pod]["_node"])
+    record = image_record(tag)
 
-        if tag_info[pod]["Succeeded"] or tag_info[pod]["Failed"]:
-            ran_nodes.append(tag_info[pod]["_node"])
+    if record is None:
+        return "no information available"
 
+    run_nodes = [ pod.node or "unknown node" for pod in record.pods_in(inventory.RUNNING) ]
     if len(run_nodes) > 0:
         return "is running on: %s" % ", ".join(run_nodes)
 
+    ran_nodes = [ pod.node or "unknown node" for pod in record.pods_in(inventory.SUCCEEDED | inventory.FAILED) ]
     if len(ran_nodes) > 0:
         return "has run on: %s" % ", ".join(ran_nodes)
 
@@ -200,61 +237,94 @@ def summarize(check):
     tags = []
     lesser_tags = []
     least_tags = []
+    # The registry did not answer in time, that is not a missing image
+    timeouts = 0
+    # The -R and -S errors are about the registry, not any namespace,
+    # counted by kind
+    registry_errors = {}
 
     for error in check:
-        namespaces = "=".join(error["namespaces"])
-        tag_info = image_info(error["tag"])
+        wrongs = error.get("wrongs", [])
+        if isinstance(wrongs, str):
+            wrongs = [ wrongs ]
+        else:
+            wrongs = list(wrongs)
+
+        if wrongs == ["timeout"]:
+            timeouts += 1
+            continue
+
+        if "namespaces" not in error:
+            kind = error.get("kind", "registry")
+            registry_errors[kind] = registry_errors.get(kind, 0) + 1
+            continue
+
+        tag = error.get("tag")
+
+        namespaces = "=".join(error.get("namespaces", []))
+        phase = error.get("phase", [])
+        tag_info = image_info(tag)
 
         if "prod" in namespaces:
             prod_errors += 1
 
-            if "ImagePullBackOff" in error["phase"]:
+            if "ImagePullBackOff" in phase:
                 image_pull_errors += 1
                 prod_errors -= 1
                 if tag_info is None:
-                    tags.append(f'ImagePullBackOff: {error["tag"]} (and not running anywhere)')
+                    tags.append(f'ImagePullBackOff: {tag} (and not running anywhere)')
                 else:
-                    tags.append(f'ImagePullBackOff: {error["tag"]} (but {tag_info})')
+                    tags.append(f'ImagePullBackOff: {tag} (but {tag_info})')
 
-            elif len(error["wrongs"]) > 0:
+            elif len(wrongs) > 0:
                 if tag_info is None:
-                    lesser_tags.append(f'{error["wrongs"]}: {error["tag"]} (and not running anywhere)')
+                    lesser_tags.append(f'{wrongs}: {tag} (and not running anywhere)')
                 else:
-                    lesser_tags.append(f'{error["wrongs"]}: {error["tag"]} ({tag_info})')
+                    lesser_tags.append(f'{wrongs}: {tag} ({tag_info})')
 
         # "stage" or "staging"
         if "stage" in namespaces or "staging" in namespaces:
             stage_errors += 1
 
-        if "ImagePullBackOff" in error["phase"]:
-            error["wrongs"].append("ImagePullBackOff")
+        if "ImagePullBackOff" in phase:
+            wrongs.append("ImagePullBackOff")
         if tag_info is None:
-            least_tags.append(f'{error["wrongs"]}: {error["tag"]} (and not running anywhere)')
+            least_tags.append(f'{wrongs}: {tag} (and not running anywhere)')
         else:
-            least_tags.append(f'{error["wrongs"]}: {error["tag"]} ({tag_info})')
+            least_tags.append(f'{wrongs}: {tag} ({tag_info})')
 
-    all_errors = len(check) - prod_errors - stage_errors
+    all_errors = len(check) - timeouts - sum(registry_errors.values()) - prod_errors - stage_errors
+
+    unchecked = ""
+    if len(registry_errors) > 0:
+        unchecked += " (in the registry: %s)" % \
+            ", ".join(f"{n} {kind} errors" for kind, n in sorted(registry_errors.items()))
+    if timeouts > 0:
+        unchecked += f" ({timeouts} images could not be checked, the registry timed out)"
 
     if image_pull_errors > 0:
-        errormsg = [ f"CRITICAL: Missing images: {image_pull_errors} ImagePullBackOff errors in prod. Otherwise: {prod_errors} image problems in prod, {stage_errors} in staging, and {all_errors} in other namespaces" ]
+        errormsg = [ f"CRITICAL: Missing images: {image_pull_errors} ImagePullBackOff errors in prod. Otherwise: {prod_errors} image problems in prod, {stage_errors} in staging, and {all_errors} in other namespaces{unchecked}" ]
         errormsg.extend(tags)
         errormsg.extend(lesser_tags)
         return "\n".join(errormsg)
 
     if prod_errors > 0:
-        errormsg = [ f"WARNING: Missing images: 0 ImagePullBackOff errors in prod, {prod_errors} errors in prod, {stage_errors} in staging, and {all_errors} in other namespaces" ]
+        errormsg = [ f"WARNING: Missing images: 0 ImagePullBackOff errors in prod, {prod_errors} errors in prod, {stage_errors} in staging, and {all_errors} in other namespaces{unchecked}" ]
         errormsg.extend(lesser_tags)
         return "\n".join(errormsg)
 
     if stage_errors > 0:
-        errormsg = [ f"WARNING: Missing images: {stage_errors} errors in stage and {all_errors} in other namespaces" ]
+        errormsg = [ f"WARNING: Missing images: {stage_errors} errors in stage and {all_errors} in other namespaces{unchecked}" ]
         errormsg.extend(least_tags)
         return "\n".join(errormsg)
 
     if all_errors > 0:
-        return f"OK: Missing images: {all_errors} errors in non-production, non-stage namespaces"
+        return f"OK: Missing images: {all_errors} errors in non-production, non-stage namespaces{unchecked}"
+
+    if len(registry_errors) > 0:
+        return f"OK: No missing images in any namespace{unchecked}"
 
-    return "OK: No missing images anywhere"
+    return f"OK: No missing images anywhere{unchecked}"
 
 
 ### HTTP endpoints ###
@@ -273,41 +343,56 @@ def check_registry(request, path, query):
         return "OK: No registry check available yet"
 
     try:
-        check = Path(f"{report_dir}/registry-check.json").read_text()
+        check = list(checkreport.load_errors(report_dir))
     except FileNotFoundError:
         return "ERROR: Registry check is unavailable and pod is old enough!"
 
-    check = json.loads(check)
+    summary = checkreport.load_summary(report_dir)
+    if summary is not None and summary.get('partial'):
+        return summarize(check) + "\n(The check is still running, this is what is found so far)"
 
     return summarize(check)
 
 
 def cat(request, path, query):
-    """Endpoint to cat one of three files. None return generates 404"""
+    """Endpoint to cat one of the report files. None return generates 404"""
 
     if path == "/_report.json":
+        # The report is saved as JSON lines, this is the old format
         try:
-            return Path(f"{report_dir}/registry-check.json").read_text()
+            return json.dumps(list(checkreport.load_errors(report_dir)), indent=2, sort_keys=True)
         except FileNotFoundError:
             return None
 
-    if path == "/_report.csv":
-        try:
-            return Path(f"{report_dir}/registry-check.csv").read_text()
-        except FileNotFoundError:
-            return None
+    files = { "/_report.jsonl": checkreport.JSONL,
+              "/_summary.json": checkreport.SUMMARY,
+              "/_report.csv": checkreport.CSV,
+              "/_images.json": "images.json" }
 
-    if path == "/_images.json":
-        try:
-            return Path(f"{report_dir}/images.json").read_text()
-        except FileNotFoundError:
-            return None
+    if path not in files:
+        return None
 
-    return None
+    # The files can be large, they're sent straight from the file.
+    # The reports are replaced by renaming, so the open file stays
+    # the whole report even if a new one is published meanwhile.
+    try:
+        return open(f"{report_dir}/{files[path]}", "rb")
+    except FileNotFoundError:
+        return None
 
 
 def get_uptime():
-    """Get pod uptime from kubernetes"""
+    """Get pod uptime, or None if the pod start time is not known
+    (yet)"""
+
+    if pod_start is None:
+        return None
+
+    return time.time() - pod_start
+
+
+def get_pod_start():
+    """Get pod start time from kubernetes, as a timestamp"""
 
     # Kubernetes API usage from a pod without the whole kubernetes module
     try:
@@ -315,32 +400,50 @@ def get_uptime():
         token = Path("/var/run/secrets/kubernetes.io/serviceaccount/token").read_text()
     except FileNotFoundError:
         print("Hmm, we're not in kubernetes I think, faking uptime")
-        return 600 # Fake that we have uptime
+        return time.time() - 600 # Fake that we have uptime
 
     pod_name = os.getenv('HOSTNAME')
     kube_api = os.getenv('KUBERNETES_SERVICE_HOST')
     kube_api_port = os.getenv('KUBERNETES_SERVICE_PORT')
     auth = "Bearer %s" % token
 
-    r = requests.get('https://%s/api/v1/namespaces/%s/pods/%s' % \
-                     (kube_api, namespace, pod_name),
-                     headers={'Authorization': auth},
-                     verify='/var/run/secrets/kubernetes.io/serviceaccount/ca.crt')
+    try:
+        r = requests.get('https://%s/api/v1/namespaces/%s/pods/%s' % \
+                         (kube_api, namespace, pod_name),
+                         headers={'Authorization': auth},
+                         verify='/var/run/secrets/kubernetes.io/serviceaccount/ca.crt',
+                         timeout=10)
+    except requests.exceptions.RequestException as e:
+        print("Pod start time query failed: %s" % e)
+        return None
 
     if r.status_code == 200:
         start_time = r.json()['status']['startTime']
         start_time = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%SZ')
-        seconds = (datetime.now() - start_time).total_seconds()
-        return seconds
+        return start_time.replace(tzinfo=timezone.utc).timestamp()
 
-    print("Uptime query failed: %d" % r.status_code)
+    print("Pod start time query failed: %d" % r.status_code)
     return None
 
 
+def fetch_pod_start():
+    """Get the pod start time, trying again every 10 seconds until
+    kubernetes answers"""
+
+    global pod_start
+
+    while (start := get_pod_start()) is None:
+        time.sleep(10)
+
+    pod_start = start
+
+
 def main():
     parser = argparse.ArgumentParser(description='Docker registry health checker in a pod')
     parser.add_argument('-p', '--port', type=int, default=8000,
                         help='Port to listen on')
+    parser.add_argument('-t', '--timeout', type=int, default=30,
+                        help='Seconds to wait for a client to send or read something, default 30')
     args = parser.parse_args()
 
     global report_dir
@@ -358,11 +461,24 @@ def main():
     router.setup("/_nagios_check_registry", check_registry)
     router.setup("/_report.csv", cat)
     router.setup("/_report.json", cat)
+    router.setup("/_report.jsonl", cat)
+    router.setup("/_summary.json", cat)
     router.setup("/_images.json", cat)
     # Compatability for now
     router.setup("/nagios_check_registry", check_registry)
 
-    web_server = HTTPServer(('', args.port), RegistryHealthHTTPD)
+    # The pod start time does not change, get it once in the
+    # background so the server can start answering at once.  Until
+    # kubernetes answers the pod is taken to have started now, which
+    # is close enough and errs on the young side
+    global pod_start
+    pod_start = time.time()
+    threading.Thread(target=fetch_pod_start, daemon=True).start()
+
+    RegistryHealthHTTPD.timeout = args.timeout
+
+    web_server = ThreadingHTTPServer(('', args.port), RegistryHealthHTTPD)
+    web_server.daemon_threads = True
     print("Server started on http://%s:%s" %
           (web_server.server_name, web_server.server_port))
 
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+# Benchmark registry-checker.py with a number of workers against a fake
+# registry with a given latency, and check that the reports are the
+# same whatever the number of workers.
+#
+# Usage:
+# - bench/checker-bench.py
+# - bench/checker-bench.py -i 2000 -l 20 -w 1 -w 8 -w 32
+# - bench/checker-bench.py -C   (also run twice with the health cache)
+# - bench/checker-bench.py -I   (incremental runs, with tags pushed again in between)
+# - bench/checker-bench.py -D   (deep checks, every 30th image misses a layer
+#                                and one repository its link to the base layer)
+# - bench/checker-bench.py -R   (check the whole registry, as -R does)
+#
+# The report is also summarized by app/webserver.py as for nagios.
+# - bench/checker-bench.py -R -T 2 -s 3 -H   (slow tail, hanging tags, hedging)
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import importlib.util
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+import inventory
+from Spinner import Spinner
+from fakeregistry import FakeRegistry, fake_digest
+from healthcache import HealthCache, BlobCache
+
+# The dash in the name means it can't be imported the normal way
+spec = importlib.util.spec_from_file_location(
+    "registry_checker", os.path.join(os.path.dirname(here), "registry-checker.py"))
+registry_checker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(registry_checker)
+
+spec = importlib.util.spec_from_file_location(
+    "webserver", os.path.join(os.path.dirname(here), "app", "webserver.py"))
+webserver = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(webserver)
+
+
+def make_inventory(registry, n):
+    """A inventory with n running images in registry, spread over
+    n / 10 repositories"""
+
+    repos = {}
+    images = {}
+
+    for i in range(n):
+        repo = "team%d/app%d" % (i % 7, i // 10)
+        tag = "v%d" % i
+        repos.setdefault(repo, []).append(tag)
+
+        pod = inventory.phase_dict(inventory.RUNNING)
+        pod['_last_wanted'] = 0
+        pod['_node'] = "node%d" % (i % 13)
+
+        images[f'{registry}/{repo}:{tag}'] = { '_phase': inventory.phase_dict(inventory.RUNNING),
+                                               '_last_wanted': 0,
+                                               '_canonical': [ f'{registry}/{repo}@' +
+                                                               fake_digest(f'{repo}:{tag}') ],
+                                               f'k8s;bench;ns{i % 5}-prod;pod{i}': pod }
+
+    return (repos, images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark registry-checker.py workers against a fake registry')
+    parser.add_argument('-i', '--images', action='store', type=int, default=500,
+                        help='Number of running images, default 500')
+    parser.add_argument('-l', '--latency', action='store', type=float, default=20,
+                        help='Latency of each registry request in ms, default 20')
+    parser.add_argument('-w', '--workers', action='append', type=int,
+                        help='Number of workers to try (can be repeated), default 1 and 16')
+    parser.add_argument('-C', '--cache', action='store_true', default=False,
+                        help='Also run twice with the health cache, with the last number of workers')
+    parser.add_argument('-I', '--incremental', action='store_true', default=False,
+                        help='Also run incrementally, and again after every 25th tag is pushed again and redeployed')
+    parser.add_argument('-R', '--by-registry', action='store_true', default=False,
+                        help='Check everything in the registry instead of the images in use')
+    parser.add_argument('-T', '--tail', action='store', type=float, default=0,
+                        help='Percent of the requests that take a second longer, default 0')
+    parser.add_argument('-s', '--slow', action='store', type=int, default=0,
+                        help='Number of tags that hang for 60 seconds, default 0')
+    parser.add_argument('-t', '--timeout', action='store', type=int, default=30,
+                        help='The checker -t, default 30')
+    parser.add_argument('-H', '--hedge', action='store_true', default=False,
+                        help='Hedge the probes, as the checker -H')
+    parser.add_argument('-D', '--deep', action='store_true', default=False,
+                        help='Check the blobs of the images too')
+    args = parser.parse_args()
+
+    workers = args.workers or [1, 16]
+
+    os.environ['REPORTDIR'] = tempfile.mkdtemp(prefix="checker-bench-")
+
+    # The registry port is not known before it's started, so start it
+    # empty and fill it in
+    fake = FakeRegistry({}, latency=args.latency / 1000, tail=(args.tail / 100, 1.0))
+    fake.start()
+
+    (repos, images) = make_inventory(fake.registry, args.images)
+    fake.repos.update(repos)
+    fake.repos['team0/empty'] = []
+    # Some tags hang, the first ones of the later repositories
+    for repo in sorted(repos)[-args.slow:] if args.slow > 0 else []:
+        fake.slow[f'{repo}:{repos[repo][0]}'] = 60
+    # Every 50th tag is missing
+    fake.missing.update(f'{repo}:{tag}' for repo, tags in repos.items()
+                        for tag in tags if int(tag[1:]) % 50 == 0)
+    # And every 30th has lost its own layer
+    fake.missing_blobs.update(fake_digest(f'layer {repo}:{tag}') for repo, tags in repos.items()
+                              for tag in tags if int(tag[1:]) % 30 == 0)
+    # One repository has lost its link to the base layer all the
+    # others have
+    unlinked = sorted(repos)[len(repos) // 2]
+    fake.missing_links.add((unlinked, fake.base_layer))
+
+    image_report = { image: inventory.ImageRecord.from_entry(image, entry)
+                     for image, entry in images.items() }
+    used = inventory.index_by_registry(image_report)[fake.registry]
+
+    registry_checker.spinner = Spinner()
+    registry_checker.registry_scheme = "http"
+    registry_checker.registry_timeout = args.timeout
+    registry_checker.hedge = args.hedge
+
+    print("%d images, %d ms latency, %.1f%% a second slower, %d hanging%s%s" %
+          (args.images, args.latency, args.tail, args.slow,
+           ", deep" if args.deep else "", ", hedged" if args.hedge else ""))
+
+    def blobs():
+        return BlobCache(fake.registry) if args.deep else None
+
+    results = {}
+    for w in workers:
+        fake.requests = 0
+        start = time.perf_counter()
+        if args.by_registry:
+            errors = registry_checker.examine_by_registry(image_report, fake.registry, used, None, w)
+        else:
+            errors = registry_checker.examine_by_report(image_report, fake.registry, used, None, w,
+                                                        None, blobs())
+        took = time.perf_counter() - start
+        results[w] = (took, errors)
+        print("%3d workers: %6.2fs  %d requests, %d errors%s" %
+              (w, took, fake.requests, len(errors), registry_checker.clear_eol))
+
+    if args.cache:
+        w = workers[-1]
+        for run in ("cold", "warm"):
+            fake.requests = 0
+            cache = HealthCache.load(fake.registry)
+            start = time.perf_counter()
+            errors = registry_checker.examine_by_report(image_report, fake.registry, used, None, w,
+                                                        cache, blobs())
+            took = time.perf_counter() - start
+            print("%s cache: %6.2fs  %d requests, %d errors%s" %
+                  (run, took, fake.requests, len(errors), registry_checker.clear_eol))
+            if errors != results[workers[0]][1]:
+                print("WARNING: %s cache gave a different report" % run)
+
+    if args.incremental:
+        w = workers[-1]
+        # Every 25th tag is pushed again and redeployed, as tag pinned
+        # images, so only the _canonical reference tells
+        pushed = [ (repo, tag) for repo, tags in repos.items()
+                   for tag in tags if int(tag[1:]) % 25 == 1 ]
+
+        for run in ("cold", "warm", "pushed"):
+            if run == "pushed":
+                for (repo, tag) in pushed:
+                    fake.push(repo, tag)
+                    image_report[f'{fake.registry}/{repo}:{tag}'].canonical = \
+                        [ f'{fake.registry}/{repo}@{fake.digest(repo, tag)}' ]
+
+            fake.requests = 0
+            cache = HealthCache.load(fake.registry, healthy_ttl=float('inf'), failed_ttl=0)
+            start = time.perf_counter()
+            errors = registry_checker.examine_by_report(image_report, fake.registry, used, None, w,
+                                                        cache, blobs())
+            took = time.perf_counter() - start
+            print("%s incremental: %6.2fs  %d requests, %d errors%s" %
+                  (run, took, fake.requests, len(errors), registry_checker.clear_eol))
+
+            if run == "pushed" and cache.counts['changed'] != len(pushed):
+                print("WARNING: %d tags were pushed again but %d were checked as changed" %
+                      (len(pushed), cache.counts['changed']))
+
+    fake.stop()
+
+    # The web server must be able to summarize whatever report was made
+    inventory.save_images(images, formats=('json',))
+    webserver.report_dir = os.environ['REPORTDIR']
+    for w, (_, errors) in results.items():
+        try:
+            summary = webserver.summarize(errors)
+        except Exception as e:
+            print("WARNING: The web server could not summarize the report of %d workers: %r" % (w, e))
+            continue
+        if w == workers[0]:
+            print("Summary: %s" % summary.split("\n")[0])
+
+    if args.deep and not args.by_registry:
+        # Every image in the unlinked repository misses the base layer,
+        # however the workers happened to check it in other repositories
+        expected = sorted(f'{fake.registry}/{unlinked}:{tag}' for tag in repos[unlinked]
+                          if f'{unlinked}:{tag}' not in fake.missing)
+        for w, (_, errors) in results.items():
+            unlinked_errors = sorted(e['tag'] for e in errors if fake.base_layer in e.get('missing', []))
+            if unlinked_errors != expected:
+                print("WARNING: %d workers found %d images missing the base layer link, not %d" %
+                      (w, len(unlinked_errors), len(expected)))
+
+    first = results[workers[0]]
+    for w in workers[1:]:
+        if results[w][1] != first[1]:
+            print("WARNING: %d workers gave a different report than %d" % (w, workers[0]))
+        print("Speedup with %d workers: %.1fx" % (w, first[0] / results[w][0]))
+
+
+if __name__ == "__main__":
+    main()
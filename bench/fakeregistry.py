@@ -0,0 +1,176 @@
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+# A fake docker registry for the benchmarks, serving made up manifests
+# over plain http with a given latency per request.
+#
+# Usage:
+#    from fakeregistry import FakeRegistry
+#
+#    fake = FakeRegistry({ "ops/certmon": ["1", "2"] }, latency=0.02,
+#                        missing={ "ops/certmon:2" })
+#    fake.start()
+#    reg = Registry(fake.registry, scheme="http")
+#    ...
+#    fake.stop()
+
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_digest(text):
+    return "sha256:" + hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class FakeRegistry:
+    """A registry with the given repos (dict of repo -> list of tags).
+
+    - latency: Seconds to wait before answering each request
+    - missing: Set of "repo:tag" that give 404
+    - missing_blobs: Set of blob digests that give 404
+    - missing_links: Set of (repo, digest) of blobs that give 404 in
+      that repository only, its link to the blob is gone
+    - slow: Dict of "repo:tag" -> seconds to wait for that manifest
+    - tail: (fraction, seconds), that fraction of the requests take
+      that many seconds longer, as the slow tail of a busy registry
+
+    Each manifest refers to a config blob, a base layer shared by all
+    the images and a layer of its own.  requests counts the requests
+    served.  push(repo, tag) pushes the tag again, as a new manifest
+    with another digest.
+    """
+
+    base_layer = fake_digest("base layer")
+
+    def __init__(self, repos, latency=0.0, missing=(), missing_blobs=(), slow=None,
+                 tail=(0.0, 0.0), missing_links=()):
+        self.repos = repos
+        self.latency = latency
+        self.missing = set(missing)
+        self.missing_blobs = set(missing_blobs)
+        self.missing_links = set(missing_links)
+        self.slow = slow or {}
+        self.tail = tail
+        self.pushed = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+
+    def push(self, repo, tag):
+        self.pushed[f"{repo}:{tag}"] = self.pushed.get(f"{repo}:{tag}", 0) + 1
+
+
+    def digest(self, repo, tag):
+        """The digest repo:tag refers to now"""
+
+        pushes = self.pushed.get(f"{repo}:{tag}", 0)
+        if pushes == 0:
+            return fake_digest(f"{repo}:{tag}")
+
+        return fake_digest(f"{repo}:{tag} push {pushes}")
+
+
+    def manifest(self, repo, tag):
+        return json.dumps({
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+            "config": { "digest": fake_digest(f"config {self.digest(repo, tag)}"), "size": 100 },
+            "layers": [ { "digest": self.base_layer, "size": 1000 },
+                        { "digest": fake_digest(f"layer {repo}:{tag}"), "size": 100 } ]
+        }).encode('utf-8')
+
+
+    def start(self):
+        """Start serving on a free port of 127.0.0.1 in a thread"""
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def answer(self, code, body=b"", headers=None):
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                with fake.lock:
+                    fake.requests += 1
+
+                delay = fake.latency
+                if random.random() < fake.tail[0]:
+                    delay += fake.tail[1]
+                time.sleep(delay)
+
+                path = self.path.split("?")[0]
+
+                if path in ("/v2", "/v2/"):
+                    return self.answer(200, b"{}")
+
+                if path == "/v2/_catalog":
+                    return self.answer(200, json.dumps({ "repositories": sorted(fake.repos) }).encode())
+
+                rest = path[len("/v2/"):]
+
+                if rest.endswith("/tags/list"):
+                    repo = rest[:-len("/tags/list")]
+                    if repo not in fake.repos:
+                        return self.answer(404)
+                    return self.answer(200, json.dumps({ "name": repo, "tags": fake.repos[repo] }).encode())
+
+                if "/manifests/" in rest:
+                    (repo, ref) = rest.split("/manifests/", 1)
+                    tags = fake.repos.get(repo, [])
+                    if ref.startswith("sha256:"):
+                        ref = next((t for t in tags if fake.digest(repo, t) == ref), None)
+
+                    if ref not in tags or f"{repo}:{ref}" in fake.missing:
+                        return self.answer(404)
+
+                    time.sleep(fake.slow.get(f"{repo}:{ref}", 0))
+
+                    return self.answer(200, fake.manifest(repo, ref),
+                                       { "Docker-Content-Digest": fake.digest(repo, ref),
+                                         "Content-Type": "application/vnd.docker.distribution.manifest.v2+json" })
+
+                if "/blobs/" in rest:
+                    (repo, digest) = rest.split("/blobs/", 1)
+                    if repo not in fake.repos or digest in fake.missing_blobs or \
+                       (repo, digest) in fake.missing_links:
+                        return self.answer(404)
+                    return self.answer(200, b"", { "Docker-Content-Digest": digest })
+
+                return self.answer(404)
+
+            do_HEAD = do_GET
+
+        class Server(ThreadingHTTPServer):
+            def handle_error(self, request, client_address):
+                # The checker hangs up on requests it gave up on
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.registry = "127.0.0.1:%d" % self.server.server_port
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
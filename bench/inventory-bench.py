@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+# Benchmark the two ways k8s-inventory.py can read pods: Through the
+# kubernetes client model objects (-M) or straight from the raw JSON
+# (the default).
+#
+# Usage:
+# - Record a pod list from a big cluster:
+#     kubectl get pods -A -o json > pods.json
+# - Or make a synthetic one:
+#     bench/inventory-bench.py -g 20000 pods.json
+# - Then:
+#     bench/inventory-bench.py pods.json
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib.util
+from datetime import datetime, timezone, timedelta
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# The dash in the name means it can't be imported the normal way
+spec = importlib.util.spec_from_file_location(
+    "k8s_inventory", os.path.join(os.path.dirname(here), "k8s-inventory.py"))
+k8s_inventory = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(k8s_inventory)
+
+from kubernetes import client
+
+
+class Response:
+    """Just enough of a urllib3 response for ApiClient.deserialize"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+def generate(n, path):
+    """Write a synthetic pod list with n pods, looking roughly like a
+    kubectl get pods -A -o json"""
+
+    now = datetime.now(timezone.utc)
+    phases = ['Running'] * 8 + ['Succeeded', 'Pending']
+    items = []
+
+    for p in range(n):
+        ns = "team%d-%s" % (p % 40, random.choice(["prod", "staging", "dev"]))
+        repo = "docker.example.com/team%d/app%d" % (p % 40, p % 400)
+        tag = "%07x" % random.randrange(16**7)
+        digest = "sha256:%064x" % random.randrange(16**64)
+        started = (now - timedelta(hours=random.randrange(24*40))).strftime('%Y-%m-%dT%H:%M:%SZ')
+        phase = random.choice(phases)
+
+        state = { 'running': { 'startedAt': started } }
+        if phase == 'Succeeded':
+            state = { 'terminated': { 'startedAt': started, 'finishedAt': started,
+                                      'exitCode': 0, 'reason': 'Completed' } }
+        elif phase == 'Pending':
+            state = { 'waiting': { 'reason': 'ImagePullBackOff' } }
+
+        items.append({
+            'apiVersion': 'v1', 'kind': 'Pod',
+            'metadata': { 'name': "app%d-%s" % (p, tag), 'namespace': ns,
+                          'uid': "%032x" % random.randrange(16**32),
+                          'creationTimestamp': started,
+                          'labels': { 'app': "app%d" % (p % 400), 'pod-template-hash': tag },
+                          'ownerReferences': [ { 'apiVersion': 'apps/v1', 'kind': 'ReplicaSet',
+                                                 'name': "app%d" % p, 'uid': "%032x" % p,
+                                                 'controller': True } ] },
+            'spec': { 'nodeName': "node-%d" % (p % 60),
+                      'containers': [ { 'name': 'app', 'image': f'{repo}:{tag}',
+                                        'env': [ { 'name': "VAR%d" % e, 'value': "x" * 20 }
+                                                 for e in range(10) ],
+                                        'resources': { 'limits': { 'cpu': '1', 'memory': '1Gi' } } } ] },
+            'status': { 'phase': phase, 'startTime': started, 'podIP': '10.0.0.1',
+                        'conditions': [ { 'type': 'Ready', 'status': 'True',
+                                          'lastTransitionTime': started } ],
+                        'containerStatuses': [ { 'name': 'app', 'image': f'{repo}:{tag}',
+                                                 'imageID': f'{repo}@{digest}',
+                                                 'ready': True, 'restartCount': 0,
+                                                 'state': state } ] } })
+
+    with open(path, "w") as f:
+        json.dump({ 'apiVersion': 'v1', 'kind': 'PodList', 'metadata': {}, 'items': items }, f)
+
+    print("Wrote %d pods to %s" % (n, path))
+
+
+def by_models(data):
+    images = {}
+    api = client.ApiClient()
+    try:
+        pods = api.deserialize(Response(data), 'V1PodList')
+    except TypeError:
+        # Newer clients take the text and content type instead
+        pods = api.deserialize(data.decode(), 'V1PodList', 'application/json')
+    for i in pods.items:
+        k8s_inventory.add_pod(images, 'bench', k8s_inventory.Pod.from_model(i))
+    return images
+
+
+def by_json(data):
+    images = {}
+    for i in json.loads(data).get('items', []):
+        k8s_inventory.add_pod(images, 'bench', k8s_inventory.Pod.from_json(i))
+    return images
+
+
+def rounded(images):
+    """The ages are computed from the time of the run, so round them off
+    before comparing"""
+
+    images = json.loads(json.dumps(images), parse_float=lambda f: round(float(f), 2))
+    return json.dumps(images, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading pods from model objects vs raw JSON')
+    parser.add_argument('-g', '--generate', action='store', type=int, default=None,
+                        help='Generate a synthetic pod list with this many pods instead')
+    parser.add_argument('-n', '--rounds', action='store', type=int, default=3,
+                        help='Number of rounds to run each way, the best is reported. Default 3')
+    parser.add_argument('file', help='Pod list in JSON, as from kubectl get pods -A -o json')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate(args.generate, args.file)
+        return
+
+    with open(args.file, "rb") as f:
+        data = f.read()
+
+    print("%d MB of pod list" % (len(data) / 1024 / 1024))
+
+    results = {}
+    for name, fn in (("model objects", by_models), ("raw JSON", by_json)):
+        best = None
+        for r in range(args.rounds):
+            start = time.perf_counter()
+            images = fn(data)
+            took = time.perf_counter() - start
+            best = took if best is None or took < best else best
+
+        results[name] = images
+        print("%-14s %7.2fs  (%d images)" % (name, best, len(images)))
+        results[name + " time"] = best
+
+    if rounded(results["model objects"]) != rounded(results["raw JSON"]):
+        print("WARNING: The two ways gave different inventories!")
+
+    print("Speedup: %.1fx" % (results["model objects time"] / results["raw JSON time"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#
+# Registry checker reports, written as they're found
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+
+"""The reports of registry-checker.py: registry-check.jsonl (one error
+per line), registry-check.csv and the small registry-check-summary.json
+with the counts, in REPORTDIR or the report directory.
+
+The errors are written to temporary files as they are found, so
+memory use does not grow with the number of errors, and the reports
+are published by renaming them in place when the check is done.
+Readers such as app/webserver.py see the last complete report until
+the new one is complete, never half a file.  The temporary files have
+the process id in their names, so two checks at the same time each
+publish their own report.
+
+The registries are checked at the same time but the errors are
+reported in the order the registries were given, so each registry
+gets its own part file that is copied into the report when publishing.
+
+While the check is going on the report can be published with the
+errors found so far, so a broken image in prod is seen at once rather
+than when the whole check is done.  The errors of the last report
+that have not been found again yet are kept in such a partial report,
+so nothing goes away before the check is done and the summary says
+"partial": true.
+
+Usage:
+   from checkreport import Report
+
+   report = Report(dirname)
+   errors = report.part("docker.example.com")
+   errors.append({ 'tag': ..., 'wrongs': [...], ... })
+   report.publish(partial=True)
+   ...
+   report.publish()
+"""
+
+import os
+import csv
+import json
+import threading
+from datetime import datetime, timezone
+
+from reportfiles import report_path, tmp_path, load_json
+
+JSONL = "registry-check.jsonl"
+CSV = "registry-check.csv"
+SUMMARY = "registry-check-summary.json"
+
+
+def load_errors(savedir=None):
+    """Iterate over the errors in the last published report"""
+
+    with open(report_path(JSONL, savedir), "r") as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+
+
+def load_summary(savedir=None):
+    """The summary of the last published report, or None if there is
+    none"""
+
+    return load_json(report_path(SUMMARY, savedir))
+
+
+def error_key(error):
+    """What the error is about, the same error in two reports has the
+    same key"""
+
+    if 'tag' in error:
+        return error['tag']
+
+    return (error.get('kind'), error.get('registry'), error.get('name'))
+
+
+def namespace_class(namespaces):
+    """"prod", "stage" or "other", the way the nagios check sees it"""
+
+    namespaces = "=".join(namespaces)
+
+    if "prod" in namespaces:
+        return "prod"
+
+    # "stage" or "staging"
+    if "stage" in namespaces:
+        return "stage"
+
+    return "other"
+
+
+class ReportPart:
+    """The errors of one registry, written to a part file as they are
+    appended.  Has the append, extend and len of a list so the examine
+    functions don't need to know.  Put anything else for the summary in
+    notes."""
+
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+        # A run from cron and one by hand can write at the same time
+        self.path = tmp_path(f'{report.dirname}/.{JSONL}.{name}')
+        self.file = open(self.path, "w")
+        self.count = 0
+        self.notes = {}
+        self.lock = threading.Lock()
+
+
+    def append(self, error):
+        line = json.dumps(error)
+
+        with self.lock:
+            self.file.write(line + "\n")
+            self.count += 1
+
+
+    def extend(self, errors):
+        for error in errors:
+            self.append(error)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Report:
+    """A report being written in dirname, one ReportPart per registry"""
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.parts = []
+        self.failed = []
+        self.started = datetime.now(timezone.utc).isoformat()
+        self.published = 0
+        self.lock = threading.Lock()
+
+
+    def part(self, name):
+        """A new part of the report, they are published in the order
+        they were made"""
+
+        part = ReportPart(self, name)
+        self.parts.append(part)
+        return part
+
+
+    def fail(self, name):
+        """The check of name failed, say so in the summary"""
+
+        self.failed.append(name)
+
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+
+    def _tmp(self, name):
+        return tmp_path(f'{self.dirname}/{name}')
+
+
+    def _write_tmp(self, name):
+        return open(self._tmp(name), "w")
+
+
+    def _errors(self, partial):
+        """The lines of the errors to publish, from the parts and if
+        partial the last report"""
+
+        keys = set()
+
+        for part in self.parts:
+            with open(part.path, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # Still being written
+                        break
+                    if partial:
+                        keys.add(error_key(json.loads(line)))
+                    yield line
+
+        if not partial:
+            return
+
+        try:
+            with open(f'{self.dirname}/{JSONL}', "r") as f:
+                for line in f:
+                    if line.strip() != "" and error_key(json.loads(line)) not in keys:
+                        yield line
+        except FileNotFoundError:
+            pass
+
+
+    def publish(self, partial=False):
+        """Write the report files from the parts and rename them in
+        place, the summary last.  If partial the check is not done, and
+        the errors of the last report not found again yet are kept.
+        Returns the paths published."""
+
+        with self.lock:
+            for part in self.parts:
+                if partial:
+                    part.flush()
+                else:
+                    part.close()
+
+            fields = {}
+            errors = 0
+            wrongs = {}
+            classes = {}
+
+            with self._write_tmp(JSONL) as jsonl:
+                for line in self._errors(partial):
+                    error = json.loads(line)
+                    jsonl.write(line)
+
+                    # The errors of the different kinds of checks have
+                    # different fields, the CSV gets them all in the
+                    # order they were first seen
+                    for field in error:
+                        fields.setdefault(field, None)
+
+                    errors += 1
+                    found = error.get('wrongs', [])
+                    if isinstance(found, str):
+                        found = [ found ]
+                    for wrong in found:
+                        wrongs[wrong] = wrongs.get(wrong, 0) + 1
+
+                    if 'namespaces' in error:
+                        c = namespace_class(error['namespaces'])
+                        classes[c] = classes.get(c, 0) + 1
+
+            # The parts may have grown meanwhile, the CSV is made from
+            # the JSON lines just written so the two are the same
+            with self._write_tmp(CSV) as csvf:
+                if errors == 0:
+                    w = csv.DictWriter(csvf, [ 'errors' ])
+                    w.writeheader()
+                    w.writerow({ 'errors': 'none' })
+                else:
+                    w = csv.DictWriter(csvf, list(fields), restval="")
+                    w.writeheader()
+                    with open(self._tmp(JSONL), "r") as f:
+                        for line in f:
+                            w.writerow(json.loads(line))
+
+            summary = { 'started': self.started,
+                        'finished': datetime.now(timezone.utc).isoformat(),
+                        'partial': partial,
+                        'errors': errors,
+                        'registries': { part.name: len(part) for part in self.parts },
+                        'failed': self.failed,
+                        'wrongs': wrongs,
+                        'namespaces': classes }
+
+            notes = { part.name: part.notes for part in self.parts if len(part.notes) > 0 }
+            if len(notes) > 0:
+                summary['notes'] = notes
+
+            with self._write_tmp(SUMMARY) as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+
+            published = []
+            for name in (JSONL, CSV, SUMMARY):
+                path = f'{self.dirname}/{name}'
+                os.replace(self._tmp(name), path)
+                published.append(path)
+
+            self.published = len(self)
+
+            if not partial:
+                self.discard()
+
+            return published
+
+
+    def publish_new(self):
+        """Publish a partial report if errors have been found since the
+        last time.  Returns True if it did."""
+
+        if len(self) == self.published:
+            return False
+
+        self.publish(partial=True)
+        return True
+
+
+    def discard(self):
+        """Remove the part files, without publishing anything"""
+
+        for part in self.parts:
+            part.close()
+            if os.path.exists(part.path):
+                os.remove(part.path)
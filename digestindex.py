@@ -0,0 +1,163 @@
+#
+# Registry wide digest index
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+
+"""A registry wide reverse index from manifest digest to the tags
+referencing it: digest -> [(repo, tag), ...].
+
+The same manifest can be referenced by many tags, in the same
+repository (retagging) and in other repositories (blob mounts,
+promotion between repositories).  Deleting a manifest by digest in a
+repository removes all the tags in that repository that refer to it,
+so both the evictor and registry-rm.py consult the index before
+deleting anything.
+
+The index is built while scanning the registry and saved as
+digest-index-<registry>.json in REPORTDIR (or the current directory)
+so it can be reused by the next run and by the other tools.
+
+Usage:
+   from digestindex import DigestIndex
+
+   index = DigestIndex.load(reg.registry)
+   index.add("ops/certmon", "dc23f22", "sha256:...")
+   for (repo, tag) in index.get("sha256:..."):
+       ...
+   index.save()
+"""
+
+import threading
+from datetime import datetime, timezone
+
+from reportfiles import report_path, load_json, atomic_write_json
+
+
+def index_path(registry):
+    """Where the index for the given registry is saved"""
+
+    return report_path(f'digest-index-{registry}.json')
+
+
+class DigestIndex:
+    """digest -> set of (repo, tag), and the reverse per repo so a
+    rescanned repo can replace its old references.  All methods are
+    thread safe, the evictor scans and deletes in different threads."""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.digests = {}
+        self.repos = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, repo, tag, digest):
+        """Record that repo:tag refers to digest"""
+
+        if digest is None or digest == "":
+            return
+
+        with self.lock:
+            self._remove(repo, tag)
+            self.repos.setdefault(repo, {})[tag] = digest
+            self.digests.setdefault(digest, set()).add((repo, tag))
+
+
+    def replace_repo(self, repo, tag_digests):
+        """Replace everything known about a repo with a new scan of it.
+        tag_digests is a dict of tag -> digest."""
+
+        with self.lock:
+            for tag in list(self.repos.get(repo, {})):
+                self._remove(repo, tag)
+
+            for tag, digest in tag_digests.items():
+                if digest is None or digest == "":
+                    continue
+                self.repos.setdefault(repo, {})[tag] = digest
+                self.digests.setdefault(digest, set()).add((repo, tag))
+
+
+    def forget(self, repo, digest):
+        """The manifest has been deleted from the repo, and with it all
+        the tags in the repo that referred to it."""
+
+        with self.lock:
+            for (r, tag) in list(self.digests.get(digest, ())):
+                if r == repo:
+                    self._remove(repo, tag)
+
+
+    def _remove(self, repo, tag):
+        """Remove repo:tag from the index. Caller holds the lock."""
+
+        old = self.repos.get(repo, {}).pop(tag, None)
+        if old is None:
+            return
+
+        refs = self.digests.get(old)
+        if refs is not None:
+            refs.discard((repo, tag))
+            if len(refs) == 0:
+                del self.digests[old]
+
+        if len(self.repos[repo]) == 0:
+            del self.repos[repo]
+
+
+    def get(self, digest):
+        """All (repo, tag) referring to the digest, sorted"""
+
+        with self.lock:
+            return sorted(self.digests.get(digest, ()))
+
+
+    def tags(self, repo, digest):
+        """The tags in repo referring to digest"""
+
+        return [ tag for (r, tag) in self.get(digest) if r == repo ]
+
+
+    def others(self, repo, digest):
+        """The (repo, tag) in other repositories referring to digest"""
+
+        return [ (r, tag) for (r, tag) in self.get(digest) if r != repo ]
+
+
+    def digest_of(self, repo, tag):
+        """The digest repo:tag referred to when it was last scanned, or None"""
+
+        with self.lock:
+            return self.repos.get(repo, {}).get(tag)
+
+
+    def __len__(self):
+        return len(self.digests)
+
+
+    @classmethod
+    def load(cls, registry, path=None):
+        """Load the saved index for the registry.  If there is none an
+        empty index is returned."""
+
+        index = cls(registry)
+        saved = load_json(path or index_path(registry), {})
+
+        for repo, tag_digests in saved.get('repos', {}).items():
+            index.replace_repo(repo, tag_digests)
+
+        return index
+
+
+    def save(self, path=None):
+        """Save the index atomically"""
+
+        path = path or index_path(self.registry)
+
+        with self.lock:
+            saved = { 'registry': self.registry,
+                      'saved': datetime.now(timezone.utc).isoformat(),
+                      'repos': self.repos }
+
+            atomic_write_json(path, saved, sort_keys=True)
@@ -0,0 +1,309 @@
+#
+# Health results of registry images, kept between checker runs
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+
+"""The result of the last health probe of each image in a registry,
+so the checker running from cron does not probe every image in use
+every 15 minutes.
+
+A result is keyed by the image ("repo:tag" or "repo@digest") and the
+digests the inventory said it was running when it was probed, those
+of its _canonical references.  If they are not known, as when no pod
+has started it yet, the image is always probed.  A result is reused
+until it expires: Healthy results live for
+healthy_ttl seconds, failures for the shorter failed_ttl since we want
+to know quickly when they're fixed.  If the image is redeployed with
+another digest it is probed again at once.  Every full_every seconds
+the whole cache is thrown away and everything is probed again, in
+case something we thought was healthy broke.
+
+The cache is saved as health-cache-<registry>.json in REPORTDIR (or
+the current directory).
+
+With --deep the checker also checks that the blobs of each image are
+there.  The BlobCache makes sure each blob is checked only once in
+each repository.
+
+Usage:
+   from healthcache import HealthCache
+
+   cache = HealthCache.load(reg.registry)
+   entry = cache.get("ops/certmon:dc23f22", running_digest)
+   if entry is None:
+       digest = probe(...)
+       cache.put("ops/certmon:dc23f22", running_digest, digest)
+   print(cache.stats())
+   cache.save()
+"""
+
+import time
+import threading
+from datetime import datetime, timezone
+
+from reportfiles import report_path, load_json, atomic_write_json
+
+DEFAULT_HEALTHY_TTL = 4 * 3600
+DEFAULT_FAILED_TTL = 10 * 60
+DEFAULT_FULL_EVERY = 24 * 3600
+
+
+def cache_path(registry):
+    """Where the cache for the given registry is saved"""
+
+    return report_path(f'health-cache-{registry}.json')
+
+
+class HealthCache:
+    """image -> { 'running': digest, 'digest': probed digest or "",
+    'checked': time }, and with --deep 'missing': [ missing blobs ].
+    Counts hits and the reasons for misses.  Not thread safe, use it
+    from the thread going through the results."""
+
+    def __init__(self, registry, healthy_ttl=DEFAULT_HEALTHY_TTL,
+                 failed_ttl=DEFAULT_FAILED_TTL, full_every=DEFAULT_FULL_EVERY):
+        self.registry = registry
+        self.healthy_ttl = healthy_ttl
+        self.failed_ttl = failed_ttl
+        self.full_every = full_every
+        self.entries = {}
+        self.full_check = 0
+        self.counts = { 'hit': 0, 'new': 0, 'changed': 0, 'expired': 0, 'unknown': 0 }
+        self.removed = 0
+
+
+    def full_due(self, now=None):
+        """True if it's time to probe everything again"""
+
+        return (now or time.time()) - self.full_check >= self.full_every
+
+
+    def start_full(self, now=None):
+        """Forget all the results, everything will be probed again"""
+
+        self.entries = {}
+        self.full_check = now or time.time()
+
+
+    def get(self, image, running, now=None, deep=False):
+        """The cached probe result of the image, a dict with the digest
+        ("" if the probe failed) and if deep the missing blobs.  None if
+        it must be probed again, always if running is None."""
+
+        if running is None:
+            self.counts['unknown'] += 1
+            return None
+
+        entry = self.entries.get(image)
+
+        if entry is None:
+            self.counts['new'] += 1
+            return None
+
+        # A result without the blobs does not do for a deep check
+        if entry['running'] != running or (deep and 'missing' not in entry):
+            self.counts['changed'] += 1
+            return None
+
+        healthy = entry['digest'] != '' and not entry.get('missing')
+        ttl = self.healthy_ttl if healthy else self.failed_ttl
+        if (now or time.time()) - entry['checked'] >= ttl:
+            self.counts['expired'] += 1
+            return None
+
+        self.counts['hit'] += 1
+        return entry
+
+
+    def put(self, image, running, digest, missing=None, now=None):
+        """Record the result of probing the image, missing is the list
+        of missing blobs if they were checked.  Without knowing what
+        is running there is nothing to tell a redeploy by, so nothing is
+        kept."""
+
+        if running is None:
+            self.entries.pop(image, None)
+            return
+
+        entry = { 'running': running, 'digest': digest, 'checked': now or time.time() }
+        if missing is not None:
+            entry['missing'] = missing
+
+        self.entries[image] = entry
+
+
+    def forget_others(self, images):
+        """Forget the images that are not in images, they are no longer
+        in use.  Returns the number forgotten."""
+
+        images = set(images)
+        gone = [ image for image in self.entries if image not in images ]
+        for image in gone:
+            del self.entries[image]
+
+        self.removed += len(gone)
+        return len(gone)
+
+
+    def stats(self):
+        """The hit rate and why the rest were probed, for the log"""
+
+        total = sum(self.counts.values())
+        rate = 100.0 * self.counts['hit'] / total if total else 0.0
+
+        return "health cache: %d of %d hits (%.0f%%), %d new, %d changed, %d expired, %d not known to run, %d removed" % \
+            (self.counts['hit'], total, rate, self.counts['new'],
+             self.counts['changed'], self.counts['expired'], self.counts['unknown'], self.removed)
+
+
+    @classmethod
+    def load(cls, registry, path=None, **ttls):
+        """Load the saved cache for the registry.  If there is none an
+        empty cache is returned, and a full check is due."""
+
+        cache = cls(registry, **ttls)
+        saved = load_json(path or cache_path(registry), {})
+
+        cache.entries = saved.get('images', {})
+        cache.full_check = saved.get('full_check', 0)
+
+        return cache
+
+
+    def save(self, path=None):
+        """Save the cache atomically"""
+
+        path = path or cache_path(self.registry)
+
+        saved = { 'registry': self.registry,
+                  'saved': datetime.now(timezone.utc).isoformat(),
+                  'full_check': self.full_check,
+                  'images': self.entries }
+
+        atomic_write_json(path, saved, sort_keys=True)
+
+
+def blob_cache_path(registry):
+    """Where the blob cache for the given registry is saved"""
+
+    return report_path(f'blob-cache-{registry}.json')
+
+
+class BlobCache:
+    """Which blobs (layers and configs) have been found in which
+    repositories, so a base layer shared by hundreds of images is only
+    checked once per repository.  The blob data is stored once in the
+    registry, but each repository has its own link to it, and the
+    registry answers for the link.  A link can go missing in one
+    repository and not the others, so what is found in one repository
+    says nothing about another.
+
+    The blobs found can be kept between runs for ttl seconds, with
+    ttl 0 (the default) nothing is saved.  Thread safe, the checker
+    checks blobs from all its workers.  If two workers want the same
+    blob in the same repository at the same time one of them checks it
+    and the other waits.
+    """
+
+    def __init__(self, registry, ttl=0):
+        self.registry = registry
+        self.ttl = ttl
+        self.present = {}
+        self.missing = {}
+        self.checking = {}
+        self.lock = threading.Lock()
+        self.counts = { 'hit': 0, 'checked': 0, 'missing': 0 }
+
+
+    def status(self, repo, digest, head):
+        """The status of the blob in the repo, 200 if it's there.  If it
+        is not known head(repo, digest) is called to check it."""
+
+        while True:
+            with self.lock:
+                if (repo, digest) in self.present:
+                    self.counts['hit'] += 1
+                    return 200
+
+                if (repo, digest) in self.missing:
+                    self.counts['hit'] += 1
+                    return self.missing[(repo, digest)]
+
+                waiting = self.checking.get((repo, digest))
+                if waiting is None:
+                    self.checking[(repo, digest)] = threading.Event()
+                    break
+
+            # Someone else is checking it, see what they found
+            waiting.wait()
+
+        try:
+            status = head(repo, digest)
+        except BaseException:
+            with self.lock:
+                self.checking.pop((repo, digest)).set()
+            raise
+
+        with self.lock:
+            self.counts['checked'] += 1
+            if status < 400:
+                self.present[(repo, digest)] = time.time()
+                status = 200
+            else:
+                self.counts['missing'] += 1
+                self.missing[(repo, digest)] = status
+
+            self.checking.pop((repo, digest)).set()
+
+        return status
+
+
+    def stats(self):
+        """The hit rate and the number of blobs checked, for the log"""
+
+        with self.lock:
+            total = self.counts['hit'] + self.counts['checked']
+            rate = 100.0 * self.counts['hit'] / total if total else 0.0
+
+            return "blob cache: %d of %d hits (%.0f%%), %d checked, %d missing" % \
+                (self.counts['hit'], total, rate, self.counts['checked'], self.counts['missing'])
+
+
+    @classmethod
+    def load(cls, registry, ttl=0, path=None):
+        """Load the blobs found in the last ttl seconds"""
+
+        cache = cls(registry, ttl)
+        if ttl <= 0:
+            return cache
+
+        saved = load_json(path or blob_cache_path(registry), {})
+
+        # Saved as "repo@digest", the blobs saved by digest only are
+        # from before it was per repository and not used
+        oldest = time.time() - ttl
+        cache.present = { tuple(blob.split("@", 1)): found
+                          for blob, found in saved.get('blobs', {}).items()
+                          if "@" in blob and found >= oldest }
+
+        return cache
+
+
+    def save(self, path=None):
+        """Save the blobs found atomically, if they are kept at all"""
+
+        if self.ttl <= 0:
+            return
+
+        path = path or blob_cache_path(self.registry)
+
+        oldest = time.time() - self.ttl
+        with self.lock:
+            saved = { 'registry': self.registry,
+                      'saved': datetime.now(timezone.utc).isoformat(),
+                      'blobs': { f'{repo}@{digest}': found
+                                 for (repo, digest), found in self.present.items()
+                                 if found >= oldest } }
+
+        atomic_write_json(path, saved, sort_keys=True)
@@ -0,0 +1,665 @@
+#
+# Image inventory, as written by k8s-inventory.py
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+
+"""Shared code for saving, loading and indexing the inventory written
+by k8s-inventory.py.
+
+The inventory is keyed by image reference, e.g.
+docker.example.com/ops/certmon:dc23f22.  Each reference is parsed only
+once, into a index keyed by registry host so tools working on several
+registries don't have to filter the whole inventory per registry.
+
+The inventory is saved in two formats:
+
+- images.json: For humans and image-list.sh.  Every pod key and phase
+  dict is spelled out for every image, so it is large and slow to load.
+- images.db: A SQLite database with each image, pod key and node name
+  stored once and the phases as bit flags (see PHASES).  Tools that
+  only need the image references, or one image, don't have to read
+  the pods of all the images.
+
+load_images() reads whichever of them is newer and gives the same
+dictionary for both.  load_records() gives ImageRecords instead, with
+the phases as bit flags, which is smaller and quicker to query.
+
+When k8s-inventory.py runs in each cluster it saves a shard instead,
+images-shard-<id>.json, with a "_shard" key saying which cluster it is
+and when it was collected.  k8s-inventory-merge.py merges the shards
+into images.json/images.db.
+
+Usage:
+   import inventory
+
+   images = inventory.load_images()
+   by_host = inventory.index_by_registry(images)
+   used = by_host.get("docker.example.com", inventory.HostIndex())
+   if "ops/certmon:dc23f22" in used.repo_tags:
+       ...
+"""
+
+import os
+import json
+import sqlite3
+
+from reportfiles import report_path, tmp_path, remove_tmp, atomic_write_json
+
+
+# The phases of a pod as saved by k8s-inventory.py, and their bit in
+# the phase flags of images.db.  ImagePullBackOff is not a kubernetes
+# phase but is interesting for the registry-checker.
+PHASES = ('Running', 'Pending', 'Succeeded', 'Failed', 'Unknown', 'ImagePullBackOff')
+
+_phase_bit = { phase: 1 << bit for bit, phase in enumerate(PHASES) }
+
+RUNNING = _phase_bit['Running']
+PENDING = _phase_bit['Pending']
+SUCCEEDED = _phase_bit['Succeeded']
+FAILED = _phase_bit['Failed']
+UNKNOWN = _phase_bit['Unknown']
+IMAGE_PULL_BACKOFF = _phase_bit['ImagePullBackOff']
+
+# Running, or trying to
+ACTIVE = RUNNING | PENDING | IMAGE_PULL_BACKOFF
+
+# All the possible phase dicts, copying one is faster than making it
+_phase_dicts = [ { phase: bool(flags & bit) for phase, bit in _phase_bit.items() }
+                 for flags in range(1 << len(PHASES)) ]
+
+
+def phase_flags(phases):
+    """A phase dict like { 'Running': True, ... } as bit flags"""
+
+    flags = 0
+    for phase, on in phases.items():
+        if on and phase in _phase_bit:
+            flags |= _phase_bit[phase]
+
+    return flags
+
+
+def phase_dict(flags):
+    """Phase bit flags as a phase dict with all the phases"""
+
+    return _phase_dicts[flags].copy()
+
+
+def phase_names(flags):
+    """The names of the phases set in the flags, sorted"""
+
+    return sorted(phase for phase, bit in _phase_bit.items() if flags & bit)
+
+
+def images_path(savedir=None):
+    """Where images.json is, REPORTDIR or the current directory"""
+
+    return report_path('images.json', savedir)
+
+
+def db_path(savedir=None):
+    """Where images.db is, REPORTDIR or the current directory"""
+
+    return report_path('images.db', savedir)
+
+
+def shard_path(shard_id, savedir=None):
+    """Where the inventory shard of the given cluster is saved"""
+
+    return report_path(f'images-shard-{shard_id}.json', savedir)
+
+
+def newest_path(savedir=None):
+    """images.db or images.json, whichever was saved last.  If neither
+    exist the images.json path is returned so the error message when
+    opening it makes sense."""
+
+    newest = None
+    newest_mtime = None
+
+    for path in (db_path(savedir), images_path(savedir)):
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+
+        if newest is None or mtime > newest_mtime:
+            newest = path
+            newest_mtime = mtime
+
+    return newest or images_path(savedir)
+
+
+def load_images(path=None, pods=True):
+    """Load the inventory as written by k8s-inventory.py.  Without a
+    path the newest of images.db and images.json in REPORTDIR is
+    used.
+
+    With pods=False the per pod information is left out of images.db,
+    only the image summaries (_phase, _last_wanted, _cronjob, _digest,
+    _canonical)
+    are loaded.  That is a lot less to read for tools that only want to
+    know what images are in use.
+    """
+
+    path = path or newest_path()
+
+    if path.endswith('.db'):
+        return _load_db(path, pods)
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_image(image, path=None):
+    """The inventory entry of one image, or None if the image is not in
+    the inventory.  From images.db this is a single lookup."""
+
+    path = path or newest_path()
+
+    if not path.endswith('.db'):
+        return load_images(path).get(image)
+
+    db = _open_db(path)
+    try:
+        row = db.execute("SELECT id, phase, last_wanted, cronjob, digest, canonical"
+                         " FROM image WHERE ref = ?", (image,)).fetchone()
+        if row is None:
+            return None
+
+        return _image_entry(db, row, pods=True)
+    finally:
+        db.close()
+
+
+def _open_db(path):
+    """Open images.db read only, opening a missing file must not make
+    a empty database"""
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No such file: '{path}'")
+
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def _image_entry(db, row, pods):
+    """Make the images.json entry of the image in row"""
+
+    (image_id, phase, last_wanted, cronjob, digest, canonical) = row
+
+    entry = { '_phase': phase_dict(phase) }
+    if last_wanted is not None: entry['_last_wanted'] = last_wanted
+    if cronjob: entry['_cronjob'] = True
+    if digest is not None: entry['_digest'] = digest
+    if canonical is not None: entry['_canonical'] = canonical.split(" ")
+
+    if pods:
+        for (key, phase, last_wanted, node) in db.execute(
+                "SELECT pod.key, image_pod.phase, image_pod.last_wanted, node.name"
+                " FROM image_pod JOIN pod ON pod.id = image_pod.pod"
+                " LEFT JOIN node ON node.id = image_pod.node"
+                " WHERE image_pod.image = ?", (image_id,)):
+            entry[key] = _pod_entry(phase, last_wanted, node)
+
+    return entry
+
+
+def _pod_entry(phase, last_wanted, node):
+    pod = phase_dict(phase)
+    if last_wanted is not None: pod['_last_wanted'] = last_wanted
+    if node is not None: pod['_node'] = node
+
+    return pod
+
+
+def _load_db(path, pods):
+    """Load images.db into the same dictionary as images.json gives"""
+
+    db = _open_db(path)
+
+    try:
+        images = {}
+        by_id = {}
+
+        for (key, value) in db.execute("SELECT key, value FROM meta"):
+            images[key] = json.loads(value)
+
+        for (image_id, ref, *row) in db.execute(
+                "SELECT id, ref, phase, last_wanted, cronjob, digest, canonical FROM image"):
+            images[ref] = by_id[image_id] = _image_entry(db, (image_id, *row), pods=False)
+
+        if pods:
+            pod_keys = dict(db.execute("SELECT id, key FROM pod"))
+            nodes = dict(db.execute("SELECT id, name FROM node"))
+
+            for (image_id, pod_id, phase, last_wanted, node_id) in db.execute(
+                    "SELECT image, pod, phase, last_wanted, node FROM image_pod"):
+                by_id[image_id][pod_keys[pod_id]] = \
+                    _pod_entry(phase, last_wanted, nodes.get(node_id))
+
+        return images
+    finally:
+        db.close()
+
+
+_schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE image (id INTEGER PRIMARY KEY, ref TEXT NOT NULL UNIQUE,
+                    phase INTEGER NOT NULL, last_wanted REAL,
+                    cronjob INTEGER NOT NULL, digest TEXT, canonical TEXT);
+CREATE TABLE pod (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE);
+CREATE TABLE node (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE image_pod (image INTEGER NOT NULL, pod INTEGER NOT NULL,
+                        phase INTEGER NOT NULL, last_wanted REAL, node INTEGER);
+CREATE INDEX image_pod_image ON image_pod (image);
+"""
+
+
+def save_db(images, path):
+    """Save the inventory as images.db, atomically: It is written to a
+    new file that is renamed over the old one."""
+
+    tmp = tmp_path(path)
+    remove_tmp(tmp)
+
+    db = sqlite3.connect(tmp)
+
+    try:
+        db.executescript(_schema)
+
+        # Interned pod keys and node names
+        pod_ids = {}
+        node_ids = {}
+
+        def intern(table, column, ids, value):
+            if value is None:
+                return None
+            if value not in ids:
+                ids[value] = db.execute(f"INSERT INTO {table} ({column}) VALUES (?)",
+                                        (value,)).lastrowid
+            return ids[value]
+
+        for image, entry in images.items():
+            if image.startswith("_"):
+                db.execute("INSERT INTO meta (key, value) VALUES (?, ?)",
+                           (image, json.dumps(entry)))
+                continue
+
+            canonical = entry.get('_canonical')
+
+            image_id = db.execute(
+                "INSERT INTO image (ref, phase, last_wanted, cronjob, digest, canonical)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (image, phase_flags(entry.get('_phase', {})), entry.get('_last_wanted'),
+                 int(bool(entry.get('_cronjob'))), entry.get('_digest'),
+                 " ".join(canonical) if canonical else None)).lastrowid
+
+            db.executemany(
+                "INSERT INTO image_pod (image, pod, phase, last_wanted, node)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [ (image_id, intern('pod', 'key', pod_ids, key), phase_flags(pod),
+                   pod.get('_last_wanted'), intern('node', 'name', node_ids, pod.get('_node')))
+                  for key, pod in entry.items() if not key.startswith("_") ])
+
+        db.commit()
+        db.close()
+        os.replace(tmp, path)
+    except BaseException:
+        db.close()
+        remove_tmp(tmp)
+        raise
+
+
+def save_json(images, path):
+    """Save the inventory as images.json, atomically"""
+
+    atomic_write_json(path, images, indent=2, sort_keys=True)
+
+
+def save_images(images, savedir=None, formats=('db', 'json')):
+    """Save the inventory in the given formats in savedir, REPORTDIR or
+    the current directory by default.  images.db is saved last so
+    load_images() picks it unless a newer images.json has been saved
+    without it.  Returns the paths saved to."""
+
+    paths = []
+
+    if 'json' in formats:
+        paths.append(images_path(savedir))
+        save_json(images, paths[-1])
+
+    if 'db' in formats:
+        paths.append(db_path(savedir))
+        save_db(images, paths[-1])
+
+    return paths
+
+
+class PodRecord:
+    """One pod running a image, as in the pod keys of a images.json
+    entry, with the phases as bit flags"""
+
+    __slots__ = ('key', 'phases', 'last_wanted', 'node')
+
+    def __init__(self, key, phases, last_wanted=None, node=None):
+        self.key = key
+        self.phases = phases
+        self.last_wanted = last_wanted
+        self.node = node
+
+
+    def namespace(self):
+        """"context;namespace" of the pod, the key is k8s;context;namespace;pod"""
+
+        return ";".join(self.key.split(";")[1:3])
+
+
+class ImageRecord:
+    """The inventory entry of one image with the phases as bit flags.
+    It takes a lot less memory than the dicts of images.json and the
+    questions the checker and the web server ask are bit operations
+    instead of looping over dicts.
+
+    - phases: The image summary phases (_phase)
+    - pods: List of PodRecord, empty if loaded without pods
+    """
+
+    __slots__ = ('ref', 'phases', 'last_wanted', 'cronjob', 'digest', 'canonical', 'pods')
+
+    def __init__(self, ref, phases, last_wanted=None, cronjob=False, digest=None, canonical=None):
+        self.ref = ref
+        self.phases = phases
+        self.last_wanted = last_wanted
+        self.cronjob = cronjob
+        self.digest = digest
+        self.canonical = canonical or []
+        self.pods = []
+
+
+    @classmethod
+    def from_entry(cls, ref, entry):
+        """Make a record from a images.json entry"""
+
+        record = cls(ref, phase_flags(entry.get('_phase', {})), entry.get('_last_wanted'),
+                     entry.get('_cronjob', False), entry.get('_digest'),
+                     entry.get('_canonical'))
+
+        record.pods = [ PodRecord(key, phase_flags(pod), pod.get('_last_wanted'), pod.get('_node'))
+                        for key, pod in entry.items() if not key.startswith("_") ]
+
+        return record
+
+
+    def any(self, mask):
+        """Is any of the phases in mask set for the image?"""
+
+        return self.phases & mask != 0
+
+
+    def pod_phases(self):
+        """All the phases set in any of the pods"""
+
+        flags = 0
+        for pod in self.pods:
+            flags |= pod.phases
+
+        return flags
+
+
+    def pods_in(self, mask):
+        """The pods with any of the phases in mask"""
+
+        return [ pod for pod in self.pods if pod.phases & mask ]
+
+
+    def namespaces(self, mask=ACTIVE):
+        """The "context;namespace" of the pods with any of the phases in
+        mask, sorted and unique"""
+
+        return sorted({ pod.namespace() for pod in self.pods if pod.phases & mask })
+
+
+def load_records(path=None, pods=True):
+    """Load the inventory as ImageRecords, see load_images.  Returns a
+    dict of image -> ImageRecord, the _ keys (like _partial) are kept
+    as they are."""
+
+    path = path or newest_path()
+
+    if not path.endswith('.db'):
+        return { image: entry if image.startswith("_") else ImageRecord.from_entry(image, entry)
+                 for image, entry in load_images(path).items() }
+
+    db = _open_db(path)
+
+    try:
+        records = {}
+        by_id = {}
+
+        for (key, value) in db.execute("SELECT key, value FROM meta"):
+            records[key] = json.loads(value)
+
+        for (image_id, ref, phase, last_wanted, cronjob, digest, canonical) in db.execute(
+                "SELECT id, ref, phase, last_wanted, cronjob, digest, canonical FROM image"):
+            records[ref] = by_id[image_id] = \
+                ImageRecord(ref, phase, last_wanted, bool(cronjob), digest,
+                            canonical.split(" ") if canonical else None)
+
+        if pods:
+            pod_keys = dict(db.execute("SELECT id, key FROM pod"))
+            nodes = dict(db.execute("SELECT id, name FROM node"))
+
+            for (image_id, pod_id, phase, last_wanted, node_id) in db.execute(
+                    "SELECT image, pod, phase, last_wanted, node FROM image_pod"):
+                by_id[image_id].pods.append(
+                    PodRecord(pod_keys[pod_id], phase, last_wanted, nodes.get(node_id)))
+
+        return records
+    finally:
+        db.close()
+
+
+def load_record(image, path=None):
+    """The ImageRecord of one image, or None, see load_image"""
+
+    entry = load_image(image, path)
+    if entry is None:
+        return None
+
+    return ImageRecord.from_entry(image, entry)
+
+
+
+def parse_image(image):
+    """Split a image reference into (host, repo, tag, digest).  tag
+    and digest are None if not present.  If the reference does not
+    start with a registry host None is returned, those images come
+    from docker hub.
+
+    docker.example.com/ops/certmon:dc23f22@sha256:abcd... gives
+    ("docker.example.com", "ops/certmon", "dc23f22", "sha256:abcd...")
+    """
+
+    if "/" not in image:
+        return None
+
+    (host, rest) = image.split("/", 1)
+
+    # Same rule as docker uses to tell a registry host from a docker
+    # hub user name
+    if "." not in host and ":" not in host and host != "localhost":
+        return None
+
+    digest = None
+    if "@" in rest:
+        (rest, digest) = rest.split("@", 1)
+
+    tag = None
+    # A : after the last / is a tag
+    if ":" in rest.rsplit("/", 1)[-1]:
+        (rest, tag) = rest.rsplit(":", 1)
+
+    if rest == "" or rest.startswith("/"):
+        return None
+
+    return (host, rest, tag, digest)
+
+
+class HostIndex:
+    """The inventory images of one registry host.
+
+    - repos: Set of repositories in use
+    - repo_tags: Set of "repo:tag" in use
+    - repo_digests: Set of "repo@digest" in use, from digest pinned
+      references and the canonical references of what is running
+    - images: The inventory keys (full references) of this registry
+    """
+
+    __slots__ = ('repos', 'repo_tags', 'repo_digests', 'images')
+
+    def __init__(self):
+        self.repos = set()
+        self.repo_tags = set()
+        self.repo_digests = set()
+        self.images = []
+
+
+    def in_use(self, repo, tag=None, digest=None):
+        """Is repo:tag, or the manifest repo@digest, in use?"""
+
+        return (tag is not None and f'{repo}:{tag}' in self.repo_tags) or \
+            (digest is not None and f'{repo}@{digest}' in self.repo_digests)
+
+
+def index_by_registry(images):
+    """Parse all the image references in the inventory once and index
+    them by registry host.  images is as given by load_images or
+    load_records.  Returns a dict of host -> HostIndex."""
+
+    by_host = {}
+
+    def host_index(host):
+        hi = by_host.get(host)
+        if hi is None:
+            hi = by_host[host] = HostIndex()
+        return hi
+
+    for image, entry in images.items():
+        parsed = parse_image(image)
+        if parsed is None:
+            continue
+
+        (host, repo, tag, digest) = parsed
+
+        hi = host_index(host)
+
+        hi.repos.add(repo)
+        hi.images.append(image)
+        if tag is not None:
+            hi.repo_tags.add(f'{repo}:{tag}')
+
+        if isinstance(entry, ImageRecord):
+            (entry_digest, canonicals) = (entry.digest, entry.canonical)
+        else:
+            (entry_digest, canonicals) = (entry.get('_digest'), entry.get('_canonical', ()))
+
+        if digest is None:
+            digest = entry_digest
+        if digest is not None:
+            hi.repo_digests.add(f'{repo}@{digest}')
+
+        # The canonical reference can be on a other host, e.g. when
+        # pulled through a mirror
+        for canonical in canonicals:
+            parsed = parse_image(canonical)
+            if parsed is None or parsed[3] is None:
+                continue
+
+            (host, repo, _, digest) = parsed
+            host_index(host).repo_digests.add(f'{repo}@{digest}')
+
+    return by_host
+
+
+def count_images(images):
+    """The number of images in the inventory, without the _ keys"""
+
+    return sum(1 for image in images if not image.startswith("_"))
+
+
+def node_coverage(images, image):
+    """On how many nodes is the image cached, by any of its names?
+    From the _node_cache key of the inventory."""
+
+    cache = images.get('_node_cache')
+    if not cache:
+        return 0
+
+    entry = images.get(image)
+    if isinstance(entry, ImageRecord):
+        names = [ image ] + entry.canonical
+    elif entry is not None:
+        names = [ image ] + entry.get('_canonical', [])
+    else:
+        names = [ image ]
+
+    return max(cache.get(name, 0) for name in names)
+
+
+def merge_images(images, other):
+    """Merge the inventory other into images.  The pod keys include the
+    context so they don't collide, the image summaries are combined:
+
+    - _phase: A phase is set if it is set in either
+    - _last_wanted: The most recent (smallest) of the two
+    - _cronjob: Set if set in either
+    - _canonical: All the references from both
+    - _digest: The one already in images is kept
+
+    The node image cache counts (_node_cache, _nodes) are added up.
+
+    Merging is done in the order it's called, so merging the same
+    inventories in the same order gives the same result.
+    """
+
+    for image, entry in other.items():
+        if image == '_node_cache':
+            cache = images.setdefault('_node_cache', {})
+            for name, nodes in entry.items():
+                cache[name] = cache.get(name, 0) + nodes
+            continue
+
+        if image == '_nodes':
+            images['_nodes'] = images.get('_nodes', 0) + entry
+            continue
+
+        if image.startswith("_"):
+            continue
+
+        if image not in images:
+            images[image] = entry
+            continue
+
+        mine = images[image]
+
+        for key, value in entry.items():
+            if key == '_phase':
+                phase = mine.setdefault('_phase', {})
+                for p, on in value.items():
+                    phase[p] = phase.get(p, False) or on
+
+            elif key == '_last_wanted':
+                if '_last_wanted' not in mine or mine['_last_wanted'] > value:
+                    mine['_last_wanted'] = value
+
+            elif key == '_cronjob':
+                mine['_cronjob'] = mine.get('_cronjob', False) or value
+
+            elif key == '_canonical':
+                mine['_canonical'] = sorted(set(mine.get('_canonical', [])) | set(value))
+
+            elif key not in mine:
+                mine[key] = value
+
+    return images
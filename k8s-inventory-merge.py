@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+# Merge the inventory shards saved by "k8s-inventory.py -s ID" in each
+# cluster into one images.json/images.db.
+#
+# Usage:
+# - k8s-inventory-merge.py
+#   merges all the images-shard-*.json in REPORTDIR (or the CWD)
+# - k8s-inventory-merge.py -e prod-1 -e prod-2 shards/*.json
+#   merges the given shards and reports prod-1 or prod-2 as missing
+#   if there is no shard for them
+#
+# The shards are read and merged one at a time, so only the merged
+# inventory and one shard is in memory.
+#
+
+import sys
+import glob
+import argparse
+import inventory
+import usedhistory
+from datetime import datetime, timezone
+
+
+def age_images(images, days):
+    """The _last_wanted ages in a shard are from when it was
+    collected, make them days older"""
+
+    if days <= 0:
+        return
+
+    for image, entry in images.items():
+        if image.startswith("_"):
+            continue
+
+        for key, value in entry.items():
+            if key == '_last_wanted':
+                entry[key] = value + days
+            elif not key.startswith("_") and '_last_wanted' in value:
+                value['_last_wanted'] += days
+
+
+def load_shard(path):
+    """Load one shard, returns (id, collected time, images) or exits
+    if it's not a shard"""
+
+    images = inventory.load_images(path)
+
+    shard = images.pop('_shard', None)
+    if shard is None:
+        sys.exit("%s is not a inventory shard, no _shard key" % path)
+
+    collected = datetime.fromisoformat(shard['collected'])
+
+    return (shard['id'], collected, images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge inventory shards from k8s-inventory.py -s into one inventory')
+    parser.add_argument('-m', '--max-age', action='store', type=float, default=2, \
+                        help='Shards older than this many hours are stale, default 2')
+    parser.add_argument('-e', '--expect', action='append', default=[], \
+                        help='Expect a shard with this id, it is reported as missing if not found (can be repeated)')
+    parser.add_argument('-f', '--format', action='append', choices=['db', 'json'], \
+                        help='Save images.db and/or images.json (can be repeated), default both')
+    parser.add_argument('-H', '--history-days', action='store', type=int, default=90, \
+                        help='Remember the images in use for this many days in used-history/, 0 to not, default 90')
+    parser.add_argument('shard', nargs='*', help='Shard files, default all images-shard-*.json in REPORTDIR')
+    args = parser.parse_args()
+
+    # Sorted, so the same shards give the same result
+    paths = sorted(args.shard or glob.glob(inventory.shard_path('*')))
+
+    if len(paths) == 0:
+        sys.exit("No shards found")
+
+    now = datetime.now(timezone.utc)
+
+    images = {}
+    failed = {}
+    merged = set()
+
+    for path in paths:
+        (shard_id, collected, shard) = load_shard(path)
+
+        # Pod keys from two shards of the same cluster would be mixed
+        if shard_id in merged:
+            sys.exit("%s: There is already a shard for %s" % (path, shard_id))
+        merged.add(shard_id)
+
+        age = (now - collected).total_seconds()
+        print("Merging %s from %s, collected %.1f minutes ago" % (shard_id, path, age / 60))
+
+        if age > args.max_age * 60 * 60:
+            # The images are merged anyway, but the consumers must know
+            # that they may be missing the newest images of the cluster
+            print("STALE shard: %s" % shard_id)
+            failed[shard_id] = "stale, collected %s" % collected.strftime('%Y-%m-%d %H:%M:%S')
+
+        for context, reason in shard.pop('_partial', {}).items():
+            failed[context] = reason
+
+        age_images(shard, age / 60 / 60 / 24)
+        inventory.merge_images(images, shard)
+        shard = None
+
+    for shard_id in args.expect:
+        if shard_id not in merged:
+            print("MISSING shard: %s" % shard_id)
+            failed[shard_id] = "no shard"
+
+    print("= Images: %d from %d shards" % (inventory.count_images(images), len(merged)))
+
+    if len(failed) > 0:
+        print("PARTIAL inventory, missing or stale: %s" % ", ".join(failed.keys()))
+        images['_partial'] = failed
+
+    for path in inventory.save_images(images, formats=tuple(args.format or ('db', 'json'))):
+        print("Saved images to %s" % path)
+
+    if args.history_days > 0:
+        new = usedhistory.record_inventory(images, args.history_days)
+        print("Added %d new images to the history of images in use" % new)
+
+    if len(failed) > 0:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,8 @@
 #
 # Script to collect images inventory from our kubernetes clusters.
 # The script will use all the the configured contexts to collect lists
-# of docker images in use and save the list to images.json in the CWD.
+# of docker images in use and save the list to images.json and
+# images.db in the CWD (or REPORTDIR).
 #
 # Copyright (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
 #
@@ -13,6 +14,15 @@
 #
 # Usage:
 # - k8s-inventory.py
+# - k8s-inventory.py -w   to keep running and keep images.json current
+# - k8s-inventory.py -s ID   in each cluster, and then
+#   k8s-inventory-merge.py  to merge the shards into images.json
+#
+# All the contexts are collected at the same time, each with its own
+# API client.  A context that fails or times out (-t) is reported and
+# listed in the "_partial" key of images.json, the other contexts are
+# saved anyway.  registry-evictor.py refuses to work on a partial
+# inventory.
 #
 # Bugs:
 # - Could use a common configuration file with the registryevictor.py
@@ -20,32 +30,274 @@
 #   not work.  You have to devise a way to change AWS_PROFILE(?) before
 #   interogating the clusters in AWS accounts.
 
-import os
-import re
 import sys
 import json
-import pprint
 import argparse
+import threading
+import time
+import inventory
+import usedhistory
 from kubernetes import client, config
 from datetime import datetime, timezone
-from kubernetes.client import configuration
 from kubernetes.client.rest import ApiException
+from kubernetes.watch.watch import iter_resp_lines
 from kubernetes.config.config_exception import ConfigException
 
 no_phase = { 'Running': False, 'Pending': False, 'Succeeded': False, \
              'Failed':  False, 'Unknown': False, 'ImagePullBackOff': False }
 
-def load_from_kubernetes(k8s, context=None):
+output_lock = threading.Lock()
+
+# Default number of items per list request, see -l
+page_size = 500
+
+# Ignore containers that ran longer ago than this many days, see -a
+max_age = 31
+
+# Make kubernetes client model objects of the pods, see -M
+use_models = False
+
+# The formats to save the inventory in, see -f
+save_formats = ('db', 'json')
+
+# Save a shard with this id instead, see -s
+shard_id = None
+
+# Days of images in use to remember in used-history/, see -H
+history_days = 90
+
+# The history is recorded at most this often, in seconds.  With
+# -w the inventory is saved every few seconds, the images seen are
+# gathered in history_pending and recorded once an hour.
+history_every = 0
+history_pending = set()
+history_recorded = None
+
+
+def log(context, msg):
+    """Print a line prefixed by the context, one write per line so the
+    contexts collected at the same time don't mix up their lines"""
+
+    with output_lock:
+        sys.stdout.write("[%s] %s\n" % (context, msg))
+        sys.stdout.flush()
+
+
+def list_paged(list_fn, context, page_size, timeout, raw=False, info=None, **kwargs):
+    """Page through a kubernetes list call with limit/continue and
+    yield the items one page at a time, so only one page is held in
+    memory and no single call has to return the whole cluster.
+
+    With raw=True the response is not made into model objects, the
+    items are yielded as the dicts parsed from the JSON.
+
+    If info is a dict the resourceVersion of the list is saved in it
+    as 'resourceVersion', a watch can start from there.
+
+    If the continue token expires (410 Gone) the listing is started
+    over.  The callers add the items to the images dictionary in a way
+    that gives the same result if a item is seen twice.
+    """
+
+    restarts = 0
+    _continue = None
+
+    while True:
+        try:
+            if raw:
+                response = list_fn(limit=page_size, _continue=_continue,
+                                   _request_timeout=timeout, _preload_content=False,
+                                   **kwargs)
+                page = json.loads(response.data)
+                response = None
+            else:
+                page = list_fn(limit=page_size, _continue=_continue,
+                               _request_timeout=timeout, **kwargs)
+        except ApiException as e:
+            if e.status != 410 or _continue is None or restarts >= 3:
+                raise
+            restarts += 1
+            log(context, "List expired while paging, starting over")
+            _continue = None
+            continue
+
+        # Don't hold on to this page while getting the next one
+        if raw:
+            items = page.get('items') or []
+            metadata = page.get('metadata') or {}
+            _continue = metadata.get('continue')
+            resource_version = metadata.get('resourceVersion')
+        else:
+            items = page.items
+            _continue = page.metadata._continue
+            resource_version = page.metadata.resource_version
+
+        if info is not None:
+            info['resourceVersion'] = resource_version
+
+        page = None
+
+        yield from items
+
+        if not _continue:
+            return
+
+
+def parse_time(timestamp):
+    """Parse a kubernetes timestamp as found in the raw JSON"""
+
+    if timestamp is None:
+        return None
+
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+
+class Container:
+    """The status fields of a container that we use"""
+
+    __slots__ = ('image', 'image_id', 'running', 'waiting_reason', 'started_at')
+
+    def __init__(self, image, image_id, running, waiting_reason, started_at):
+        self.image = image
+        self.image_id = image_id
+        self.running = running
+        self.waiting_reason = waiting_reason
+        self.started_at = started_at
+
+
+    def __eq__(self, other):
+        return isinstance(other, Container) and \
+            all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+
+class Pod:
+    """The dozen or so fields of a pod that we use.  Made either from
+    the kubernetes client model objects or straight from the JSON of
+    the API response, which is a lot faster since the kubernetes
+    client spends most of its time making model objects for all the
+    fields we don't care about.
+    """
+
+    __slots__ = ('namespace', 'name', 'phase', 'node', 'start_time',
+                 'spec_images', 'containers')
+
+    @classmethod
+    def from_model(cls, i):
+        pod = cls()
+        pod.namespace = i.metadata.namespace
+        pod.name = i.metadata.name
+        pod.phase = i.status.phase
+        pod.node = i.spec.node_name
+        pod.start_time = i.status.start_time
+        pod.spec_images = [c.image for c in i.spec.containers]
+        pod.containers = None
+
+        if i.status.container_statuses is not None:
+            pod.containers = [
+                Container(c.image, c.image_id,
+                          c.state.running is not None,
+                          c.state.waiting.reason if c.state.waiting is not None else None,
+                          c.state.terminated.started_at if c.state.terminated is not None else None)
+                for c in i.status.container_statuses ]
+
+        return pod
+
+
+    @classmethod
+    def from_json(cls, i):
+        metadata = i.get('metadata', {})
+        spec = i.get('spec', {})
+        status = i.get('status', {})
+
+        pod = cls()
+        pod.namespace = metadata.get('namespace')
+        pod.name = metadata.get('name')
+        pod.phase = status.get('phase')
+        pod.node = spec.get('nodeName')
+        pod.start_time = parse_time(status.get('startTime'))
+        pod.spec_images = [c.get('image') for c in spec.get('containers', [])]
+        pod.containers = None
+
+        statuses = status.get('containerStatuses')
+        if statuses is not None:
+            pod.containers = []
+            for c in statuses:
+                state = c.get('state') or {}
+                waiting = state.get('waiting')
+                terminated = state.get('terminated')
+                pod.containers.append(
+                    Container(c.get('image'), c.get('imageID'),
+                              state.get('running') is not None,
+                              waiting.get('reason') if waiting is not None else None,
+                              parse_time(terminated.get('startedAt')) if terminated is not None else None))
+
+        return pod
+
+
+    def __eq__(self, other):
+        # So the watch can tell if anything we use has changed
+        return isinstance(other, Pod) and \
+            all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+
+def load_from_kubernetes(k8s, images, context=None, timeout=None):
 
     """Load image list from all the pods in all the namespaces in the
     given cluster.  The images and some status information are saved
-    in the global images dictionary.
+    in the given images dictionary.
+
+    Unless --model-objects is given the pods are read from the raw
+    JSON of the API responses, see Pod.
 
     Pods that are not running or pending and more than 31 days old
-    will be ignored.
+    will be ignored.  Returns the number of containers that were too
+    old.
     """
 
-    global too_old
+    count = 0
+    too_old = 0
+
+    if use_models:
+        pods = map(Pod.from_model,
+                   list_paged(k8s.list_pod_for_all_namespaces, context, page_size, timeout))
+    else:
+        pods = map(Pod.from_json,
+                   list_paged(k8s.list_pod_for_all_namespaces, context, page_size, timeout, raw=True))
+
+    for pod in pods:
+        (added, old) = add_pod(images, context, pod)
+        count += added
+        too_old += old
+
+    log(context, "* Found %s pods" % count)
+
+    return too_old
+
+
+
+def canonical_image(image_id):
+    """The registry/repo@digest reference of what a container actually
+    runs, from its imageID in the pod status.  The imageID can have a
+    runtime prefix like docker-pullable://.  If it's only a local image
+    id (sha256:...) there is no canonical reference and None is
+    returned."""
+
+    if image_id is None:
+        return None
+
+    if "://" in image_id:
+        image_id = image_id.split("://", 1)[1]
+
+    if "/" not in image_id or "@sha256:" not in image_id:
+        return None
+
+    return image_id
+
+
+def add_pod(images, context, i):
+    """Add the containers of one Pod to the images dictionary.  Returns
+    the number of containers added and the number that were too old.
+    Adding the same pod twice gives the same result."""
 
     # Kubernetes pod phases:
     # https://kubernetes.io/docs/concepts/workloads/pods/pod-lifecycle/#pod-phase
@@ -53,161 +305,698 @@ def load_from_kubernetes(k8s, context=None):
     # ImagePullBackOff is not a kubernetes phase, but for the registry-checker it's
     # interesting
     count = 0
+    too_old = 0
 
     # Each container can be the origin of several different pods.  A
     # long running pod, a cronJob pod etc.  Therefore the outer key is
     # the container since we're all about the container images really.
 
-    for i in k8s.list_pod_for_all_namespaces(watch=False).items:
+    if i.containers is None: return (0, 0)
 
-        if i.status.container_statuses is None: continue
+    # This is the namespace-point of suffcient specificity to save
+    # if the registry tag is running somewhere and where that is.
+    pod_name = f'k8s;{context};{i.namespace};{i.name}'
 
-        # This is the namespace-point of suffcient specificity to save
-        # if the registry tag is running somewhere and where that is.
-        pod_name = f'k8s;{context};{i.metadata.namespace};{i.metadata.name}'
+    pod_images = i.spec_images
 
-        pod_images = [c.image for c in i.spec.containers]
+    # A image can be referenced as all of these things in various places:
+    # - docker.vgnett.no/docker-registry-checker:50575d7@sha256:dadd36f816c87663fee16ff8f4e265e3feda064f7b2faa6426cb0b32c5ae0d0b
+    # - docker.vgnett.no/docker-registry-checker@sha256:dadd36f816c87663fee16ff8f4e265e3feda064f7b2faa6426cb0b32c5ae0d0b
+    # - docker.vgnett.no/docker-registry-checker:50575d7
+    # - sha256:dadd36f816c87663fee16ff8f4e265e3feda064f7b2faa6426cb0b32c5ae0d0b
+    #
+    # The digest is fairly unique and we need to be able to find
+    # registry:tag from the sha256-digit.
+    image_by_digest = {}
 
-        # A image can be referenced as all of these things in various places:
-        # - docker.vgnett.no/docker-registry-checker:50575d7@sha256:dadd36f816c87663fee16ff8f4e265e3feda064f7b2faa6426cb0b32c5ae0d0b
-        # - docker.vgnett.no/docker-registry-checker@sha256:dadd36f816c87663fee16ff8f4e265e3feda064f7b2faa6426cb0b32c5ae0d0b
-        # - docker.vgnett.no/docker-registry-checker:50575d7
-        # - sha256:dadd36f816c87663fee16ff8f4e265e3feda064f7b2faa6426cb0b32c5ae0d0b
-        #
-        # The digest is fairly unique and we need to be able to find
-        # registry:tag from the sha256-digit.
-        image_by_digest = {}
+    for im in pod_images:
+        if "@" in im:
+            ima, digest = im.split('@')
+            image_by_digest[digest] = ima
 
-        for im in pod_images:
-            if "@" in im:
-                ima, digest = im.split('@')
-                image_by_digest[digest] = ima
+    # Figure out when this pod was last wanted
+    ipbo = any(c.waiting_reason == 'ImagePullBackOff' for c in i.containers)
 
-        # Figure out when this pod was last wanted
-        if i.status.phase in ['Pending', 'Running'] or ipbo:
-            pod_age = 0 # now
-        else:
-            pod_age = (datetime.now(timezone.utc) - i.status.start_time).total_seconds()
+    if i.phase in ['Pending', 'Running'] or ipbo:
+        pod_age = 0 # now
+    else:
+        pod_age = 0
+        if i.start_time is not None:
+            pod_age = (datetime.now(timezone.utc) - i.start_time).total_seconds()
             pod_age = pod_age / 60 / 60 / 24
 
-        for c in i.status.container_statuses:
-            # Figuring out what the registry/repository:tag format
-            # without the digest is is a bit of a circus act. So here
-            # are some heurstics to find the right one.
-            digest = None
+    for c in i.containers:
+        # Figuring out what the registry/repository:tag format
+        # without the digest is is a bit of a circus act. So here
+        # are some heurstics to find the right one.
+        digest = None
 
-            if "/" in c.image:
-                # If there is a registry name in the image name, use that
-                image_name = c.image
-            else:
-                # This tends to be in registry/repository@digest
-                # format which we don't like very much because the tag
-                # format is most common in input to kubernetes and is
-                # needed for pushing.  The digest format can be used
-                # for pull but not push.
-                image_name = c.image_id
-
-            if image_name is None or image_name == "":
-                # This happened once on a fluke, just ignore it if it happens
-                print("No image_name for %s" % pod_name)
-                next
-
-            # Turns out there is a digest as well
-            if "@" in image_name and len(image_by_digest) > 0:
-                digest = image_name.split("@")[1]
-                image_name = image_by_digest.get(digest, image_name)
-
-            if "@" in image_name and len(pod_images) == 1:
-                image_name = pod_images[0]
-
-            ipbo = c.state.waiting is not None and \
-                c.state.waiting.reason == 'ImagePullBackOff'
-
-            c_age = pod_age
-
-            if c.state.running is not None:
-                c_age = 0 # now
-            elif pod_age > 0 and c.state.terminated is not None and \
-                c.state.terminated.started_at is not None:
-                # Get the launch time of the container if it's
-                # terminated, and then ignore it if it's older than
-                # max_age
-                c_age = datetime.now(timezone.utc) - c.state.terminated.started_at
-                c_age = c_age.total_seconds() / 60 / 60 / 24
-                if c_age > max_age:
-                    # print("Skipping %s, too old at %d days" % (image_name, c_age) )
-                    too_old += 1
-                    continue
+        if c.image is not None and "/" in c.image:
+            # If there is a registry name in the image name, use that
+            image_name = c.image
+        else:
+            # This tends to be in registry/repository@digest
+            # format which we don't like very much because the tag
+            # format is most common in input to kubernetes and is
+            # needed for pushing.  The digest format can be used
+            # for pull but not push.
+            image_name = c.image_id
 
-                # print("Container %s in pod %s is not running and is %d days old" % (c.name, i.metadata.name, c_age))
+        if image_name is None or image_name == "":
+            # This happened once on a fluke, just ignore it if it happens
+            log(context, "No image_name for %s" % pod_name)
+            continue
 
-            count += 1
-            if image_name not in images:
-                images[image_name] = { '_phase': no_phase.copy() }
+        # Turns out there is a digest as well
+        if "@" in image_name and len(image_by_digest) > 0:
+            digest = image_name.split("@")[1]
+            image_name = image_by_digest.get(digest, image_name)
+
+        if "@" in image_name and len(pod_images) == 1:
+            image_name = pod_images[0]
 
-            ipbo = c.state.waiting is not None and \
-                c.state.waiting.reason == 'ImagePullBackOff'
+        c_age = pod_age
 
-            images[image_name]['_phase']['ImagePullBackOff'] = ipbo
+        if c.running:
+            c_age = 0 # now
+        elif pod_age > 0 and c.started_at is not None:
+            # Get the launch time of the container if it's
+            # terminated, and then ignore it if it's older than
+            # max_age
+            c_age = datetime.now(timezone.utc) - c.started_at
+            c_age = c_age.total_seconds() / 60 / 60 / 24
+            if c_age > max_age:
+                too_old += 1
+                continue
 
-            # If we haven't seen this container/pod combination
-            # before, make a new emtpy phase summary for it.
-            if pod_name not in images[image_name]:
-                images[image_name][pod_name] = no_phase.copy()
+        count += 1
+        if image_name not in images:
+            images[image_name] = { '_phase': no_phase.copy() }
 
-            # The outer nesting is the image - because we're concerned
-            # with the images
-            images[image_name][pod_name][i.status.phase] = True
-            images[image_name][pod_name]['ImagePullBackOff'] = ipbo
-            images[image_name][pod_name]['_last_wanted'] = c_age
-            if digest is not None: images[image_name]['_digest'] = digest
+        ipbo = c.waiting_reason == 'ImagePullBackOff'
 
-            images[image_name]['_phase'][i.status.phase] = True
+        images[image_name]['_phase']['ImagePullBackOff'] = ipbo
 
-            if '_last_wanted' not in images[image_name] or \
-               images[image_name]['_last_wanted'] > c_age:
-                images[image_name]['_last_wanted'] = c_age
+        # If we haven't seen this container/pod combination
+        # before, make a new emtpy phase summary for it.
+        if pod_name not in images[image_name]:
+            images[image_name][pod_name] = no_phase.copy()
 
-            if i.spec.node_name is not None:
-                images[image_name][pod_name]['_node'] = i.spec.node_name
+        # The outer nesting is the image - because we're concerned
+        # with the images
+        images[image_name][pod_name][i.phase] = True
+        images[image_name][pod_name]['ImagePullBackOff'] = ipbo
+        images[image_name][pod_name]['_last_wanted'] = c_age
+        if digest is not None: images[image_name]['_digest'] = digest
 
-    print("* Found %s pods" % count)
+        # The manifest that is actually running, whatever the image is
+        # called in the pod spec
+        canonical = canonical_image(c.image_id)
+        if canonical is not None:
+            canonicals = images[image_name].setdefault('_canonical', [])
+            if canonical not in canonicals:
+                canonicals.append(canonical)
+                canonicals.sort()
 
+        images[image_name]['_phase'][i.phase] = True
 
-def load_cronjobs_from_kubernetes(k8s, context=None):
+        if '_last_wanted' not in images[image_name] or \
+           images[image_name]['_last_wanted'] > c_age:
+            images[image_name]['_last_wanted'] = c_age
+
+        if i.node is not None:
+            images[image_name][pod_name]['_node'] = i.node
+
+    return (count, too_old)
+
+
+def load_cronjobs_from_kubernetes(k8s, images, context=None, timeout=None):
     """Load image list from the cronjob specs in all the namespaces in
-    the given cluster.
+    the given cluster into the images dictionary.
     """
 
     count = 0
 
+    cronjobs = list_paged(k8s.list_cron_job_for_all_namespaces, context, page_size, timeout)
+
     try:
-        cronjobs = k8s.list_cron_job_for_all_namespaces()
+        for i in cronjobs:
+            add_cronjob(images, i)
+            count += len(i.spec.job_template.spec.template.spec.containers)
+
     except ApiException as e:
         if e.status == 404:
-            print("* No cronjobs found")
+            log(context, "* No cronjobs found")
             return
         if e.status == 403:
-            sys.exit("\nNo access to cronjobs. Terminating.")
+            sys.exit("No access to cronjobs in %s" % context)
         sys.exit("API ERROR: %s" % e)
 
-    for i in cronjobs.items:
+    log(context, "* Found %s cronjobs" % count)
+
+
+def add_cronjob(images, i):
+    """Add the images of one cronjob to the images dictionary"""
+
+    add_cronjob_images(images, i.metadata.name,
+                       [c.image for c in i.spec.job_template.spec.template.spec.containers])
+
+
+def add_cronjob_images(images, name, image_names):
+    """Add the images of the cronjob called name to the images dictionary"""
+
+    for image_name in image_names:
+        if image_name is None or image_name == "":
+            sys.exit("FATAL: No image for cronjob %s" % name)
+
+        if image_name not in images:
+            images[image_name] = { '_cronjob': True,
+                                   '_last_wanted': 0,
+                                   '_phase': no_phase.copy() }
+        else:
+            images[image_name]['_cronjob'] = True
+            images[image_name]['_last_wanted'] = 0
+
+
+def load_nodes_from_kubernetes(k8s, images, context=None, timeout=None):
+    """Count on how many nodes of the cluster each image is cached,
+    from the status of the nodes, into the _node_cache key of the
+    images dictionary.  Images cached on few nodes are the ones that
+    hurt if they go missing from the registry.
+    """
+
+    count = 0
 
-        for c in i.spec.job_template.spec.template.spec.containers:
+    try:
+        for i in list_paged(k8s.list_node, context, page_size, timeout, raw=True):
+            add_node_images(images, node_images_from_json(i))
             count += 1
-            image_name = c.image
-            if image_name is None or image_name == "":
-                sys.exit("FATAL: No image for cronjob %s" % i.metadata.name)
 
-            if image_name not in images:
-                images[image_name] = { '_cronjob': True,
-                                       '_last_wanted': 0,
-                                       '_phase': no_phase.copy() }
-            else:
-                images[image_name]['_cronjob'] = True
-                images[image_name]['_last_wanted'] = 0
-                
-    print("* Found %s cronjobs" % count)
+    except ApiException as e:
+        if e.status == 403:
+            log(context, "* No access to nodes, the node image cache is unknown")
+            return
+        raise
+
+    log(context, "* Found %s nodes" % count)
+
+
+def node_images_from_json(i):
+    """The names of the images cached on a node, as found in the raw
+    JSON.  Each image has several names, by tag and by digest."""
+
+    names = []
+    for image in (i.get('status') or {}).get('images') or []:
+        names.extend(image.get('names') or [])
+
+    return names
+
+
+def add_node_images(images, names):
+    """Count the images cached on one node in the images dictionary"""
+
+    cache = images.setdefault('_node_cache', {})
+    for name in set(names):
+        cache[name] = cache.get(name, 0) + 1
+
+    images['_nodes'] = images.get('_nodes', 0) + 1
+
+
+def collect_context(context, api_client, timeout):
+    """Collect the images of one context into a images dictionary of
+    its own.  This runs in a thread, one for each context.  timeout is
+    the timeout of each API request.  Returns the images and the
+    number of too old containers."""
+
+    log(context, "Loading from %s" % context)
+
+    if api_client is None:
+        api_client = config.new_client_from_config(context=context)
+
+    k8s = client.CoreV1Api(api_client)
+    k8s_batch = client.BatchV1Api(api_client)
+
+    images = {}
+
+    too_old = load_from_kubernetes(k8s, images, context=context, timeout=timeout)
+    load_cronjobs_from_kubernetes(k8s_batch, images, context=context, timeout=timeout)
+    load_nodes_from_kubernetes(k8s, images, context=context, timeout=timeout)
+
+    log(context, "= Images: %d, and %d are too old" % (inventory.count_images(images), too_old))
+
+    return (images, too_old)
+
+
+class ContextRun:
+    """The collection of one context in a daemon thread of its own, so
+    a context that hangs can be left behind: Python does not wait for
+    daemon threads when it exits."""
+
+    def __init__(self, context, api_client, request_timeout, done):
+        self.context = context
+        self.api_client = api_client
+        self.request_timeout = request_timeout
+        self.done = done
+        self.started = None
+        self.finished = False
+        self.result = None
+        self.error = None
+
+
+    def start(self):
+        self.started = time.monotonic()
+        threading.Thread(target=self.run, name=self.context, daemon=True).start()
+
+
+    def run(self):
+        try:
+            self.result = collect_context(self.context, self.api_client, self.request_timeout)
+        except (Exception, SystemExit) as e:
+            self.error = e
+
+        with self.done:
+            self.finished = True
+            self.done.notify_all()
+
+
+def collect_contexts(contexts, timeout, request_timeout, parallel):
+    """Collect all the contexts at the same time and merge the results
+    into the global images, in the order of the contexts so the result
+    does not depend on which context was fastest.  Each API request
+    times out after request_timeout seconds, and a context that is not
+    done timeout seconds after it started is given up.  Returns a dict
+    of the contexts that failed, with the reason."""
+
+    total_too_old = 0
+    failed = {}
+
+    done = threading.Condition()
+    runs = [ ContextRun(context, api_client, request_timeout, done)
+             for (context, api_client) in contexts ]
+
+    # At most parallel contexts at a time.  A context that is given up
+    # keeps its thread but not its place, it does not hold up the rest.
+    waiting = list(runs)
+    running = []
+    timed_out = set()
+
+    with done:
+        while len(waiting) > 0 or len(running) > 0:
+            now = time.monotonic()
+            for run in list(running):
+                if run.finished:
+                    running.remove(run)
+                elif now - run.started > timeout:
+                    running.remove(run)
+                    timed_out.add(run.context)
+
+            while len(waiting) > 0 and len(running) < (parallel or len(runs)):
+                run = waiting.pop(0)
+                run.start()
+                running.append(run)
+
+            if len(running) > 0:
+                done.wait(timeout=1)
+
+    for run in runs:
+        context = run.context
+
+        if context in timed_out:
+            print("FAILED: %s timed out after %d seconds" % (context, timeout))
+            failed[context] = "timed out"
+            continue
+
+        if run.error is not None:
+            print()
+            print("FAILED loading from %s" % context)
+            print()
+            print('ERROR MESSAGE: """%s"""' % run.error)
+            failed[context] = str(run.error).strip().split("\n")[0]
+            continue
+
+        (found, too_old) = run.result
+        inventory.merge_images(images, found)
+        total_too_old += too_old
+
+    print("= Images: %d, and %d are too old" % (inventory.count_images(images), total_too_old))
+
+    return failed
+
+
+# How long each watch request lasts before the API server ends it and
+# it is started again from the last resourceVersion
+watch_seconds = 300
+
+
+def cronjob_images_from_json(i):
+    """The images of a cronjob as found in the raw JSON"""
+
+    spec = i.get('spec', {}).get('jobTemplate', {}).get('spec', {}) \
+            .get('template', {}).get('spec', {})
+
+    return [c.get('image') for c in spec.get('containers', [])]
+
+
+class ContextWatcher:
+    """Keeps the pods, cronjobs and nodes of one context current.  Each kind
+    is listed once and then followed with a watch from the
+    resourceVersion of the list.  If the watch falls too far behind
+    (410 Gone) the kind is listed again.  Bookmarks keep the
+    resourceVersion fresh so that seldom happens.
+
+    The state is kept as the Pods, the cronjob images and the node
+    images, the images dictionary is made from them when it's time to save it, see
+    images().  changed is a threading.Event that is set whenever
+    something we use changes, events that only change other fields of
+    the objects are ignored.
+    """
+
+    def __init__(self, context, api_client, changed, request_timeout):
+        self.context = context
+        self.api_client = api_client
+        self.changed = changed
+        self.request_timeout = request_timeout
+        self.lock = threading.Lock()
+        self.pods = {}
+        self.cronjobs = {}
+        self.nodes = {}
+        self.listed = set()
+        # When the last watch failed, None when all is well
+        self.failing_since = None
+        self.error = None
+
+
+    def start(self):
+        threading.Thread(target=self.connect, name=self.context, daemon=True).start()
+
+
+    def failed(self, error):
+        """Note that something failed, the context goes in _partial if
+        it goes on for too long"""
+
+        with self.lock:
+            if self.failing_since is None:
+                self.failing_since = datetime.now(timezone.utc)
+            self.error = error
+
+
+    def connect(self):
+        """Make the API client, trying again until the configuration
+        works, and start following the pods, cronjobs and nodes.  A
+        broken context must not stop the others."""
+
+        backoff = 1
+
+        while self.api_client is None:
+            try:
+                self.api_client = config.new_client_from_config(context=self.context)
+            except Exception as e:
+                error = str(e).strip().split("\n")[0]
+                log(self.context, "Cannot connect, retrying in %d seconds: %s" % (backoff, error))
+                self.failed(error)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+        k8s = client.CoreV1Api(self.api_client)
+        k8s_batch = client.BatchV1Api(self.api_client)
+
+        for (kind, list_fn, store, parse) in \
+            [ ('pods', k8s.list_pod_for_all_namespaces, self.pods, Pod.from_json),
+              ('cronjobs', k8s_batch.list_cron_job_for_all_namespaces, self.cronjobs,
+               self.cronjob_images),
+              ('nodes', k8s.list_node, self.nodes, node_images_from_json) ]:
+            threading.Thread(target=self.follow, args=(kind, list_fn, store, parse),
+                             name=f'{self.context}-{kind}', daemon=True).start()
+
+
+    def cronjob_images(self, i):
+        """The images of a cronjob as found in the raw JSON.  A cronjob
+        without a image stops a full collection, but must not stop the
+        watcher, it is logged and left out."""
+
+        image_names = cronjob_images_from_json(i)
+
+        if any(image_name is None or image_name == "" for image_name in image_names):
+            metadata = i.get('metadata', {})
+            log(self.context, "No image for cronjob %s/%s, leaving it out" %
+                (metadata.get('namespace'), metadata.get('name')))
+            return []
+
+        return image_names
+
+
+    def ready(self):
+        """True when pods, cronjobs and nodes have all been listed"""
+
+        with self.lock:
+            return len(self.listed) == 3
+
+
+    def follow(self, kind, list_fn, store, parse):
+        """List and then watch one kind of object, forever"""
+
+        backoff = 1
+
+        while True:
+            try:
+                resource_version = self.relist(kind, list_fn, store, parse)
+
+                while True:
+                    resource_version = self.watch(kind, list_fn, store, parse,
+                                                  resource_version)
+                    with self.lock:
+                        self.failing_since = None
+                        self.error = None
+                    backoff = 1
+
+            except ApiException as e:
+                if e.status == 410:
+                    log(self.context, "Watching %s expired, listing again" % kind)
+                    continue
+
+                # Neither is needed for a useful inventory
+                if (e.status == 404 and kind == 'cronjobs') or \
+                   (e.status == 403 and kind == 'nodes'):
+                    log(self.context, "* No access to %s, not watching them" % kind)
+                    with self.lock:
+                        self.listed.add(kind)
+                    self.changed.set()
+                    return
+
+                error = "API ERROR: %s %s" % (e.status, e.reason)
+
+            except Exception as e:
+                error = str(e).strip().split("\n")[0]
+
+            log(self.context, "Watching %s failed, retrying in %d seconds: %s" %
+                (kind, backoff, error))
+
+            self.failed(error)
+
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+    def relist(self, kind, list_fn, store, parse):
+        """List all the objects and replace the stored ones with them.
+        Returns the resourceVersion to watch from."""
+
+        info = {}
+        fresh = {}
+
+        for i in list_paged(list_fn, self.context, page_size, self.request_timeout,
+                            raw=True, info=info):
+            metadata = i.get('metadata', {})
+            fresh[(metadata.get('namespace'), metadata.get('name'))] = parse(i)
+
+        with self.lock:
+            changed = kind not in self.listed or store != fresh
+            store.clear()
+            store.update(fresh)
+            self.listed.add(kind)
+            self.failing_since = None
+            self.error = None
+
+        if changed:
+            self.changed.set()
+        log(self.context, "* Listed %d %s" % (len(fresh), kind))
+
+        return info['resourceVersion']
+
+
+    def watch(self, kind, list_fn, store, parse, resource_version):
+        """Apply the changes from one watch request to the stored
+        objects.  Returns the resourceVersion to continue from when the
+        API server ends the watch."""
+
+        response = list_fn(watch=True, resource_version=resource_version,
+                           allow_watch_bookmarks=True, timeout_seconds=watch_seconds,
+                           _request_timeout=(self.request_timeout, watch_seconds + 60),
+                           _preload_content=False)
+
+        try:
+            for line in iter_resp_lines(response):
+                if not line:
+                    continue
+
+                event = json.loads(line)
+                kind_of_event = event.get('type')
+                obj = event.get('object') or {}
+
+                if kind_of_event == 'ERROR':
+                    raise ApiException(status=obj.get('code'),
+                                       reason="%s: %s" % (obj.get('reason'), obj.get('message')))
+
+                metadata = obj.get('metadata', {})
+                resource_version = metadata.get('resourceVersion', resource_version)
+
+                if kind_of_event == 'BOOKMARK':
+                    continue
+
+                key = (metadata.get('namespace'), metadata.get('name'))
+                value = parse(obj) if kind_of_event != 'DELETED' else None
+
+                # Most events on a busy cluster change nothing we use,
+                # like the readiness of a pod or the heartbeat of a
+                # node.  They don't need a new inventory.
+                with self.lock:
+                    if kind_of_event == 'DELETED':
+                        changed = store.pop(key, None) is not None
+                    else:
+                        changed = store.get(key) != value
+                        store[key] = value
+
+                if changed:
+                    self.changed.set()
+
+        finally:
+            response.close()
+            response.release_conn()
+
+        return resource_version
+
+
+    def images(self):
+        """Make the images dictionary of this context from the stored
+        pods and cronjobs, the same way as a full collection does"""
+
+        with self.lock:
+            pods = list(self.pods.values())
+            cronjobs = list(self.cronjobs.items())
+            nodes = list(self.nodes.values())
+
+        images = {}
+
+        for pod in pods:
+            add_pod(images, self.context, pod)
+
+        for ((namespace, name), image_names) in cronjobs:
+            add_cronjob_images(images, name, image_names)
+
+        for names in nodes:
+            add_node_images(images, names)
+
+        return images
+
+
+def build_images(watchers, timeout):
+    """Merge the images of all the contexts, in the order of the
+    contexts.  Contexts that are not listed yet, or have not been
+    updated for more than timeout seconds, go in the _partial key."""
+
+    images = {}
+    failed = {}
+
+    now = datetime.now(timezone.utc)
+
+    for w in watchers:
+        if not w.ready():
+            failed[w.context] = w.error or "not listed yet"
+            continue
+
+        inventory.merge_images(images, w.images())
+
+        with w.lock:
+            if w.failing_since is not None and \
+               (now - w.failing_since).total_seconds() > timeout:
+                failed[w.context] = "no updates since %s: %s" % \
+                    (w.failing_since.strftime('%Y-%m-%d %H:%M:%S'), w.error)
+
+    if len(failed) > 0:
+        images['_partial'] = failed
+
+    return images
+
+
+def watch_contexts(contexts, timeout, request_timeout, interval, refresh):
+    """Keep images.json current by watching all the contexts.  When
+    something changes the file is saved interval seconds later, so a
+    burst of changes gives one save.  It is saved every refresh
+    seconds anyway since the ages of the containers change.  Never
+    returns."""
+
+    changed = threading.Event()
+
+    watchers = [ ContextWatcher(context, api_client, changed, request_timeout)
+                 for (context, api_client) in contexts ]
+
+    for w in watchers:
+        log(w.context, "Watching %s" % w.context)
+        w.start()
+
+    # Give all the contexts a chance to be listed before the first save
+    started = time.monotonic()
+    while not all(w.ready() for w in watchers) and \
+          time.monotonic() - started < timeout:
+        time.sleep(1)
+
+    while True:
+        images = build_images(watchers, timeout)
+
+        missing = images.get('_partial', {})
+        if len(missing) == len(watchers):
+            print("Could not load from any context, not saving anything")
+        else:
+            if len(missing) > 0:
+                print("PARTIAL inventory, missing contexts: %s" % ", ".join(missing.keys()))
+            print("= Images: %d" % inventory.count_images(images))
+            save_images(images)
+
+        images = None
+
+        changed.clear()
+        changed.wait(timeout=refresh)
+        # Let the rest of the burst of changes come in
+        time.sleep(interval)
+
+
+def save_images(images):
+    """Save the inventory in the formats given by -f, or as a shard
+    with -s, atomically"""
+
+    if shard_id is not None:
+        images['_shard'] = { 'id': shard_id,
+                             'collected': datetime.now(timezone.utc).isoformat() }
+        path = inventory.shard_path(shard_id)
+        inventory.save_json(images, path)
+        del images['_shard']
+        print("Saved shard to %s" % path)
+        return
+
+    for path in inventory.save_images(images, formats=save_formats):
+        print("Saved images to %s" % path)
+
+    global history_recorded
+
+    if history_days > 0:
+        history_pending.update(usedhistory.used_items(images))
+
+        now = time.monotonic()
+        if history_recorded is None or now - history_recorded >= history_every:
+            new = usedhistory.record_items(history_pending, history_days)
+            print("Added %d new images to the history of images in use" % new)
+            history_pending.clear()
+            history_recorded = now
 
 
 def main():
@@ -215,11 +1004,38 @@ def main():
     parser.add_argument('-a', '--age', action='store', type=int, default=31, \
                         help='Only inlucde images younger than this many days, default is 31')
     parser.add_argument('-c', '--context', action='append', help='Check this context (can be repeated)')
+    parser.add_argument('-t', '--timeout', action='store', type=int, default=300, \
+                        help='Give up on a context after this many seconds, default 300')
+    parser.add_argument('-T', '--request-timeout', action='store', type=int, default=60, \
+                        help='Give up on a single API request after this many seconds, default 60')
+    parser.add_argument('-P', '--parallel', action='store', type=int, default=None, \
+                        help='Number of contexts to collect at the same time, default all')
+    parser.add_argument('-l', '--limit', action='store', type=int, default=500, \
+                        help='Number of pods (or cronjobs) to get from the API per request, default 500')
+    parser.add_argument('-M', '--model-objects', action='store_true', default=False, \
+                        help='Read pods through the kubernetes client model objects (slow) instead of the raw JSON')
+    parser.add_argument('-f', '--format', action='append', choices=['db', 'json'], \
+                        help='Save images.db and/or images.json (can be repeated), default both')
+    parser.add_argument('-s', '--shard', action='store', default=None, \
+                        help='Save a inventory shard for k8s-inventory-merge.py with this cluster id instead')
+    parser.add_argument('-H', '--history-days', action='store', type=int, default=90, \
+                        help='Remember the images in use for this many days in used-history/, 0 to not, default 90')
+    parser.add_argument('-w', '--watch', action='store_true', default=False, \
+                        help='Keep running and keep images.json current by watching the clusters')
+    parser.add_argument('-i', '--interval', action='store', type=int, default=10, \
+                        help='With -w: Save this many seconds after a change, default 10')
+    parser.add_argument('-r', '--refresh', action='store', type=int, default=900, \
+                        help='With -w: Save at least this often in seconds to update the ages, default 900')
     args = parser.parse_args()
 
-    global max_age, too_old
+    global max_age, page_size, use_models, save_formats, shard_id, history_days, history_every
     max_age = args.age
-    too_old = 0
+    page_size = args.limit
+    use_models = args.model_objects
+    if args.format:
+        save_formats = tuple(args.format)
+    shard_id = args.shard
+    history_days = args.history_days
 
     print("Collecting images from kubernetes %s" % args.context)
 
@@ -245,42 +1061,35 @@ def main():
         sys.exit("Cannot find any contexts? Exiting.")
 
     if contexts[0]['name'] == 'in-cluster':
-        k8s = client.CoreV1Api()
-        k8s_batch = client.BatchV1Api()
-
         print("Running in cluster, only checking it")
-        load_from_kubernetes(k8s, context='in-cluster')
-        load_cronjobs_from_kubernetes(k8s_batch)
-        print("= Images until now: %d, and %d are too old" % (len(images), too_old))
+        # The in-cluster config is loaded into the default client
+        # configuration.  The pod keys of the shards from different
+        # clusters must not collide, so use the shard id as the name.
+        contexts = [ (shard_id or 'in-cluster', client.ApiClient()) ]
 
     else:
-        contexts = [context['name'] for context in contexts]
-
         print("Finding images in available contexts")
-        for context in contexts:
-            print("Loading from %s" % context)
-            config.load_kube_config(context=context)
-            k8s = client.CoreV1Api()
-            k8s_batch = client.BatchV1Api()
+        # Each context gets its own ApiClient in collect_context
+        contexts = [ (context['name'], None) for context in contexts ]
 
-            try:
-                load_from_kubernetes(k8s, context=context)
-            except ApiException as e:
-                print()
-                print("FATAL ERROR loading from %s" % context)
-                print()
-                print('API ERROR MESSAGE: """%s"""' % e)
-                sys.exit(1)
+    if args.watch:
+        history_every = 3600
+        watch_contexts(contexts, args.timeout, args.request_timeout, args.interval, args.refresh)
+
+    failed = collect_contexts(contexts, args.timeout, args.request_timeout, args.parallel)
 
-            load_cronjobs_from_kubernetes(k8s_batch, context=context)
-            print("= Images until now: %d, and %d are too old" % (len(images), too_old))
+    if len(failed) == len(contexts):
+        sys.exit("Could not load from any context, not saving anything")
 
-    savedir = os.environ.get('REPORTDIR', '.')
+    if len(failed) > 0:
+        # Consumers must be able to tell that this is not the whole picture
+        images['_partial'] = failed
+        print("PARTIAL inventory, missing contexts: %s" % ", ".join(failed.keys()))
 
-    print("Saving images to %s/images.json" % savedir)
+    save_images(images)
 
-    with open(f'{savedir}/images.json', "w") as f:
-        f.write(json.dumps(images, indent=2, sort_keys=True))
+    if len(failed) > 0:
+        sys.exit(2)
 
 images = {}
         
@@ -9,21 +9,36 @@
 # Usage:
 # - Run ./k8s-inventory.py to build the images.json file first
 # - ./registry-checker.py docker.example.com
+# - Or several registries at once, into one report:
+#   ./registry-checker.py docker.example.com harbor.example.com
 #
 #   See -h for more options
 
 import os
-import re
 import sys
-import csv
-import json
+import math
+import time
+import random
 import curses
-import requests
 import argparse
 from Spinner import Spinner
-from os import mkdir, chdir
+from os import mkdir
 from datetime import datetime
-from Registry import Registry
+from Registry import Registry, manifest_blobs, TIMEOUT
+from digestindex import DigestIndex
+from healthcache import HealthCache, BlobCache
+from checkreport import Report
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import inventory
+
+# "http" for test registries without TLS, such as in bench/
+registry_scheme = "https"
+
+# The longest to wait for the registry, and if slow probes should be
+# sent again.  See -t and -H
+registry_timeout = 30
+hedge = False
 
 dirname = "check-report-%s" % datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
 
@@ -37,30 +52,144 @@ try:
 except:
     pass
 
-used_repo = {}
-used_repo_tag = {}
+def check_order(image_report, images):
+    """The order to check the images in, the most urgent first:
+
+    0. Images in prod namespaces that pods are waiting for, Pending or
+       in ImagePullBackOff
+    1. The rest of the images in prod
+    2. The images pods are waiting for elsewhere
+    3. The images in staging namespaces
+    4. The rest
+
+    A missing image hurts most when a pod has to start on a node that
+    does not have it cached, so in each group the images cached on the
+    fewest nodes come first."""
+
+    def priority(path):
+        record = image_report[path]
+        namespaces = record.namespaces(inventory.ACTIVE)
+        waiting = record.any(inventory.PENDING | inventory.IMAGE_PULL_BACKOFF)
+
+        if any("prod" in ns for ns in namespaces):
+            group = 0 if waiting else 1
+        elif waiting:
+            group = 2
+        elif any("stag" in ns for ns in namespaces):
+            group = 3
+        else:
+            group = 4
 
+        return (group, inventory.node_coverage(image_report, path), path)
 
-def find_image_by_repo(repo_name):
-    """Find all the images in the report that are from a given repo"""
+    return sorted(images, key=priority)
 
-    search_string = f'{repo_name}:'
-    return [ path for path in image_report if path.startswith(search_string) ]
 
+def running_digests(record):
+    """What the pods of the image are running, as a string to compare
+    between runs: The digests of its canonical references, from the
+    imageIDs, or the digest it is pinned to.  None if not known, such
+    as when no pod has pulled it yet."""
 
-def examine_by_report(image_report, only=None):
-    regPrefix = f'{registry}/'
+    digests = sorted({ ref.split('@', 1)[1] for ref in record.canonical if '@' in ref })
+    if len(digests) > 0:
+        return " ".join(digests)
+
+    return record.digest
+
+
+def open_registry(registry, connections):
+    """The Registry object for registry, as the options say"""
+
+    return Registry(registry, connections=connections, scheme=registry_scheme,
+                    timeout=registry_timeout, hedge=hedge)
+
+
+def probe_wrongs(digest, digest_status, manifest_status):
+    """What is wrong according to Registry.get_manifest_health.  If
+    the registry did not answer we don't know if anything is missing,
+    that is only a "timeout"."""
 
-    reg = Registry(registry)
+    if TIMEOUT in (digest_status, manifest_status):
+        return [ "timeout" ]
 
-    errors = []
+    wrongs = []
+    if digest == "":
+        wrongs.append("no digest")
+    if manifest_status is not None and manifest_status != 200:
+        wrongs.append("no manifest")
 
-    i = 0
+    return wrongs
 
-    for path in image_report:
-        if not path.startswith(regPrefix):
+
+def missing_blobs(reg, blobs, repo, manifest):
+    """The blobs the manifest, and the manifests of a manifest list,
+    refer to that are missing in the repo, sorted.  blobs is the
+    BlobCache of the registry.  A blob that could not be checked for
+    another reason than not being there is listed with the status."""
+
+    missing = set()
+
+    (layers, manifests) = manifest_blobs(manifest)
+
+    for blob in layers:
+        status = blobs.status(repo, blob, reg.get_blob_status)
+        if status == 404:
+            missing.add(blob)
+        elif status == TIMEOUT:
+            missing.add(f'{blob} (timeout)')
+        elif status != 200:
+            missing.add(f'{blob} ({status})')
+
+    for child in manifests:
+        _, child_manifest, _, status = reg.get_image_manifest(repo, child)
+        if status == TIMEOUT:
+            missing.add(f'{child} (timeout)')
+            continue
+        if len(child_manifest) == 0:
+            missing.add(f'{child} (manifest)')
             continue
 
+        missing.update(missing_blobs(reg, blobs, repo, child_manifest))
+
+    return sorted(missing)
+
+
+def examine_by_report(image_report, registry, used, only=None, workers=1, cache=None,
+                      blobs=None, errors=None):
+    """Check the images from the registry that are in the inventory.
+    image_report is the inventory as loaded by inventory.load_records
+    and used is the inventory.HostIndex of the registry.
+
+    The manifests are probed by workers threads at the same time.  The
+    results are gone through in the order the images were given, so
+    the errors come out the same whatever order the probes finish in.
+
+    If cache is a HealthCache the images with a fresh result in it are
+    not probed again.
+
+    If blobs is a BlobCache the check is deep: All the blobs of the
+    image must be there too.
+
+    The errors are appended to errors, a list or checkreport.ReportPart,
+    as they are found.  It is returned.
+    """
+
+    regPrefix = f'{registry}/'
+
+    reg = open_registry(registry, workers)
+
+    # The digest index is saved by the evictor. It tells us what the
+    # digest of a broken tag was and what other tags refer to it.
+    index = DigestIndex.load(registry)
+
+    if errors is None:
+        errors = []
+
+    # First find the images to check, that is quick
+    to_check = []
+
+    for path in check_order(image_report, used.images):
         repo_tag = path.replace(regPrefix,"",1)
 
         if only is not None:
@@ -78,70 +207,178 @@ def examine_by_report(image_report, only=None):
 
         # We only care about images that are running or pending, the
         # state of way too many dead pods is kept around.
-        if not (image_report[path]['_phase']['Running'] or
-                image_report[path]['_phase']['Pending'] or
-                image_report[path]['_phase']['ImagePullBackOff']):
+        if not image_report[path].any(inventory.ACTIVE):
             continue
 
-        i += 1
-
         if '@sha256:' in repo_tag:
             # Digest is used instead of tag
             (repo, tag) = repo_tag.split("@",1)
         else:
             (repo, tag) = repo_tag.split(":",1)
 
-        digest, _, _ = reg.get_manifest(repo, tag)
-
-        wrongs = []
-        # We used to check the manifest too here, but not all kinds of images have a manifest.
-        if digest == '': wrongs.append("no digest")
-
-        if image_report[path]['_phase']['ImagePullBackOff']:
-            wrongs.append("ImagePullBackOff")
-
-        if len(wrongs) > 0:
-            # We have a problem with this image, let's see where it's used
-            namespaces = [ ";".join(ns.split(";")[1:3])
-                           for ns in image_report[path]
-                             if not ns.startswith("_") and
-                               (image_report[path][ns]['Running'] or
-                                image_report[path][ns]['Pending'] or
-                                image_report[path][ns]['ImagePullBackOff']) ]
-
-            # Doing this as a list comprehension hurts my head too much
-            phases = []
-            for ns in image_report[path]:
-                if ns.startswith("_"):
-                    continue
-                for phase in image_report[path][ns]:
-                    if not phase.startswith("_") and \
-                      image_report[path][ns][phase]:
-                        phases.append(phase)
-
-            # Unique and sorted
-            phases = list(set(phases))
-            phases.sort()
-            namespaces = list(set(namespaces))
-            namespaces.sort()
-
-            # NOTE! All errors that goes to the same file must have the
-            # same fields, for the sake of the CSV writer.
-            errors.append({ 'tag': path, 'wrongs': wrongs, 'namespaces': namespaces, 'phase': phases })
-
-            print("  Examined %d/%d images, %d errors" % (i, len(image_report), len(errors)),
+        to_check.append((path, repo, tag))
+
+    now = time.time()
+    if cache is not None and only is None and cache.full_due(now):
+        print("  %s: Full recheck, not using the health cache%s" % (registry, clear_eol))
+        cache.start_full(now)
+
+    if cache is not None and only is None:
+        # The images no longer in use
+        cache.forget_others(path for (path, _, _) in to_check)
+
+    deep = blobs is not None
+
+    # The cached results, and the images to probe
+    cached = {}
+    to_probe = []
+    for item in to_check:
+        path = item[0]
+        entry = None
+        if cache is not None:
+            entry = cache.get(path, running_digests(image_report[path]), now, deep)
+
+        if entry is None:
+            to_probe.append(item)
+        else:
+            cached[path] = entry
+
+    def probe(item):
+        (path, repo, tag) = item
+
+        digest, manifest, _, status = reg.get_image_manifest(repo, tag)
+        result = { 'digest': digest, 'timeout': status == TIMEOUT }
+
+        if deep:
+            result['missing'] = []
+            if digest != '':
+                result['missing'] = missing_blobs(reg, blobs, repo, manifest)
+            if any(m.endswith(' (timeout)') for m in result['missing']):
+                result['timeout'] = True
+
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # map gives the results in the order of to_probe, which is the
+        # order of to_check with the cached images left out
+        probed = pool.map(probe, to_probe)
+
+        for i, (path, repo, tag) in enumerate(to_check, 1):
+
+            spinner.next()
+
+            record = image_report[path]
+
+            if path in cached:
+                result = cached[path]
+            else:
+                result = next(probed)
+                # A timeout tells nothing about the image, probe it
+                # again next time
+                if cache is not None and not result['timeout']:
+                    cache.put(path, running_digests(record), result['digest'], result.get('missing'))
+
+            digest = result['digest']
+
+            wrongs = []
+            # We used to check the manifest too here, but not all kinds
+            # of images have a manifest.  If the registry did not answer
+            # we don't know if it's there.
+            if result.get('timeout'):
+                wrongs.append("timeout")
+            elif digest == '':
+                wrongs.append("no digest")
+
+            if any(not m.endswith(' (timeout)') for m in result.get('missing', [])):
+                wrongs.append("missing blobs")
+
+            if record.any(inventory.IMAGE_PULL_BACKOFF):
+                wrongs.append("ImagePullBackOff")
+
+            if len(wrongs) == 0:
+                continue
+
+            # We have a problem with this image, let's see where it's
+            # used.  Unique and sorted.
+            namespaces = record.namespaces(inventory.ACTIVE)
+            phases = inventory.phase_names(record.pod_phases())
+
+            # All the other tags refering to the same (possibly
+            # corrupted) manifest are affected too
+            if digest == '' and tag.startswith('sha256:'):
+                digest = tag
+            if digest == '':
+                digest = index.digest_of(repo, tag) or record.digest
+            affects = [ f'{regPrefix}{r}:{t}' for (r, t) in index.get(digest)
+                        if f'{regPrefix}{r}:{t}' != path ]
+
+            error = { 'tag': path, 'wrongs': wrongs, 'namespaces': namespaces,
+                      'phase': phases, 'affects': affects }
+            if deep:
+                error['missing'] = result['missing']
+            errors.append(error)
+
+            print("  Examined %d/%d images, %d errors" % (i, len(to_check), len(errors)),
                   end="\r", flush=True)
 
+    if cache is not None:
+        print("  %s: %s%s" % (registry, cache.stats(), clear_eol))
+        cache.save()
+
+    if deep:
+        print("  %s: %s%s" % (registry, blobs.stats(), clear_eol))
+        blobs.save()
+
+    print("  %s: %s%s" % (registry, reg.stats(), clear_eol))
+    reg.close()
+
     return errors
 
 
-def examine_by_registry(image_report, only=None):
+def ordered_map(pool, fn, items, window):
+    """Like pool.map, but only window items are taken from items and
+    run at a time, so a long generator of items is not read all at
+    once.  Yields (item, result) in the order of items."""
+
+    pending = deque()
+
+    for item in items:
+        pending.append((item, pool.submit(fn, item)))
+        if len(pending) >= window:
+            (item, future) = pending.popleft()
+            yield item, future.result()
+
+    while pending:
+        (item, future) = pending.popleft()
+        yield item, future.result()
+
+
+def examine_by_registry(image_report, registry, used, only=None, workers=1, get=True,
+                        errors=None):
     """Loop over all the images in the registry and see if they are
-    healthy or not. Also see if they are used or not."""
+    healthy or not. Also see if they are used or not, used is the
+    inventory.HostIndex of the registry.
 
-    errors = []
+    The tags are probed by workers threads at the same time, and the
+    results are gone through in order as they come in, a repository at
+    a time.  Only a few tags per worker are in flight at any time, so
+    a registry with hundreds of thousands of tags can be checked.  If
+    get is False only the digest of each tag is checked, not that the
+    manifest can be retrieved.
 
-    reg = Registry(registry)
+    The errors are appended to errors as in examine_by_report.
+    """
+
+    if errors is None:
+        errors = []
+
+    # The tags of the next repositories are listed while the tags of
+    # the one before are probed, by as many workers again
+    reg = open_registry(registry, workers * 2)
+
+    # A tag is in use if a pod runs the manifest it refers to, by
+    # whatever name.  The index is updated with what we find.
+    index = DigestIndex.load(registry)
 
     if only is not None:
         repos = only
@@ -150,66 +387,294 @@ def examine_by_registry(image_report, only=None):
 
     if repos is None or len(repos) == 0:
         print("No repositories found")
-        return []
+        reg.close()
+        return errors
+
+    def tags_of_repos(list_pool):
+        # One (repo, None) after the tags of each repo, to know when
+        # it's done
+        for repo, tags in ordered_map(list_pool, reg.get_tags, repos, workers * 2):
+            for tag in tags:
+                yield (repo, tag)
+            yield (repo, None)
+
+    def probe(item):
+        (repo, tag) = item
+        if tag is None:
+            return None
+        return reg.get_manifest_health(repo, tag, get)
+
+    num_tags = 0
+    num_errors = 0
+    repo_in_use = False
+    tag_errors = []
+    tag_digests = {}
+    checked = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as list_pool, \
+         ThreadPoolExecutor(max_workers=workers) as pool:
+        for (repo, tag), health in ordered_map(pool, probe, tags_of_repos(list_pool), workers * 4):
+            spinner.next()
 
-    for repo in repos:
-        print("  REPO: %s%s\r" % (repo, clear_eol), end="")
+            if tag is not None:
+                num_tags += 1
+                checked += 1
 
-        num_tags = 0
-        num_errors = 0
-        repo_in_use = False
+                (digest, digest_status, manifest_status) = health
+                wrongs = probe_wrongs(digest, digest_status, manifest_status)
+                # Remember what a broken tag referred to
+                tag_digests[tag] = digest or index.digest_of(repo, tag)
 
-        tags = reg.get_tags(repo)
+                repo_tag = f'{repo}:{tag}'
+                in_use = used.in_use(repo, tag, digest or index.digest_of(repo, tag))
+                if in_use: repo_in_use = True
 
-        # NOTE! All errors that goes to the same file must have the
-        # same fields, for the sake of the CSV writer.
+                if len(wrongs) > 0:
+                    num_errors += 1
+                    tag_errors.append({ 'kind': 'tag', 'registry': registry,
+                                        'name': repo_tag, 'wrongs': wrongs,
+                                        'inuse': in_use })
 
-        if tags is None:
-            if len(find_image_by_repo(repo)) > 0:
-                errors.append({ 'kind': 'repository', 'name':
-                                repo, 'wrongs': 'no tags - but in use',
-                                'inuse': True })
-            else:
-                errors.append({ 'kind': 'repository', 'name': repo,
-                                'wrongs': 'no tags', 'inuse': False })
-            continue
+                if checked % 100 == 0:
+                    print("  REPO: %s, %d tags checked, %d errors%s\r" %
+                          (repo, checked, len(errors) + len(tag_errors), clear_eol), end="")
+                continue
 
-        for tag in tags:
-            spinner.next()
-            num_tags += 1
+            # All the tags of repo are done
+            if num_tags == 0:
+                errors.append({ 'kind': 'repository', 'registry': registry,
+                                'name': repo,
+                                'wrongs': 'no tags - but in use' if repo in used.repos else 'no tags',
+                                'inuse': repo in used.repos })
+
+            elif num_tags == num_errors:
+                errors.append({ 'kind': 'repository', 'registry': registry,
+                                'name': repo, 'wrongs': 'all tags unhealthy',
+                                'inuse': repo_in_use or repo in used.repos })
+
+            elif num_errors > 0:
+                errors.extend(tag_errors)
+                errors.append({ 'kind': 'repository', 'registry': registry,
+                                'name': repo, 'wrongs': 'See tags above',
+                                'inuse': repo_in_use })
+
+            if num_tags > 0:
+                index.replace_repo(repo, tag_digests)
+
+            num_tags = 0
+            num_errors = 0
+            repo_in_use = False
             tag_errors = []
+            tag_digests = {}
 
-            (digest, manifest) = get_manifest_health(repo, tag)
+    print("  %s: %d tags checked, %d errors%s" % (registry, checked, len(errors), clear_eol))
+    print("  %s: %s%s" % (registry, reg.stats(), clear_eol))
+    reg.close()
 
-            repo_tag = f'{repo}:{tag}'
-            in_use = repo_tag in image_report
-            if in_use: repo_in_use = True
+    index.save()
 
-            if digest.status_code != 200 or manifest.status_code != 200:
-                num_errors += 1
-                wrongs = []
-                if digest.status_code != 200:
-                    wrongs.append("no digest")
-                if manifest.status_code != 200:
-                    wrongs.append("no manifest")
+    return errors
 
-                tag_errors.append({ 'kind': 'tag', 'name': repo_tag,
-                                    'wrongs': wrongs, 'inuse': in_use })
 
-        repo_wrongs = 'See tags above'
+def wilson(errors, n, population, z=1.96):
+    """The Wilson score interval of the fraction errors / n, n being a
+    random sample of population.  The finite population correction
+    narrows it as the sample covers more of the population."""
 
-        if num_tags == num_errors:
-            if not repo_in_use:
-                repo_in_use = len(find_image_by_repo(repo)) > 0
+    if n == 0:
+        return (0.0, 1.0)
 
-            repo_wrongs = 'all tags unhealthy'
-        else:
-            errors.extend(tag_errors)
+    p = errors / n
+    if n >= population:
+        return (p, p)
 
-        errors.append({ 'kind': 'repository', 'name': repo,
-                        'wrongs': repo_wrongs, 'inuse': repo_in_use })
+    n = n * (population - 1) / (population - n)
 
-    return errors
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+
+    return (max(0.0, centre - half), min(1.0, centre + half))
+
+
+def sample_order(strata, rand):
+    """Order the items of all the strata (dict of stratum -> list of
+    items) so that any number of items from the start is a random
+    sample with each stratum represented by its share of the items.
+    Each stratum is shuffled and spread evenly over the order from a
+    random offset."""
+
+    keyed = []
+    for items in strata.values():
+        items = list(items)
+        rand.shuffle(items)
+        offset = rand.random()
+        keyed.extend(((rank + offset) / len(items), item) for rank, item in enumerate(items))
+
+    keyed.sort(key=lambda k: k[0])
+
+    return [ item for (_, item) in keyed ]
+
+
+def examine_by_sample(image_report, registry, used, only=None, workers=1, get=True,
+                      errors=None, budget=300):
+    """Check a random sample of the tags in the registry for budget
+    seconds and estimate the fraction of broken tags.
+
+    Listing the tags of a large registry can take the whole budget, so
+    the repositories are listed in random order for at most half of it
+    and the tags are sampled from the repositories listed.  The sample
+    is stratified by repository and by the tag being in use or not, so
+    every part of that gets its share.  The broken tags found are
+    appended to errors as in examine_by_registry.
+
+    Returns the estimates for the tags in use, the unused and all: The
+    number of tags, the number checked and found broken, the number
+    that timed out and are not in the estimate, and the estimated
+    broken fraction with its 95% confidence interval.  Under 'strata'
+    how many repositories were listed, and the counts of each
+    repository where broken tags were found.
+    """
+
+    if errors is None:
+        errors = []
+
+    deadline = time.monotonic() + budget
+    list_deadline = time.monotonic() + budget / 2
+
+    reg = open_registry(registry, workers)
+
+    index = DigestIndex.load(registry)
+
+    rand = random.Random()
+
+    repos = list(only if only is not None else reg.get_repositories())
+    rand.shuffle(repos)
+
+    def until_list_deadline():
+        for repo in repos:
+            if time.monotonic() >= list_deadline:
+                return
+            yield repo
+
+    strata = {}
+    listed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for repo, tags in ordered_map(pool, reg.get_tags, until_list_deadline(), workers * 2):
+            spinner.next()
+            listed += 1
+            for tag in tags:
+                in_use = used.in_use(repo, tag, index.digest_of(repo, tag))
+                strata.setdefault((repo, in_use), []).append((repo, tag, in_use))
+
+        order = sample_order(strata, rand)
+
+        print("  %s: %d tags in %d of %d repositories listed in %ds%s" %
+              (registry, len(order), listed, len(repos), budget - (deadline - time.monotonic()),
+               clear_eol))
+
+        def until_deadline():
+            for item in order:
+                if time.monotonic() >= deadline:
+                    return
+                yield item
+
+        def probe(item):
+            (repo, tag, _) = item
+            return reg.get_manifest_health(repo, tag, get)
+
+        # Checked, broken and timed out, by stratum.  A tag that timed
+        # out was not checked, counting it would make a slow registry
+        # look broken.
+        counts = { stratum: [0, 0, 0] for stratum in strata }
+
+        for (repo, tag, in_use), health in ordered_map(pool, probe, until_deadline(), workers * 4):
+            spinner.next()
+
+            (digest, digest_status, manifest_status) = health
+            wrongs = probe_wrongs(digest, digest_status, manifest_status)
+
+            if wrongs == [ "timeout" ]:
+                counts[(repo, in_use)][2] += 1
+            else:
+                counts[(repo, in_use)][0] += 1
+                if len(wrongs) > 0:
+                    counts[(repo, in_use)][1] += 1
+
+            if len(wrongs) > 0:
+                errors.append({ 'kind': 'tag', 'registry': registry,
+                                'name': f'{repo}:{tag}', 'wrongs': wrongs,
+                                'inuse': in_use })
+
+    print("  %s: %s%s" % (registry, reg.stats(), clear_eol))
+    reg.close()
+
+    estimates = {}
+    for name, groups in (('in use', [True]), ('unused', [False]), ('all', [True, False])):
+        tags = sum(len(items) for (_, u), items in strata.items() if u in groups)
+        (checked, broken, timeouts) = [ sum(c[i] for (_, u), c in counts.items() if u in groups)
+                                        for i in range(3) ]
+        (low, high) = wilson(broken, checked, tags)
+
+        estimates[name] = { 'tags': tags, 'checked': checked, 'broken': broken,
+                            'timeouts': timeouts,
+                            'fraction': broken / checked if checked else None,
+                            'low': low, 'high': high }
+
+        print("  %s: %s: %d of %d tags checked, %d broken, %d timed out, %.2f%% broken (95%%: %.2f%% - %.2f%%)%s" %
+              (registry, name, checked, tags, broken, timeouts,
+               100.0 * broken / checked if checked else 0.0, 100.0 * low, 100.0 * high, clear_eol))
+
+    # The estimates above are over all the strata, these are the
+    # strata that are the worst off
+    broken_strata = {}
+    for (repo, in_use), (checked, broken, timeouts) in sorted(counts.items()):
+        if broken > 0:
+            broken_strata[f'{repo} ({"in use" if in_use else "unused"})'] = \
+                { 'tags': len(strata[(repo, in_use)]), 'checked': checked, 'broken': broken,
+                  'timeouts': timeouts }
+
+    estimates['strata'] = { 'repositories': len(repos), 'listed': listed, 'strata': len(strata),
+                            'broken': broken_strata }
+
+    return estimates
+
+
+def examine(image_report, registry, by_host, args, errors):
+    """Check one registry in the way the options say, the errors are
+    appended to errors"""
+
+    used = by_host.get(registry, inventory.HostIndex())
+
+    only = None
+    if args.repository: only = args.repository
+
+    if args.sample:
+        estimates = examine_by_sample(image_report, registry, used, only, max(1, args.workers),
+                                      not args.quick, errors, args.sample)
+        errors.notes['sample'] = estimates
+        return errors
+
+    if args.by_registry:
+        return examine_by_registry(image_report, registry, used, only, max(1, args.workers),
+                                   not args.quick, errors)
+
+    cache = None
+    if args.incremental:
+        # Only what changed since the last run, and what was broken
+        cache = HealthCache.load(registry, healthy_ttl=float('inf'), failed_ttl=0,
+                                 full_every=args.full_recheck * 3600)
+    elif args.healthy_ttl > 0:
+        cache = HealthCache.load(registry, healthy_ttl=args.healthy_ttl * 60,
+                                 failed_ttl=args.failed_ttl * 60,
+                                 full_every=args.full_recheck * 3600)
+
+    blobs = None
+    if args.deep:
+        blobs = BlobCache.load(registry, args.blob_ttl * 3600)
+
+    return examine_by_report(image_report, registry, used, only, max(1, args.workers), cache, blobs,
+                             errors)
 
 
 def main():
@@ -217,6 +682,10 @@ def main():
     parser.add_argument('-R', '--by-registry', action='store_true',
                         help='Loop over the content of the registry instead of images.json. This finds errors like missing tags and manifests, e.g. registry corruption.',
                         default=False)
+    parser.add_argument('-S', '--sample', action='store', type=int, default=None,
+                        help='Check a random sample of the tags in the registry for this many seconds and estimate how many are broken')
+    parser.add_argument('-q', '--quick', action='store_true', default=False,
+                        help='With -R or -S only check that each tag has a digest, do not get the manifests')
     parser.add_argument('-r', '--repository', action="append",
                         help='Work on this repository instead  of all (can be repeated)')
     parser.add_argument('-o', '--old-age', action="store", type=int, default=31,
@@ -224,61 +693,105 @@ def main():
     parser.add_argument('-s', '--spinner', action="store", type=int, default=None,
                         help='Select what kind of progress spinner you prefer, default random')
     parser.add_argument('-a', '--always', action="store_true", default=False, help='Even if now errors Always write report files (default is to only write if errors are found)')
-    parser.add_argument('server', help='Registry server to check')
+    parser.add_argument('-P', '--parallel', action="store", type=int, default=None,
+                        help='Number of registries to check at the same time, default all')
+    parser.add_argument('-w', '--workers', action="store", type=int, default=1,
+                        help='Number of images to check at the same time in each registry, default 1')
+    parser.add_argument('-T', '--healthy-ttl', action="store", type=int, default=240,
+                        help='Minutes to trust that a healthy image is still healthy, default 240. 0 disables the health cache')
+    parser.add_argument('-F', '--failed-ttl', action="store", type=int, default=10,
+                        help='Minutes to trust that a broken image is still broken, default 10')
+    parser.add_argument('-I', '--incremental', action="store_true", default=False,
+                        help='Only check the images that are new or redeployed since the last run, and the broken ones. Overrides -T and -F')
+    parser.add_argument('-A', '--full-recheck', action="store", type=int, default=24,
+                        help='Hours between checking all images regardless of the health cache, default 24')
+    parser.add_argument('-D', '--deep', action="store_true", default=False,
+                        help='Also check that all the layers and config blobs of the images are there')
+    parser.add_argument('-B', '--blob-ttl', action="store", type=int, default=0,
+                        help='With --deep, hours to remember blobs that were found between runs, default 0 (only during the run)')
+    parser.add_argument('-t', '--timeout', action="store", type=int, default=30,
+                        help='Seconds to wait for the registry at most, default 30. Probes time out sooner once the normal latency is known')
+    parser.add_argument('-H', '--hedge', action="store_true", default=False,
+                        help='Ask again if a probe is slower than 95%% of them, and use the first answer')
+    parser.add_argument('-u', '--update', action="store", type=int, default=10,
+                        help='Publish the errors found so far this often, in seconds, default 10. 0 only publishes when done')
+    parser.add_argument('server', nargs='+', help='Registry server(s) to check')
     args = parser.parse_args()
 
     global spinner
-    global registry
-    global image_report
     global dirname
+    global registry_timeout
+    global hedge
 
     spinner = Spinner(kind=args.spinner)
-    registry = args.server
+    registry_timeout = args.timeout
+    hedge = args.hedge
 
     savedir = os.environ.get('REPORTDIR', '.')
-    print("Loading images list from %s/images.json" % savedir)
-    with open(f'{savedir}/images.json', "r") as f:
-        image_report = json.load(f)
+    images_path = inventory.newest_path(savedir)
+    print("Loading images list from %s" % images_path)
+    # Checking the registry itself only needs to know which images are in use
+    image_report = inventory.load_records(images_path, pods=not (args.by_registry or args.sample))
+    by_host = inventory.index_by_registry(image_report)
 
     spinner.next()
 
-    only=None
-    if args.repository: only=args.repository
-    
-    if args.by_registry:
-        errors = examine_by_registry(image_report, only)
+    servers = list(dict.fromkeys(args.server))
+
+    # The reports are written as the errors are found, in the
+    # directory they are published in
+    if savedir != '.':
+        dirname = savedir
     else:
-        errors = examine_by_report(image_report, only)
+        mkdir(dirname)
+
+    report = Report(dirname)
+
+    # The errors are reported in the order the registries were given
+    parts = [ report.part(server) for server in servers ]
+
+    with ThreadPoolExecutor(max_workers=args.parallel or len(servers)) as pool:
+        futures = [ pool.submit(examine, image_report, server, by_host, args, part)
+                    for server, part in zip(servers, parts) ]
+
+        # Publish what's found as we go, the most urgent images are
+        # checked first
+        if args.update > 0:
+            while len(wait(futures, timeout=args.update).not_done) > 0:
+                if report.publish_new():
+                    print("  Published %d errors so far%s" % (len(report), clear_eol))
 
     print()
-    
-    if len(errors) == 0:
+
+    failed = []
+    for server, future, part in zip(servers, futures, parts):
+        try:
+            future.result()
+        except (Exception, SystemExit) as e:
+            print("%s: FAILED: %s" % (server, e))
+            failed.append(server)
+            report.fail(server)
+            continue
+
+        if len(servers) > 1:
+            print("%s: %d images in use, %d errors" %
+                  (server, len(by_host.get(server, inventory.HostIndex()).images), len(part)))
+
+    if len(report) == 0:
         print("Nothing wrong here!")
 
-    if len(errors) > 0 or args.always:
+    if len(report) > 0 or args.always:
+        print("Found %d errors, writing reports to %s" % (len(report), dirname))
 
-        if savedir != '.':
-            print("Saving reports to %s" % savedir)
-            dirname = savedir
-        else:
-            mkdir(dirname)
-            
-        chdir(dirname)
-        print("Found %d errors, writing reports" % len(errors))
-
-        with open("registry-check.json", "w") as f:
-            f.write(json.dumps(errors, indent=2, sort_keys=True))
-        print("Wrote report to %s/%s" % (dirname, "registry-check.json"))
-
-        if len(errors) == 0:
-            errors.append({ 'errors': 'none' })
-
-        with open("registry-check.csv", "w") as f:
-            w = csv.DictWriter(f, errors[0].keys())
-            w.writeheader()
-            for e in errors:
-                w.writerow(e)
-        print("Wrote report to %s/%s" % (dirname, "registry-check.csv"))
+        for path in report.publish():
+            print("Wrote report to %s" % path)
+    else:
+        report.discard()
+        if dirname != savedir:
+            os.rmdir(dirname)
+
+    if len(failed) > 0:
+        sys.exit("Failed to check: %s" % ", ".join(failed))
 
 
 if __name__ == "__main__":
@@ -27,235 +27,684 @@
 #     ./registry-evictor.py -d docker.example.com 2>&1 | tee eviction-$(date '+%F-%T').log
 #   Without log:
 #     ./registry-evictor.py -d docker.example.com
+#   Several registries at once (log lines are prefixed with the registry):
+#     ./registry-evictor.py -d docker.example.com harbor.example.com
 # 
 
-import re
+import os
 import sys
 import json
+import time
+import queue
 import datetime
-import requests
+import resource
+import threading
 import argparse
 from keeprules import *
 from Spinner import Spinner
 from dateutil import parser
 from Registry import Registry
+from digestindex import DigestIndex
+import usedhistory
+from concurrent.futures import ThreadPoolExecutor
+import inventory
 
 spinner = Spinner()
-used_repo = {}
-used_repo_tag = {}
-repos = {}
 debug = False
 pause = False
+max_memory = None
+output_lock = threading.Lock()
 
-## Catalogue all the repos and tags
-    
-def repo_lookup(reg, repo_name):
-    """Look up the needed information from each repository:
-    - List of all tags
-    - The manifest info for each tag
-    - Creation date in order to sort by date
-    """
+# delete_most_manifests always keeps this many of the newest tags
+KEEP_NEWEST = 3
 
-    print("REPO %s" % repo_name)
 
-    if repo_name.startswith("/"):
-        sys.exit("Weirdness in repo_lookup")
+## Compact records of the scanned repos
 
-    if repo_name not in repos:
-        repos[repo_name] = {}
+def pack_digest(digest):
+    """sha256 digests are kept as 32 raw bytes instead of a 71
+    character string.  Other kinds of digests are kept as they are."""
 
-    tags = reg.get_tags(repo_name)
-    if tags is None or len(tags) == 0:
-        repos[repo_name]['_notags'] = True
-        return
+    if digest.startswith("sha256:") and len(digest) == 71:
+        return bytes.fromhex(digest[7:])
 
-    problems = 0
-    problem_tags = []
-    
-    for tag in tags:
-        tagkey = f'{repo_name}:{tag}'
-
-        spinner.next()
-        (tagdig, manifest, _) = reg.get_manifest(repo_name, tag)
-        
-        if len(manifest) == 0:
-            problems += 1
-            problem_tags.append(tag)
-            continue
-        
-        if "history" not in manifest:
-            print("*E* Weird manifest: %s / %s" % (tag, manifest))
-            sys.exit(1)
+    return digest
 
-        if tag not in repos[repo_name]:
-            repos[repo_name][tag] = {}
 
-        created = json.loads(manifest['history'][0]['v1Compatibility'])
-        repos[repo_name][tag]["created"] = parser.parse(created['created'])
-        repos[repo_name][tag]["digest"] = tagdig
+def unpack_digest(packed):
+    """Reverse of pack_digest"""
 
-    if problems > 0:
-        print("*E* %d problem tags ignored in %s (%s)" % (problems, repo_name, problem_tags))
+    if isinstance(packed, bytes):
+        return "sha256:" + packed.hex()
 
+    return packed
 
-# Eviction logic
 
-def delete_most_manifests(reg, repo_name):
-    """For repositories that are in use in kubernetes delete the tags we don't need.
+class Tag:
+    """What we need to know about a tag to evict it: The creation time
+    as seconds since the epoch and the packed digest.  created is None
+    if the repo was scanned without dates (see repo_lookup)."""
 
-    I.e., delete most tags, except:
-       - The 3 newest
-       - The ones in use
-       - The 2 newsest before the ones in use
-    """
+    __slots__ = ('created', 'packed')
 
-    # List all actuall tags, this excludes the ones starting in underscore
-    the_tags = list(filter(lambda x: not x.startswith("_"), \
-                           repos[repo_name].keys()) )
+    def __init__(self, created, digest):
+        self.created = created
+        self.packed = pack_digest(digest)
 
-    if len(the_tags) == 0:
-        print("* No some tags to delete")
-        return
 
-    # Get the tags sorted by time
-    tag_bytime = sorted(the_tags, key=lambda x: repos[repo_name][x]["created"])
+    @property
+    def digest(self):
+        return unpack_digest(self.packed)
+
+
+    def __repr__(self):
+        created = None
+        if self.created is not None:
+            created = datetime.datetime.fromtimestamp(self.created, datetime.timezone.utc).isoformat()
+
+        return "{created: %s, digest: %s}" % (created, self.digest)
+
+
+class Repo:
+    """The scanned tags of one repository.  tags is a dict of tag name
+    to Tag.  Problem tags (no manifest) are listed in problems.  If
+    keep_all is set the scan found that nothing in the repo will be
+    deleted and stopped early, tags then has the tag names but no Tag
+    records.  The object is dropped as soon as the repo has been
+    evicted."""
+
+    __slots__ = ('name', 'tags', 'notags', 'problems', 'keep_all')
 
-    print("* Delete some tags in repo (newer last): %s" % tag_bytime)
+    def __init__(self, name):
+        self.name = name
+        self.tags = {}
+        self.notags = False
+        self.problems = []
+        self.keep_all = None
+
+
+## Memory use
+
+def rss_mb():
+    """Current resident set size of the process in MB. Only Linux has
+    /proc, elsewhere the peak is the best we can do."""
 
-    # Keep the 3 newest tags:
-    tags_to_keep = { tag_bytime[-1]: True }
     try:
-        tags_to_keep[tag_bytime[-2]] = True
-        tags_to_keep[tag_bytime[-3]] = True
-    except IndexError:
-        pass
-
-    # Want to delete all tags but the 3 newest before the ones in use
-    used_tags = {}
-    for tag in tag_bytime:
-        repo_tag = f'{repo_name}:{tag}'
-        if repo_tag not in used_repo_tag:
-            continue
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process in MB"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def check_memory(where):
+    """Stop if the process uses more memory than --max-memory.  This is
+    only called between repos, so nothing is half evicted when we
+    stop."""
+
+    if max_memory is None:
+        return
+
+    rss = rss_mb()
+    if rss > max_memory:
+        sys.exit("*E* Using %d MB of memory after %s, more than --max-memory %d MB. Stopping." %
+                 (rss, where, max_memory))
+
+
+## The per registry eviction state
+#
+# One Evictor for each registry we work on.  They can run concurrently
+# in separate threads, each with its own scan/evict pipeline.
+
+class Evictor:
+    """Scan and evict one registry.
+
+    - reg: The Registry
+    - used: The inventory.HostIndex of the images used from this
+      registry
+    - index: The DigestIndex of the registry
+    - seen: usedhistory.Window of the images seen in use lately,
+      or None
+    - prefix: Printed in front of all output lines, to tell the
+      registries apart when several run at the same time
+    """
+
+    def __init__(self, reg, used, prefix="", seen=None):
+        self.reg = reg
+        self.used = used
+        self.seen = seen
+        self.prefix = prefix
+        self.index = None
+        # What a dry run would have deleted, as (repo, digest)
+        self.pretend_deleted = set()
+        self.scan = Stage("scan")
+        self.evict = Stage("evict")
+
+
+    def log(self, msg):
+        # One write per line, under a lock, so lines from registries
+        # running at the same time don't get mixed up
+        with output_lock:
+            sys.stdout.write("%s%s\n" % (self.prefix, msg))
+
+
+    ## Catalogue all the repos and tags
+
+    def needs_dates(self, repo_name):
+        """Only repos that are used, or have keep rules, are sorted by time
+        in delete_most_manifests.  The rest are deleted whole and only need
+        the digests."""
+
+        return repo_name in self.used.repos or keep_repo_by_rule(repo_name)
+
+
+    def nothing_to_delete(self, repo_name, tags):
+        """Can we tell from the tag names alone that nothing in the repo
+        will be deleted?  Returns the reason if so, otherwise None."""
+
+        if len(tags) <= KEEP_NEWEST:
+            return "only %d tags" % len(tags)
+
+        if all(self.used.in_use(repo_name, tag) or keep_by_rule(repo_name, tag)
+               for tag in tags):
+            return "all tags in use or kept by rule"
+
+        return None
+
+
+    def repo_lookup(self, repo_name):
+        """Look up the needed information from each repository:
+        - List of all tags
+        - The digest of each tag
+        - Creation date in order to sort by date, but only for repos that
+          need it (see needs_dates).  This is the expensive part since it
+          needs the whole manifest.  The other repos make do with a HEAD
+          request per tag.
+
+        If it's clear that nothing in the repo is going to be deleted the
+        manifests are not looked up at all.
 
-        if debug: print("  ! Tag %s is in use" % tag)
-        used_idx = tag_bytime.index(tag)
-        tags_to_keep[tag] = True
+        This runs in the scanner thread so it does not print anything
+        about the repo, problems are saved in the Repo and reported by
+        evict_repo.  Returns the Repo.
+        """
+
+        reg = self.reg
+
+        if repo_name.startswith("/"):
+            sys.exit("Weirdness in repo_lookup")
+
+        repo = Repo(repo_name)
+
+        tags = reg.get_tags(repo_name)
+        if tags is None or len(tags) == 0:
+            repo.notags = True
+            return repo
+
+        if not self.needs_dates(repo_name):
+            for tag in tags:
+                spinner.next()
+                digest = reg.get_digest(repo_name, tag)
+                if digest == "":
+                    repo.problems.append(tag)
+                    continue
+
+                repo.tags[tag] = Tag(None, digest)
+
+            self.index.replace_repo(repo_name, { tag: t.digest for tag, t in repo.tags.items() })
+            return repo
+
+        repo.keep_all = self.nothing_to_delete(repo_name, tags)
+        if repo.keep_all is not None:
+            # Leave what the index knows about the repo as it is
+            repo.tags = dict.fromkeys(tags)
+            return repo
+
+        for tag in tags:
+            spinner.next()
+            (tagdig, manifest, _) = reg.get_manifest(repo_name, tag)
+
+            if len(manifest) == 0:
+                repo.problems.append(tag)
+                continue
+
+            if "history" not in manifest:
+                self.log("*E* Weird manifest: %s / %s" % (tag, manifest))
+                sys.exit(1)
+
+            created = json.loads(manifest['history'][0]['v1Compatibility'])
+            repo.tags[tag] = Tag(parser.parse(created['created']).timestamp(), tagdig)
+
+        self.index.replace_repo(repo_name, { tag: t.digest for tag, t in repo.tags.items() })
+
+        return repo
+
+
+    # Eviction logic
+
+    def delete_tag(self, repo, tag):
+        """Delete the manifest repo:tag refers to, unless the same digest
+        is used by a tag in some other repository.  Deleting the digest
+        removes all the tags in the repo that refer to it, so those are
+        not deleted again.  Returns the number of manifests deleted."""
+
+        repo_tag = f'{repo.name}:{tag}'
+        digest = repo.tags[tag].digest
+
+        if self.index.digest_of(repo.name, tag) is None or \
+           (repo.name, digest) in self.pretend_deleted:
+            self.log("+ Already deleted by digest: %s" % repo_tag)
+            return 0
+
+        # A pod can run the manifest by digest, whatever tag it was
+        # pulled by
+        if self.used.in_use(repo.name, digest=digest):
+            self.log("+ Keep by digest in use: %s (%s)" % (repo_tag, digest))
+            return 0
+
+        # Weekly jobs and such are not running when the inventory is
+        # made, but the history remembers them
+        host = self.reg.registry
+        if self.seen is not None and \
+           (f'{host}/{repo_tag}' in self.seen or f'{host}/{repo.name}@{digest}' in self.seen):
+            self.log("+ Keep by history, in use lately: %s" % repo_tag)
+            return 0
+
+        in_use = [ f'{r}:{t}' for (r, t) in self.index.others(repo.name, digest)
+                   if self.used.in_use(r, t, digest) ]
+        if len(in_use) > 0:
+            self.log("+ Keep by digest used in other repositories: %s (%s)" %
+                     (repo_tag, ", ".join(in_use)))
+            return 0
+
+        self.log("? %s: %s" % (tag, repo.tags[tag]))
+        self.log("- Delete %s" % repo_tag)
+
+        if not self.reg.delete_manifest(repo.name, digest):
+            if not self.reg.do_delete:
+                # The index is of what is really in the registry, a
+                # dry run just remembers what it would have deleted
+                self.pretend_deleted.add((repo.name, digest))
+                return 1
+            return 0
+
+        self.index.forget(repo.name, digest)
+        return 1
+
+
+    def delete_most_manifests(self, repo):
+        """For repositories that are in use in kubernetes delete the tags we don't need.
+
+        I.e., delete most tags, except:
+           - The 3 newest
+           - The ones in use
+           - The 2 newsest before the ones in use
+        """
+
+        repo_name = repo.name
+
+        if len(repo.tags) == 0:
+            self.log("* No some tags to delete")
+            return 0
+
+        # Get the tags sorted by time
+        tag_bytime = sorted(repo.tags, key=lambda x: repo.tags[x].created)
+
+        self.log("* Delete some tags in repo (newer last): %s" % tag_bytime)
+
+        # Keep the 3 newest tags:
+        tags_to_keep = { tag_bytime[-1]: True }
         try:
-            tags_to_keep[tag_bytime[used_idx-1]] = True
-            tags_to_keep[tag_bytime[used_idx-2]] = True
+            tags_to_keep[tag_bytime[-2]] = True
+            tags_to_keep[tag_bytime[-3]] = True
         except IndexError:
             pass
 
-    print("* Tags to keep: %s" % list(tags_to_keep.keys()))
+        # Want to delete all tags but the 3 newest before the ones in use
+        for tag in tag_bytime:
+            if not self.used.in_use(repo_name, tag, repo.tags[tag].digest):
+                continue
 
-    if len(tags_to_keep) == len(tag_bytime):
-        print("* Keeping all tags, nothing to do")
-        return
+            if debug: self.log("  ! Tag %s is in use" % tag)
+            used_idx = tag_bytime.index(tag)
+            tags_to_keep[tag] = True
+            try:
+                tags_to_keep[tag_bytime[used_idx-1]] = True
+                tags_to_keep[tag_bytime[used_idx-2]] = True
+            except IndexError:
+                pass
 
-    if pause: any_key = input("Press enter to proceed")
+        self.log("* Tags to keep: %s" % list(tags_to_keep.keys()))
 
-    digests_to_keep = []
+        if len(tags_to_keep) == len(tag_bytime):
+            self.log("* Keeping all tags, nothing to do")
+            return 0
 
-    # Sometimes multiple tags have the same digest, so we need to keep
-    # off all of those tags.
-    for tag in tags_to_keep:
-        digests_to_keep.append(repos[repo_name][tag]['digest'])
+        if pause: any_key = input("Press enter to proceed")
 
-    # Delete the tags, except the ones we want to keep
-    for tag in tag_bytime:
-        repo_tag = f'{repo_name}:{tag}'
-        if tag in tags_to_keep:
-            print("+ Keep by tag: %s" % repo_tag)
-            continue
+        # Sometimes multiple tags have the same digest, so we need to keep
+        # off all of those tags.
+        digests_to_keep = { repo.tags[tag].packed for tag in tags_to_keep }
 
-        if repos[repo_name][tag]['digest'] in digests_to_keep:
-            print("+ Keep by digest: %s" % repo_tag)
-            continue
+        deleted = 0
 
-        if keep_by_rule(repo_name, tag):
-            print("+ Keep by rule: %s" % repo_tag)
-            continue
-        
-        print("? %s: %s" % (tag, repos[repo_name][tag]))
-        print("- Delete %s" % repo_tag)
-        reg.delete_manifest(repo_name, repos[repo_name][tag]['digest'])
-    
-
-def delete_all_manifests(reg, repo_name):
-    """Delete all manifests refered to all the tags in a repo.  This
-    should only be used on repositories that are not used by k8s.
-    """
+        # Delete the tags, except the ones we want to keep
+        for tag in tag_bytime:
+            repo_tag = f'{repo_name}:{tag}'
+            if tag in tags_to_keep:
+                self.log("+ Keep by tag: %s" % repo_tag)
+                continue
 
-    tags = list(repos[repo_name].keys())
+            if repo.tags[tag].packed in digests_to_keep:
+                self.log("+ Keep by digest: %s" % repo_tag)
+                continue
 
-    if len(tags) == 0:
-        print("* No tags to delete")
-        return
+            if keep_by_rule(repo_name, tag):
+                self.log("+ Keep by rule: %s" % repo_tag)
+                continue
 
-    print("* Delete all tags: %s" % tags)
-    if pause: any_key = input("Press enter to proceed")
+            deleted += self.delete_tag(repo, tag)
 
-    for tag in repos[repo_name]:
-        if keep_by_rule(repo_name, tag):
-            print("+ Keep by rule: %s" % repo_tag)
-            continue
+        return deleted
 
-        repo_tag = f'{repo_name}:{tag}'
-        print("- Delete %s" % repo_tag)
-        reg.delete_manifest(repo_name, repos[repo_name][tag]['digest'])
 
+    def delete_all_manifests(self, repo):
+        """Delete all manifests refered to all the tags in a repo.  This
+        should only be used on repositories that are not used by k8s.
+        """
 
-def evict_repo(reg, repo_name):
-    """Fint out how much should be deleted and call the apropriate function.
-    For unused repos: all the tags
-    For used repos: just some of the tags"""
+        repo_name = repo.name
+        tags = list(repo.tags.keys())
 
-    if "_notags" in repos[repo_name]:
-        print(" * Repo %s has no tags, nothing to do" % repo_name)
-        return
+        if len(tags) == 0:
+            self.log("* No tags to delete")
+            return 0
 
-    if repo_name in used_repo or keep_repo_by_rule(repo_name):
-        delete_most_manifests(reg, repo_name)
-        return
+        self.log("* Delete all tags: %s" % tags)
+        if pause: any_key = input("Press enter to proceed")
+
+        deleted = 0
+
+        for tag in tags:
+            repo_tag = f'{repo_name}:{tag}'
+            if keep_by_rule(repo_name, tag):
+                self.log("+ Keep by rule: %s" % repo_tag)
+                continue
+
+            deleted += self.delete_tag(repo, tag)
+
+        return deleted
+
+
+    def evict_repo(self, repo):
+        """Fint out how much should be deleted and call the apropriate function.
+        For unused repos: all the tags
+        For used repos: just some of the tags
+
+        Returns the number of manifests deleted."""
+
+        repo_name = repo.name
+
+        self.log("REPO %s" % repo_name)
+
+        if repo.notags:
+            self.log(" * Repo %s has no tags, nothing to do" % repo_name)
+            return 0
+
+        if len(repo.problems) > 0:
+            self.log("*E* %d problem tags ignored in %s (%s)" %
+                     (len(repo.problems), repo_name, repo.problems))
+
+        if repo.keep_all is not None:
+            self.log("* Keeping all tags (%s), nothing to do: %s" %
+                     (repo.keep_all, list(repo.tags)))
+            return 0
+
+        if self.needs_dates(repo_name):
+            return self.delete_most_manifests(repo)
+
+        return self.delete_all_manifests(repo)
+
+
+    # The scan/evict pipeline.  Looking up a repo is a lot of slow
+    # requests to the registry, and so is deleting.  So the next repos
+    # are scanned in separate threads while the current one is
+    # evicted.  The queue between them is bounded so we never hold
+    # more than a few scanned repos in memory, and each repo is dropped
+    # once it has been evicted.
+
+    def scanner(self, repo_names, work):
+        """Producer: Look up the repos and queue them for eviction.  Any
+        exception, including the SystemExit of sys.exit, is passed on in
+        the queue so the evicting thread can raise it again.  repo_names
+        is a iterator shared by all the scanners."""
+
+        stage = self.scan
+
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    repo_name = next(repo_names)
+                except StopIteration:
+                    break
+
+                repo = self.repo_lookup(repo_name)
+                check_memory("scanning %s" % repo_name)
+                scanned = time.monotonic()
+                work.put(repo)
+
+                with stage.lock:
+                    stage.tags += len(repo.tags) + len(repo.problems)
+                    stage.busy += scanned - start
+                    stage.waited += time.monotonic() - scanned
+                    stage.repos += 1
+
+        except BaseException as e:
+            work.put(e)
+            return
+
+        work.put(None)
+
+
+    def run(self, repo_names, depth, scanners=1):
+        """Consumer: Evict the repos in the order the scanners produce
+        them.  The digest index is loaded first and saved at the end,
+        dry run or not."""
+
+        # Start from the index saved by the last scan so digests shared
+        # with repositories we have not scanned yet are known
+        self.index = DigestIndex.load(self.reg.registry)
+        self.log("Loaded %d digests from the digest index" % len(self.index))
+
+        try:
+            self.pipeline(repo_names, depth, scanners)
+        finally:
+            # A dry run scans the registry just the same, what it
+            # pretended to delete is not forgotten
+            self.index.save()
+            self.log("Saved %d digests to the digest index" % len(self.index))
+
+
+    def pipeline(self, repo_names, depth, scanners):
+        work = queue.Queue(maxsize=depth)
+        evict = self.evict
+
+        # The scanners take turns taking the next repo name
+        shared = SharedIterator(repo_names)
+
+        producers = [ threading.Thread(target=self.scanner, name="scanner-%d" % n,
+                                       daemon=True, args=(shared, work))
+                      for n in range(scanners) ]
+        for p in producers:
+            p.start()
+
+        running = scanners
+        while running > 0:
+            start = time.monotonic()
+            repo = work.get()
+            got = time.monotonic()
+            evict.waited += got - start
+
+            if repo is None:
+                running -= 1
+                continue
+
+            if isinstance(repo, BaseException):
+                raise repo
+
+            evict.deleted += self.evict_repo(repo)
+            evict.tags += len(repo.tags) + len(repo.problems)
+            evict.repos += 1
+            evict.busy += time.monotonic() - got
+
+            check_memory("evicting %s" % repo.name)
+            # Let go of the repo before waiting for the next one
+            repo = None
+
+        for p in producers:
+            p.join()
+
+
+    def report(self):
+        """Report the throughput of both stages"""
 
-    delete_all_manifests(reg, repo_name)
+        self.log(self.scan.report())
+        self.log(self.evict.report())
 
+        # If the scanners spend their time waiting on a full queue the
+        # eviction is what holds us back, and the other way around.
+        if self.scan.waited > self.evict.waited:
+            self.log("= Bottleneck: evict (deleting is slower than scanning)")
+        else:
+            self.log("= Bottleneck: scan (scanning is slower than deleting)")
 
-def load_image_list(reg):
-    """Load image list from json file previously written by
-    kubernetes-inventory.py"""
 
-    images = {}
+class SharedIterator:
+    """A iterator that can be shared between threads"""
 
-    # This is the list of image:tags we use in kubernetes
-    with open("images.json", "r") as f:
-        images = json.loads(f.read())
+    def __init__(self, iterable):
+        self.it = iter(iterable)
+        self.lock = threading.Lock()
 
-    if len(images) < 10:
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        with self.lock:
+            return next(self.it)
+
+
+class Stage:
+    """Throughput counters for one stage of the scan/evict pipeline.
+    busy is the time spent doing the work of the stage, waited is the
+    time spent waiting for the other stage (on a full or empty queue).
+    With several scanners these are summed over all of them."""
+
+    def __init__(self, name):
+        self.name = name
+        self.repos = 0
+        self.tags = 0
+        self.deleted = 0
+        self.busy = 0.0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+
+    def add(self, other):
+        self.repos += other.repos
+        self.tags += other.tags
+        self.deleted += other.deleted
+        self.busy += other.busy
+        self.waited += other.waited
+
+
+    def report(self):
+        rate = self.tags / self.busy if self.busy > 0 else 0.0
+        return "= %s: %d repos, %d tags, %d deleted, busy %.1fs (%.1f tags/s), waited %.1fs" % \
+            (self.name, self.repos, self.tags, self.deleted, self.busy, rate, self.waited)
+
+
+def load_image_list():
+    """Load image list previously written by k8s-inventory.py and
+    index it by registry host"""
+
+    # This is the list of image:tags we use in kubernetes.  Which pods
+    # use them does not matter here.
+    images = inventory.load_images(pods=False)
+
+    if inventory.count_images(images) < 10:
         sys.exit("The image list seems unreasonably short!")
 
-    regPrefix = f'{reg.registry}/'
+    # Images used in the missing clusters would look unused
+    if '_partial' in images:
+        sys.exit("The image list is missing some clusters (%s), refusing to evict!" %
+                 ", ".join(images['_partial']))
+
+    return inventory.index_by_registry(images)
 
-    for i in images:
-        if not i.startswith(regPrefix):
-            continue
-        
-        repo_tag = i.replace(regPrefix,"",1)
 
-        # A bit of paranoid sanity checking
-        if repo_tag == i:
-            sys.exit("That's weird!")
-        i = None # Just to be sure we don't use it by mistake
+def load_history(days):
+    """The images seen in use in the last days days, according to
+    the used-history directory, or None if there is no history"""
 
-        if repo_tag.startswith("/"):
-            sys.exit("That's weird II!")
+    if days <= 0:
+        return None
 
-        (repo, tag) = repo_tag.split(":")
-        used_repo[repo] = True
-        used_repo_tag[repo_tag] = True
+    history = usedhistory.UsedHistory.load(days=days)
+    seen = history.window(days)
+    if len(seen) == 0:
+        print("No history of images in use in %s, only using the image list" % history.path)
+        return None
 
-    return images
+    false_positives = seen.false_positives()
 
+    print("Using the history of images in use for the last %d days (%d days recorded, %.2g%% false positives)" %
+          (days, len(seen), false_positives * 100))
+
+    if false_positives > usedhistory.WARN_FALSE_POSITIVES:
+        print("WARNING: The history of the last %d days gives about %.0f%% false positives, that many "
+              "of the unused tags will be kept as if they were used.  Some days had a lot more images "
+              "in use than their filters in %s were sized for, use a shorter -H" %
+              (days, false_positives * 100, history.path), file=sys.stderr)
+
+    return seen
+
+
+def evict_registry(server, by_host, args, prefix, seen=None):
+    """Set up and run the Evictor for one registry, returns it for
+    the summary"""
+
+    reg = Registry(server, args.delete)
+    # The Registry prints without the prefix, so only let it talk if
+    # there is just one registry
+    reg.verbose = prefix == ""
+    reg.debug = debug
+
+    ev = Evictor(reg, by_host.get(reg.registry, inventory.HostIndex()), prefix, seen)
+    ev.log("Registry %s: %d images in use in %d repositories" %
+           (server, len(ev.used.images), len(ev.used.repos)))
+
+    repo_names = args.repository or reg.get_repositories()
+
+    ev.run(repo_names, max(1, args.queue), max(1, args.workers))
+    ev.report()
+
+    reg.close()
+
+    return ev
 
 
 def main():
@@ -268,34 +717,76 @@ def main():
                         help='Debug', default=False)
     parser.add_argument('-p', '--pause', action='store_true', \
                         help='Pause before (possible) delete in each registry', default=False)
-    parser.add_argument('server', help="Registry server to check")
+    parser.add_argument('-q', '--queue', action='store', type=int, default=2, \
+                        help='Number of scanned repositories to keep ready for eviction, default 2')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=1, \
+                        help='Number of repositories to scan at the same time in each registry, default 1')
+    parser.add_argument('-P', '--parallel', action='store', type=int, default=None, \
+                        help='Number of registries to work on at the same time, default all')
+    parser.add_argument('-m', '--max-memory', action='store', type=int, default=None, \
+                        help='Stop (between repositories) if using more than this many MB of memory')
+    parser.add_argument('-H', '--history-days', action='store', type=int, default=30, \
+                        help='Keep images seen in use in the last this many days (see used-history/), 0 to not, default 30')
+    parser.add_argument('server', nargs='+', help="Registry server(s) to evict from")
     args = parser.parse_args()
 
     global debug
     global pause
+    global max_memory
     debug = args.debug
     pause = args.pause
-
-    global reg
-    reg = Registry(args.server, args.delete)
-    reg.verbose = True
-    reg.debug = debug
+    max_memory = args.max_memory
 
     load_keep_list()
-    images = load_image_list(reg)
+    by_host = load_image_list()
+    seen = load_history(args.history_days)
 
     if not args.delete:
         print("***Not evicting anything, just looking around***")
     else:
         print("***WILL EVICT IMAGES!!!!***")
 
-    repos = args.repository or reg.get_repositories()
-
     sys.stdout.reconfigure(line_buffering=True)
 
-    for repo_name in repos:
-        repo_lookup(reg, repo_name)
-        evict_repo(reg, repo_name)
+    servers = list(dict.fromkeys(args.server))
+    parallel = args.parallel or len(servers)
+
+    # Pausing for input only makes sense for one registry at a time
+    if pause:
+        parallel = 1
+
+    prefixes = { server: ("[%s] " % server if len(servers) > 1 else "") for server in servers }
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = { server: pool.submit(evict_registry, server, by_host, args, prefixes[server], seen)
+                    for server in servers }
+
+    scan = Stage("scan")
+    evict = Stage("evict")
+    failed = []
+
+    print("= Summary:")
+    for server in servers:
+        try:
+            ev = futures[server].result()
+        except (Exception, SystemExit) as e:
+            print("= %s: FAILED: %s" % (server, e))
+            failed.append(server)
+            continue
+
+        print("= %s: %d repos, %d tags, %d deleted" %
+              (server, ev.evict.repos, ev.evict.tags, ev.evict.deleted))
+        scan.add(ev.scan)
+        evict.add(ev.evict)
+
+    if len(servers) > 1:
+        print(scan.report())
+        print(evict.report())
+
+    print("= Peak RSS: %d MB" % peak_rss_mb())
+
+    if len(failed) > 0:
+        sys.exit("Failed registries: %s" % ", ".join(failed))
 
 
 if __name__ == "__main__":
@@ -10,10 +10,13 @@ import socket
 import requests
 import argparse
 import Registry
+from digestindex import DigestIndex
 
 def main():
     parser = argparse.ArgumentParser(description='Delete registry tags')
     parser.add_argument('server', help='Registry server')
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='Delete even if other tags refer to the same digest')
     parser.add_argument('image', action='store', nargs='+', help='Image(s) to delete')
     args = parser.parse_args()
 
@@ -30,17 +33,45 @@ def main():
     reg.do_delete = True
     reg.verbose = True
 
+    # The index is saved by the evictor. Deleting a digest deletes
+    # every tag in the repository that refers to it, so look before
+    # we leap.
+    index = DigestIndex.load(reg.registry)
+
     for image_tag in args.image:
 
         if "@" in image_tag:
             (repository, digest) = image_tag.split("@")
+            tag = None
+        else:
+            (repository, tag) = image_tag.split(":")
+            digest, _, _ = reg.get_manifest(repository, tag)
+
+        if digest == "":
+            print(f"No digest for {image_tag}, can't delete it")
+            continue
+
+        also = [ t for t in index.tags(repository, digest) if t != tag ]
+        others = [ f'{r}:{t}' for (r, t) in index.others(repository, digest) ]
+
+        if len(others) > 0:
+            print(f"Note: {digest} is also used in other repositories: {', '.join(others)}")
 
-        (repository, tag) = image_tag.split(":")
-        digest, _, _ = reg.get_manifest(repository, tag)
+        if len(also) > 0:
+            print(f"This will also delete these tags in {repository}: {', '.join(also)}")
+            if not args.force:
+                print(f"Not deleting {image_tag}, use -f to delete anyway")
+                continue
 
         print(f"Deleting {repository}:{digest}")
 
-        reg.delete_manifest(repository, digest)
-        
+        if reg.delete_manifest(repository, digest):
+            index.forget(repository, digest)
+
+    if len(index) > 0:
+        index.save()
+
+    reg.close()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,85 @@
+#
+# Files saved in the report directory
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+
+"""Where the tools keep their files, REPORTDIR or the current
+directory, and how they are saved: A file is written under a temporary
+name and renamed over the old one, so readers never see half a file.
+The temporary name has the process id in it, so two runs at the same
+time don't write to the same temporary file.
+
+Usage:
+   from reportfiles import report_path, load_json, atomic_write_json
+
+   path = report_path("digest-index-docker.example.com.json")
+   saved = load_json(path, {})
+   ...
+   atomic_write_json(path, saved, sort_keys=True)
+"""
+
+import os
+import sys
+import json
+
+
+def report_path(name, savedir=None):
+    """Where the file name is, in savedir or by default REPORTDIR or
+    the current directory"""
+
+    if savedir is None:
+        savedir = os.environ.get('REPORTDIR', '.')
+
+    return f'{savedir}/{name}'
+
+
+def tmp_path(path):
+    """The temporary name to write path under before it is renamed
+    into place"""
+
+    return f'{path}.{os.getpid()}.tmp'
+
+
+def remove_tmp(tmp):
+    """Remove a temporary file that was not renamed into place"""
+
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+
+
+def load_json(path, default=None):
+    """The JSON saved in path.  If there is no such file, or it is not
+    valid JSON, default is returned."""
+
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except json.decoder.JSONDecodeError:
+        print("%s is not valid JSON, ignoring it" % path, file=sys.stderr)
+        return default
+
+
+def atomic_write(path, data):
+    """Save data, bytes, in path atomically"""
+
+    tmp = tmp_path(path)
+
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        remove_tmp(tmp)
+        raise
+
+
+def atomic_write_json(path, data, **dump_args):
+    """Save data as JSON in path atomically.  dump_args are given to
+    json.dumps."""
+
+    atomic_write(path, json.dumps(data, **dump_args).encode('utf-8'))
@@ -0,0 +1,320 @@
+#
+# History of the images that have been in use
+#
+# (C) 2024, Nicolai Langfeldt, Schibsted Products and Technology
+#
+
+"""A compact record of which images have been in use over the last
+months, so the evictor does not delete the image of a weekly job just
+because it was not running when the inventory was made.
+
+Each day the images seen in use ("host/repo:tag" and
+"host/repo@digest") are added to a Bloom filter for that day.  A
+Bloom filter answers "was this seen?" in constant time with a fixed
+size, at the price of some false positives: A image that was never
+seen may be reported as seen.  For the evictor that only means keeping
+a tag that could have been deleted.  There are never false negatives.
+
+The filter of a day is sized from the number of images in use when it
+is made, see BITS_PER_ITEM.  The filters are saved in the
+used-history directory in REPORTDIR (or the current directory), one
+file per day, so adding to today's filter only writes today's file.
+Days older than the kept number of days are removed when new images
+are added.
+
+Usage:
+   import usedhistory
+   from usedhistory import UsedHistory
+
+   usedhistory.record_inventory(images, keep_days=90)
+
+   history = UsedHistory.load(days=30)
+   seen = history.window(30)
+   if "docker.example.com/ops/certmon:dc23f22" in seen:
+       ...
+"""
+
+import os
+import hashlib
+from datetime import datetime, timedelta, timezone
+import inventory
+from reportfiles import report_path, atomic_write
+
+# A day's filter has this many bits per image in use when it is made,
+# room for twice as many at 16 bits each.  With 7 hashes that is about
+# 1 false positive in 90000 a day, and 1 in 3000 for a window of 30
+# days, while the images in use do not double during the day.  20000
+# images in use is 80KB a day.
+BITS_PER_ITEM = 32
+MIN_BITS = 1 << 16
+DEFAULT_HASHES = 7
+
+# Above this false positive rate of a window the evictor warns, too
+# many unused tags are kept
+WARN_FALSE_POSITIVES = 0.01
+
+SUFFIX = ".bloom"
+
+
+def history_path(savedir=None):
+    """Where the used-history directory is, REPORTDIR or the current
+    directory"""
+
+    return report_path('used-history', savedir)
+
+
+def bits_for(count):
+    """The size of a filter for a day with count images in use"""
+
+    return (max(MIN_BITS, count * BITS_PER_ITEM) + 63) // 64 * 64
+
+
+def _hash(item):
+    # Double hashing: Two 64 bit hashes from one blake2b give all the
+    # bit positions, in a filter of any size
+    d = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+
+    return (int.from_bytes(d[:8], 'little'), int.from_bytes(d[8:], 'little') | 1)
+
+
+def _oldest(days):
+    """The first day of the last days days, today is day 0"""
+
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+class BloomFilter:
+    """A Bloom filter of size bits using hashes hash functions"""
+
+    __slots__ = ('bits', 'size', 'hashes')
+
+    def __init__(self, size, hashes=DEFAULT_HASHES, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(size // 8)
+
+
+    def _positions(self, hashed):
+        (h1, h2) = hashed
+
+        return [ (h1 + i * h2) % self.size for i in range(self.hashes) ]
+
+
+    def add(self, item):
+        """Add the item, returns True if it was not there already"""
+
+        new = False
+        for pos in self._positions(_hash(item)):
+            bit = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & bit:
+                self.bits[pos >> 3] |= bit
+                new = True
+
+        return new
+
+
+    def has(self, hashed):
+        """Is the item with the given _hash in the filter"""
+
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(hashed))
+
+
+    def __contains__(self, item):
+        return self.has(_hash(item))
+
+
+    def fill(self):
+        """The fraction of the bits that are set.  The false positive
+        rate is about fill ** hashes."""
+
+        return bin(int.from_bytes(self.bits, "little")).count("1") / self.size
+
+
+    def false_positives(self):
+        """The estimated false positive rate"""
+
+        return self.fill() ** self.hashes
+
+
+    def to_bytes(self):
+        """The filter as saved: A line with the size and hashes, and
+        the bits"""
+
+        return b"%d %d\n" % (self.size, self.hashes) + bytes(self.bits)
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        (header, bits) = data.split(b"\n", 1)
+        (size, hashes) = header.split()
+
+        return cls(int(size), int(hashes), bits)
+
+
+class Window:
+    """The filters of the days in a window, a item is in the window if
+    it is in any of them.  Each item is hashed once whatever the number
+    of days."""
+
+    def __init__(self, blooms):
+        self.blooms = list(blooms)
+
+
+    def __len__(self):
+        return len(self.blooms)
+
+
+    def __contains__(self, item):
+        hashed = _hash(item)
+
+        return any(bloom.has(hashed) for bloom in self.blooms)
+
+
+    def false_positives(self):
+        """The estimated false positive rate, a item that was never
+        seen is a false positive if any day says it was"""
+
+        none = 1.0
+        for bloom in self.blooms:
+            none *= 1.0 - bloom.false_positives()
+
+        return 1.0 - none
+
+
+class UsedHistory:
+    """One BloomFilter per day (UTC) of the images seen in use, as many
+    of them as were loaded"""
+
+    def __init__(self, path=None):
+        self.path = path or history_path()
+        self.days = {}
+        self.changed = set()
+
+
+    def _day_path(self, day):
+        return f'{self.path}/{day}{SUFFIX}'
+
+
+    def saved_days(self):
+        """The days saved, sorted"""
+
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        return sorted(name[:-len(SUFFIX)] for name in names if name.endswith(SUFFIX))
+
+
+    @classmethod
+    def load(cls, path=None, days=None):
+        """Load the saved history of the last days days, today is day 0,
+        or all of it if days is None.  If there is none the history is
+        empty."""
+
+        history = cls(path)
+        oldest = _oldest(days) if days is not None else ""
+
+        for day in history.saved_days():
+            if day < oldest:
+                continue
+
+            with open(history._day_path(day), "rb") as f:
+                history.days[day] = BloomFilter.from_bytes(f.read())
+
+        return history
+
+
+    def add(self, items, day=None):
+        """Add the items to the filter of the day, today by default.  A
+        new filter is sized for the items.  Returns the number of items
+        that were not there already."""
+
+        day = day or datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        items = list(items)
+
+        bloom = self.days.get(day)
+        if bloom is None:
+            bloom = self.days[day] = BloomFilter(bits_for(len(items)))
+
+        new = sum(bloom.add(item) for item in items)
+        if new > 0:
+            self.changed.add(day)
+
+        return new
+
+
+    def add_inventory(self, images):
+        """Add the images in use in the inventory, both by tag and by
+        digest, to the filter of today.  Returns the number of new
+        items."""
+
+        return self.add(used_items(images))
+
+
+    def expire(self, keep_days):
+        """Forget the days more than keep_days ago, the saved ones too.
+        Returns the number of days forgotten."""
+
+        oldest = _oldest(keep_days)
+
+        expired = [ day for day in self.saved_days() if day < oldest ]
+        for day in expired:
+            os.remove(self._day_path(day))
+
+        for day in [ day for day in self.days if day < oldest ]:
+            del self.days[day]
+            self.changed.discard(day)
+
+        return len(expired)
+
+
+    def window(self, days):
+        """The Window of everything seen in the last days days,
+        including today, of the days loaded"""
+
+        oldest = _oldest(days)
+
+        return Window(bloom for day, bloom in sorted(self.days.items()) if day >= oldest)
+
+
+    def save(self):
+        """Save the days that changed, each atomically"""
+
+        os.makedirs(self.path, exist_ok=True)
+
+        for day in sorted(self.changed):
+            atomic_write(self._day_path(day), self.days[day].to_bytes())
+
+        self.changed.clear()
+
+
+def used_items(images):
+    """The images in use in the inventory as they are kept in the
+    history: "host/repo:tag" and "host/repo@digest" """
+
+    for host, used in inventory.index_by_registry(images).items():
+        yield from (f'{host}/{repo_tag}' for repo_tag in used.repo_tags)
+        yield from (f'{host}/{repo_digest}' for repo_digest in used.repo_digests)
+
+
+def record_inventory(images, keep_days, path=None):
+    """Add the images in use in the inventory to the saved history and
+    forget the days more than keep_days ago.  Only today's filter is
+    loaded, and only saved if something changed, the same inventory is
+    usually saved many times a day.  Returns the number of new items."""
+
+    return record_items(used_items(images), keep_days, path)
+
+
+def record_items(items, keep_days, path=None):
+    """Add the items, from used_items, to the saved history as
+    record_inventory does.  Returns the number of new items."""
+
+    history = UsedHistory.load(path, days=0)
+
+    new = history.add(items)
+    history.expire(keep_days)
+    history.save()
+
+    return new